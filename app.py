@@ -1,17 +1,40 @@
+import time
+_IMPORT_STARTED = time.perf_counter()  # ابتدای import ماژول (مرحله 'import' در STARTUP_TIMINGS)
+
+import abc
+import asyncio
+import atexit
+import contextlib
+import functools
 import logging
 import os
 import re
 import json
+import select
+import sqlite3
+import sys
+from collections import OrderedDict, deque
+from collections.abc import MutableMapping
+from enum import Enum
+from bisect import bisect_left, bisect_right, insort
+import heapq
+from itertools import islice
+import threading
+import zlib
+from concurrent.futures import ThreadPoolExecutor
 from uuid import uuid4
 from urllib.parse import urlparse # ⬅️ اضافه شد
 import psycopg2.pool # ⬅️ اضافه شد
 import psycopg2 
+import psycopg2.extras
+import psycopg2.sql
 
 # ⬅️ وارد کردن پکیج‌های لازم برای ساختار Webhook و Flask
 from flask import Flask, request, jsonify
 from telegram import Update, InlineKeyboardMarkup, InlineKeyboardButton
 from telegram.ext import Application, CommandHandler, CallbackQueryHandler, MessageHandler, filters, ContextTypes
-from telegram.error import BadRequest
+from telegram.ext import BasePersistence, BaseRateLimiter, PersistenceInput
+from telegram.error import BadRequest, Forbidden, RetryAfter
 import telegram
 
 # --------------------------------------------------------------------------------------------------
@@ -19,10 +42,84 @@ import telegram
 # --------------------------------------------------------------------------------------------------
 TELEGRAM_BOT_TOKEN = os.environ.get("BOT_TOKEN")
 MANAGER_CHAT_ID = os.environ.get("MANAGER_ID")
+# ⬅️ آدرس Bot API (سرور محلی Bot API یا fake_bot_api.py برای تست کارایی)؛ خالی یعنی api.telegram.org
+BOT_API_BASE_URL = os.environ.get("BOT_API_BASE_URL")  # مثل http://127.0.0.1:8081/bot
+BOT_API_FILE_URL = os.environ.get("BOT_API_FILE_URL")  # پیش‌فرض: همان سرور با مسیر /file/bot
 
 # ⬅️ متغیرهای دیتابیس
+# postgresql://... برای PostgreSQL یا sqlite:///path/bot.db برای SQLite محلی (استقرارهای تک-worker)
+DATABASE_URL = os.environ.get("DATABASE_URL")
+DB_SSLMODE = os.environ.get("DB_SSLMODE", "require")  # Render به require نیاز دارد؛ محلی: disable/prefer
 DB_POOL = None
-PROJECT_DATA = {} # دیکشنری در حافظه برای کش و دسترسی سریع
+DB_CONN_KWARGS = None  # پارامترهای اتصال (برای اتصال اختصاصی LISTEN)
+STORAGE = None  # backend ذخیره‌سازی (PostgresStorage یا SQLiteStorage، بخش ۱.۵)
+PROJECT_DATA = None # کش پروژه‌ها در حافظه (ProjectCache، بخش ۱.۵.۴)
+# ⬅️ سقف پروژه‌هایی که محتواهایشان در حافظه می‌ماند (۰ یعنی بدون سقف)؛ بقیه در اولین دسترسی خوانده می‌شوند.
+PROJECT_CACHE_MAX_PROJECTS = int(os.environ.get("PROJECT_CACHE_MAX_PROJECTS", "500"))
+PROJECT_CACHE_MAX_MB = float(os.environ.get("PROJECT_CACHE_MAX_MB", "64"))  # حجم تخمینی (طول JSON)
+# ⬅️ ایندکس معکوس نقش‌ها: chat_id -> {'editor_of': set(project_id), 'client_of': set(project_id)}
+CHAT_ROLE_INDEX = {}
+# ⬅️ شناسه عددی پروژه‌های هر ادیتور به صورت مرتب: chat_id -> [project_id] (صفحه‌بندی «پروژه‌های من»)
+EDITOR_PROJECT_IDS = {}
+# ⬅️ ایندکس پیام‌های محتوا نزد کارفرما: (client_chat_id, media_message_id) -> (project_id, submission_id)
+MEDIA_MESSAGE_INDEX = {}
+# ⬅️ رجیستری محتواها: submission_id -> (project_id, submission, position در لیست پروژه)
+SUBMISSION_INDEX = {}
+# ⬅️ شمارنده‌های افزایشی وضعیت محتواها (برای داشبورد و /check بدون پیمایش)
+SUBMISSION_STATUSES = ('AwaitingFeedback', 'ClientReviewed', 'ClientApproved',
+                       'RejectedByClient_AwaitingEditor', 'ManagerApproved')
+PROJECT_STATUS_COUNTS = {}  # project_id -> {status: تعداد}
+ARCHIVED_COUNTS = {}  # project_id -> تعداد محتواهای نهایی‌شده منتقل‌شده به آرشیو (خارج از شمارنده‌های بالا)
+GLOBAL_STATUS_COUNTS = {status: 0 for status in SUBMISSION_STATUSES}
+PROJECTS_BY_STATUS = {status: set() for status in SUBMISSION_STATUSES}  # وضعیت -> پروژه‌های دارای آن
+# ⬅️ شناسه عددی همه پروژه‌ها به صورت مرتب (برای صفحه‌بندی لیست‌ها)
+SORTED_PROJECT_IDS = []
+PROJECT_LIST_PAGE_SIZE = int(os.environ.get("PROJECT_LIST_PAGE_SIZE", "8"))
+
+# ⬅️ اجرای کوئری‌های دیتابیس خارج از حلقه asyncio
+# هر پروژه همیشه به یک shard تک‌نخی می‌رود تا ترتیب نوشتن‌های آن حفظ شود.
+DB_WRITE_SHARDS = int(os.environ.get("DB_WRITE_SHARDS", "4"))
+DB_EXECUTORS = [
+    ThreadPoolExecutor(max_workers=1, thread_name_prefix=f"db-write-{i}")
+    for i in range(DB_WRITE_SHARDS)
+]
+
+# ⬅️ صف write-behind: ذخیره‌سازی‌های پشت سر هم یک پروژه ادغام و دسته‌ای نوشته می‌شوند.
+DB_FLUSH_INTERVAL_MS = int(os.environ.get("DB_FLUSH_INTERVAL_MS", "200"))
+DB_FLUSH_MAX_ITEMS = int(os.environ.get("DB_FLUSH_MAX_ITEMS", "50"))
+# با DB_DEFERRED_WRITES=0 همه ذخیره‌سازی‌ها همگام (sync) انجام می‌شوند.
+DB_DEFERRED_WRITES = os.environ.get("DB_DEFERRED_WRITES", "1") != "0"
+
+DURABILITY_SYNC = 'sync'  # تغییر وضعیت: قبل از ادامه هندلر در دیتابیس commit می‌شود.
+DURABILITY_DEFERRED = 'deferred'  # فیلدهای غیرحیاتی: در flush بعدی نوشته می‌شود.
+# پسوند پاسخ تغییر وضعیتی که نوشتن همگام آن ناموفق بود و در صف برای تلاش دوباره ماند.
+SAVE_PENDING_NOTE = "\n\n⏳ ثبت این تغییر در دیتابیس با تاخیر انجام می‌شود و خودکار دوباره تلاش خواهد شد."
+
+# ⬅️ هماهنگی کش بین workerهای Gunicorn با LISTEN/NOTIFY
+# هر ذخیره/حذف روی این کانال اعلام می‌شود و workerهای دیگر فقط همان پروژه را دوباره می‌خوانند.
+DB_NOTIFY_CHANNEL = os.environ.get("DB_NOTIFY_CHANNEL", "project_changes")
+WORKER_ID = f"{os.getpid()}-{uuid4().hex[:8]}"  # مبدأ اعلان‌ها (اعلان‌های خود worker نادیده گرفته می‌شوند)
+
+# ⬅️ حالت گفتگوها (user_data/chat_data) در دیتابیس تا هر worker بتواند مراحل ساخت پروژه را ادامه دهد.
+STATE_KINDS = ('user_data', 'chat_data')
+STATE_UPDATE_INTERVAL = float(os.environ.get("STATE_UPDATE_INTERVAL", "0.5"))  # ثانیه
+
+# ⬅️ صندوق خروجی (outbox): اطلاعیه‌ها در همان تراکنش تغییر وضعیت ثبت و در پس‌زمینه ارسال می‌شوند.
+# با OUTBOX_ENABLED=0 اطلاعیه‌ها حتی روی PostgreSQL مستقیم (مثل حالت بدون دیتابیس) ارسال می‌شوند.
+OUTBOX_ENABLED = os.environ.get("OUTBOX_ENABLED", "1") != "0"
+OUTBOX_BATCH_SIZE = int(os.environ.get("OUTBOX_BATCH_SIZE", "20"))
+OUTBOX_POLL_INTERVAL = float(os.environ.get("OUTBOX_POLL_INTERVAL", "2"))  # ثانیه
+OUTBOX_LEASE_SECONDS = int(os.environ.get("OUTBOX_LEASE_SECONDS", "60"))  # مهلت ارسال یک دسته claim‌شده
+OUTBOX_MAX_ATTEMPTS = int(os.environ.get("OUTBOX_MAX_ATTEMPTS", "5"))
+OUTBOX_RETENTION_HOURS = int(os.environ.get("OUTBOX_RETENTION_HOURS", "24"))  # نگهداری سطرهای تحویل‌شده
+
+# ⬅️ آرشیو محتواهای نهایی‌شده (ManagerApproved): فشرده در جدول submission_archive، خارج از حافظه.
+# آخرین ARCHIVE_KEEP_FINALIZED محتوای نهایی‌شده هر پروژه می‌ماند، مگر قدیمی‌تر از ARCHIVE_AFTER_HOURS باشد.
+ARCHIVE_KEEP_FINALIZED = int(os.environ.get("ARCHIVE_KEEP_FINALIZED", "10"))
+ARCHIVE_AFTER_HOURS = float(os.environ.get("ARCHIVE_AFTER_HOURS", "72"))
+ARCHIVE_INTERVAL = float(os.environ.get("ARCHIVE_INTERVAL", "600"))  # ثانیه بین دو دور آرشیو
+ARCHIVE_BATCH_PROJECTS = int(os.environ.get("ARCHIVE_BATCH_PROJECTS", "50"))  # پروژه‌های هر دور
+ARCHIVE_PAGE_SIZE = 10  # محتواهای هر صفحه گزارش آرشیو
 
 logging.basicConfig(
     format=
@@ -30,10 +127,612 @@ logging.basicConfig(
     level=logging.INFO)
 logger = logging.getLogger(__name__)
 
+# ⬅️ صف آپدیت‌های Webhook: پاسخ فوری به تلگرام و پردازش در پس‌زمینه
+UPDATE_QUEUE_SIZE = int(os.environ.get("UPDATE_QUEUE_SIZE", "1000"))
+# تعداد آپدیت‌هایی که همزمان پردازش می‌شوند (آپدیت‌های یک چت همیشه به ترتیب اجرا می‌شوند).
+UPDATE_WORKERS = int(os.environ.get("UPDATE_WORKERS", "16"))
+UPDATE_SHUTDOWN_TIMEOUT = float(os.environ.get("UPDATE_SHUTDOWN_TIMEOUT", "10"))
+# حداکثر زمان مقداردهی Application (getMe) و فاصله تلاش دوباره در صورت شکست آن
+UPDATE_START_TIMEOUT = float(os.environ.get("UPDATE_START_TIMEOUT", "30"))
+UPDATE_START_RETRY = 5
+WEBHOOK_SECRET = os.environ.get("WEBHOOK_SECRET")  # همان secret_token در setWebhook
+
+# ⬅️ راه‌اندازی سریع: اتصال دیتابیس و بارگذاری پروژه‌ها در پس‌زمینه تا وب‌سرور بلافاصله به / پاسخ دهد.
+# با LAZY_STARTUP=0 مثل قبل همه این کارها هنگام import انجام می‌شود.
+LAZY_STARTUP = os.environ.get("LAZY_STARTUP", "1") != "0"
+STARTUP_TIMINGS = {}  # مرحله (import، pool، schema، load) -> ثانیه
+STARTUP_READY = threading.Event()  # پروژه‌ها بارگذاری شده‌اند (مسیر /ready)
+
 # --------------------------------------------------------------------------------------------------
-# ۱.۵. توابع مدیریت داده (ذخیره سازی دائمی در PostgreSQL)
+# ۱.۴. مدل داده درون‌حافظه (Project و Submission)
 # --------------------------------------------------------------------------------------------------
 
+
+class SubmissionStatus(str, Enum):
+    """وضعیت یک محتوا؛ هر عضو با رشته ذخیره‌شده در دیتابیس (و SUBMISSION_STATUSES) برابر است."""
+    AWAITING_FEEDBACK = 'AwaitingFeedback'
+    CLIENT_REVIEWED = 'ClientReviewed'
+    CLIENT_APPROVED = 'ClientApproved'
+    REJECTED_BY_CLIENT = 'RejectedByClient_AwaitingEditor'
+    MANAGER_APPROVED = 'ManagerApproved'
+
+    # در متن پیام‌ها و لاگ‌ها خود مقدار نوشته می‌شود، نه SubmissionStatus.X
+    __str__ = str.__str__
+    __format__ = str.__format__
+
+
+_STATUS_BY_VALUE = {status.value: status for status in SubmissionStatus}
+# تغییر وضعیت‌های مجاز (همان مسیرهای هندلرها)؛ در ادغام نوشتن‌های همزمان دوباره بررسی می‌شوند.
+SUBMISSION_TRANSITIONS = {
+    SubmissionStatus.AWAITING_FEEDBACK: (SubmissionStatus.CLIENT_REVIEWED,
+                                         SubmissionStatus.CLIENT_APPROVED),
+    SubmissionStatus.CLIENT_REVIEWED: (SubmissionStatus.REJECTED_BY_CLIENT,
+                                       SubmissionStatus.MANAGER_APPROVED),
+    SubmissionStatus.CLIENT_APPROVED: (SubmissionStatus.MANAGER_APPROVED,),
+}
+
+
+def is_valid_transition(old_status, new_status):
+    """آیا محتوا می‌تواند از old_status به new_status برود (رشته یا SubmissionStatus)."""
+    return new_status in SUBMISSION_TRANSITIONS.get(_STATUS_BY_VALUE.get(str(old_status)), ())
+
+
+def intern_chat_id(chat_id):
+    """شناسه چت به صورت رشته intern‌شده (نقش‌ها و ایندکس‌ها یک نسخه از هر شناسه نگه می‌دارند)."""
+    return sys.intern(str(chat_id)) if chat_id is not None else None
+
+
+# JSON سطرها فشرده و بدون بررسی حلقه ساخته می‌شود (مدل‌ها فقط داده ساده دارند).
+_encode_json = json.JSONEncoder(separators=(',', ':'), check_circular=False).encode
+
+
+class Submission:
+    """یک محتوای ارسالی ادیتور (سطر جدول submissions).
+
+    کلیدهای ناشناخته JSON ذخیره‌شده در extra نگه داشته می‌شوند تا در رفت و برگشت از بین نروند.
+    """
+    __slots__ = ('submission_id', 'media_message_id', 'file_id', 'media_type', 'caption',
+                 'feedback', 'status', 'finalized_at', 'extra')
+    FIELDS = frozenset(__slots__) - {'extra'}
+
+    def __init__(self, submission_id, media_message_id=None, file_id=None, media_type=None,
+                 caption=None, feedback=None, status=SubmissionStatus.AWAITING_FEEDBACK,
+                 finalized_at=None, extra=None):
+        self.submission_id = submission_id
+        self.media_message_id = media_message_id
+        self.file_id = file_id
+        self.media_type = sys.intern(media_type) if media_type else media_type
+        self.caption = caption
+        self.feedback = [] if feedback is None else feedback
+        self.status = _STATUS_BY_VALUE.get(status) or SubmissionStatus(status)
+        self.finalized_at = finalized_at
+        self.extra = extra
+
+    @classmethod
+    def from_dict(cls, data):
+        extra = None if data.keys() <= cls.FIELDS else {
+            key: value for key, value in data.items() if key not in cls.FIELDS}
+        return cls(data['submission_id'], data.get('media_message_id'), data.get('file_id'),
+                   data.get('media_type'), data.get('caption'), data.get('feedback'),
+                   data.get('status', SubmissionStatus.AWAITING_FEEDBACK),
+                   data.get('finalized_at'), extra)
+
+    @classmethod
+    def from_json(cls, text):
+        return cls.from_dict(json.loads(text))
+
+    def to_dict(self):
+        data = {
+            'submission_id': self.submission_id,
+            'media_message_id': self.media_message_id,
+            'file_id': self.file_id,
+            'media_type': self.media_type,
+            'caption': self.caption,
+            'feedback': self.feedback,
+            'status': self.status.value
+        }
+        if self.finalized_at is not None:
+            data['finalized_at'] = self.finalized_at
+        if self.extra:
+            data.update(self.extra)
+        return data
+
+    def to_json(self):
+        return _encode_json(self.to_dict())
+
+
+class Project:
+    """اطلاعات یک پروژه (سطر جدول projects) و در صورت گرم بودن، لیست محتواهای آن.
+
+    submissions برابر None یعنی پروژه سرد است و محتواهایش در حافظه نیستند (بخش ۱.۵.۴).
+    """
+    __slots__ = ('name', 'status', 'client_chat_id', 'editor_chat_id', 'submissions', 'extra')
+    FIELDS = frozenset(__slots__) - {'extra'}
+
+    def __init__(self, name, status='ReadyForEditSubmission', client_chat_id=None,
+                 editor_chat_id=None, submissions=None, extra=None):
+        self.name = name
+        self.status = sys.intern(status) if status else status
+        self.client_chat_id = intern_chat_id(client_chat_id)
+        self.editor_chat_id = intern_chat_id(editor_chat_id)
+        self.submissions = submissions
+        self.extra = extra
+
+    @classmethod
+    def from_dict(cls, data):
+        extra = None if data.keys() <= cls.FIELDS else {
+            key: value for key, value in data.items() if key not in cls.FIELDS}
+        submissions = data.get('submissions')
+        if submissions is not None:
+            submissions = [Submission.from_dict(submission) for submission in submissions]
+        return cls(data.get('name'), data.get('status'), data.get('client_chat_id'),
+                   data.get('editor_chat_id'), submissions, extra)
+
+    @classmethod
+    def from_json(cls, text):
+        return cls.from_dict(json.loads(text))
+
+    def chat_id(self, chat_key):
+        """شناسه چت نقش chat_key ('editor_chat_id' یا 'client_chat_id')."""
+        return getattr(self, chat_key)
+
+    def set_chat_id(self, chat_key, chat_id):
+        setattr(self, chat_key, intern_chat_id(chat_id))
+
+    def meta_dict(self):
+        """اطلاعات پایه پروژه بدون submissions (محتوای ستون data جدول projects)."""
+        data = {
+            'name': self.name,
+            'status': self.status,
+            'client_chat_id': self.client_chat_id,
+            'editor_chat_id': self.editor_chat_id
+        }
+        if self.extra:
+            data.update(self.extra)
+        return data
+
+    def meta_json(self):
+        return _encode_json(self.meta_dict())
+
+    def to_dict(self):
+        data = self.meta_dict()
+        if self.submissions is not None:
+            data['submissions'] = [submission.to_dict() for submission in self.submissions]
+        return data
+
+    def to_json(self):
+        return _encode_json(self.to_dict())
+
+    def replace_with(self, other):
+        """جایگزینی درجای همه فیلدها با نسخه other (ارجاع‌های موجود به این شیء معتبر می‌مانند)."""
+        for field in self.__slots__:
+            setattr(self, field, getattr(other, field))
+
+# --------------------------------------------------------------------------------------------------
+# ۱.۵. توابع مدیریت داده (ذخیره سازی دائمی در PostgreSQL یا SQLite)
+# --------------------------------------------------------------------------------------------------
+
+class StorageBackend(abc.ABC):
+    """رابط ذخیره‌سازی دائمی: Pool اتصال‌ها، schema و بخش‌های وابسته به نوع دیتابیس.
+
+    بقیه SQL (خواندن پروژه‌ها و حالت گفتگوها، حذف) مشترک است و با placeholder %s نوشته
+    می‌شود. نوشتن‌های نسخه‌دار در این کلاس با SQL قابل حمل و یک دستور برای هر سطر
+    پیاده شده‌اند؛ هر backend می‌تواند نسخه دسته‌ای خود را جایگزین کند. هر متد نوشتن
+    شناسه سطرهایی را که واقعاً نوشته شدند برمی‌گرداند (بقیه متعارض‌اند).
+    """
+    name = None
+    # چند worker روی یک دیتابیس: LISTEN/NOTIFY، claim همزمان outbox (SKIP LOCKED) و آرشیو.
+    multi_worker = False
+    row_lock = ""  # پسوند SELECT برای قفل سطر تا پایان تراکنش
+
+    @abc.abstractmethod
+    def create_pool(self):
+        """Pool اتصال‌ها با getconn/putconn (مثل ThreadedConnectionPool)."""
+
+    def connect_kwargs(self):
+        """پارامترهای psycopg2.connect (برای اتصال اختصاصی LISTEN)؛ None یعنی اعلان بین workerها وجود ندارد."""
+        return None
+
+    @abc.abstractmethod
+    def create_schema(self, cur):
+        """ساخت/مهاجرت جداول (idempotent؛ هر بار در setup_db اجرا می‌شود)."""
+
+    @abc.abstractmethod
+    def next_project_id(self, cur):
+        """شناسه پروژه بعدی، بزرگ‌تر از همه شناسه‌های موجود."""
+
+    def backfill_versions(self, cur):
+        """نسخه ۱ برای سطرهای قدیمی (از پیش از ستون version یا مهاجرت JSONB) با نسخه ۰.
+
+        هر نوشتن نسخه‌دار سطر را با نسخه ۱ یا بیشتر می‌نویسد، پس نسخه ۰ فقط سطر موجودی است
+        که نسخه نگرفته؛ بدون این کار اولین نوشتن آن مسیر INSERT را می‌رفت، با ON CONFLICT
+        کنار گذاشته و به اشتباه برخورد شمرده می‌شد.
+        """
+        cur.execute("UPDATE projects SET version = 1 WHERE version = 0;")
+        cur.execute("UPDATE submissions SET version = 1 WHERE version = 0;")
+
+    def notify(self, cur, payloads):
+        """ارسال اعلان‌ها به workerهای دیگر در همان تراکنش (بدون multi_worker کاری نمی‌کند)."""
+
+    def insert_projects(self, cur, rows):
+        written = set()
+        for project_id, data, version in rows:
+            cur.execute("""
+                INSERT INTO projects (id, data, version) VALUES (%s, %s, %s)
+                ON CONFLICT (id) DO NOTHING;
+            """, (project_id, data, version))
+            if cur.rowcount:
+                written.add(project_id)
+        return written
+
+    def update_projects(self, cur, rows):
+        written = set()
+        for project_id, data, version in rows:
+            cur.execute("""
+                UPDATE projects SET data = %s, version = %s WHERE id = %s AND version = %s;
+            """, (data, version, project_id, version - 1))
+            if cur.rowcount:
+                written.add(project_id)
+        return written
+
+    def insert_submissions(self, cur, rows):
+        written = set()
+        for row in rows:
+            cur.execute("""
+                INSERT INTO submissions
+                    (submission_id, project_id, position, status, media_message_id, data, version)
+                SELECT %s, %s, %s, %s, %s, %s, %s
+                WHERE EXISTS (SELECT 1 FROM projects WHERE id = %s)
+                ON CONFLICT (submission_id) DO NOTHING;
+            """, (*row, row[1]))
+            if cur.rowcount:
+                written.add(row[0])
+        return written
+
+    def update_submissions(self, cur, rows):
+        written = set()
+        for submission_id, _, _, status, media_message_id, data, version in rows:
+            cur.execute("""
+                UPDATE submissions
+                SET status = %s, media_message_id = %s, data = %s, version = %s
+                WHERE submission_id = %s AND version = %s;
+            """, (status, media_message_id, data, version, submission_id, version - 1))
+            if cur.rowcount:
+                written.add(submission_id)
+        return written
+
+    def upsert_state(self, cur, rows):
+        cur.executemany("""
+            INSERT INTO conversation_state (kind, id, data) VALUES (%s, %s, %s)
+            ON CONFLICT (kind, id) DO UPDATE SET data = excluded.data;
+        """, rows)
+
+    def insert_outbox(self, cur, rows):
+        cur.executemany("INSERT INTO outbox (chat_id, priority, payload) VALUES (%s, %s, %s);",
+                        rows)
+
+
+class PostgresStorage(StorageBackend):
+    """PostgreSQL (Render): JSONB، UPSERT دسته‌ای با execute_values و LISTEN/NOTIFY بین workerها."""
+    name = 'postgres'
+    multi_worker = True
+    row_lock = " FOR UPDATE"
+
+    def __init__(self, url, sslmode=DB_SSLMODE):
+        self.url = url
+        self.sslmode = sslmode
+
+    def connect_kwargs(self):
+        # پارس کردن URL دیتابیس
+        url = urlparse(self.url)
+        return dict(
+            database=url.path[1:],
+            user=url.username,
+            password=url.password,
+            host=url.hostname,
+            port=url.port,
+            sslmode=self.sslmode  # DB_SSLMODE؛ برای Render الزامی است که require بماند
+        )
+
+    def create_pool(self):
+        # ایجاد Threaded Connection Pool
+        return psycopg2.pool.ThreadedConnectionPool(1, 20, **self.connect_kwargs())
+
+    def create_schema(self, cur):
+        # workerها همزمان بالا می‌آیند؛ ساخت جداول و مهاجرت به نوبت انجام می‌شود.
+        cur.execute("SELECT pg_advisory_xact_lock(hashtext('projects_schema'));")
+
+        # ایجاد جدول projects (id به عنوان کلید اصلی و data به صورت JSONB)
+        cur.execute("""
+            CREATE TABLE IF NOT EXISTS projects (
+                id INT PRIMARY KEY,
+                data JSONB NOT NULL
+            );
+        """)
+        # هر محتوای ارسالی یک سطر جدا دارد تا افزودن/تغییر آن کل تاریخچه پروژه را بازنویسی نکند.
+        cur.execute("""
+            CREATE TABLE IF NOT EXISTS submissions (
+                submission_id TEXT PRIMARY KEY,
+                project_id INT NOT NULL,
+                position INT NOT NULL,
+                status TEXT NOT NULL,
+                media_message_id BIGINT,
+                data JSONB NOT NULL
+            );
+        """)
+        # user_data/chat_data تلگرام (مراحل ساخت پروژه و تغییر نقش مدیر)
+        cur.execute("""
+            CREATE TABLE IF NOT EXISTS conversation_state (
+                kind TEXT NOT NULL,
+                id BIGINT NOT NULL,
+                data JSONB NOT NULL,
+                PRIMARY KEY (kind, id)
+            );
+        """)
+        # اطلاعیه‌های ارسال‌نشده؛ در همان تراکنش تغییر وضعیت درج می‌شوند.
+        cur.execute("""
+            CREATE TABLE IF NOT EXISTS outbox (
+                id BIGSERIAL PRIMARY KEY,
+                chat_id BIGINT NOT NULL,
+                priority SMALLINT NOT NULL,
+                payload JSONB NOT NULL,
+                created_at TIMESTAMPTZ NOT NULL DEFAULT now(),
+                attempts INT NOT NULL DEFAULT 0,
+                claimed_until TIMESTAMPTZ,
+                delivered_at TIMESTAMPTZ,
+                failed_at TIMESTAMPTZ,
+                last_error TEXT
+            );
+        """)
+        cur.execute("""
+            CREATE INDEX IF NOT EXISTS outbox_pending_idx ON outbox (priority, id)
+            WHERE delivered_at IS NULL AND failed_at IS NULL;
+        """)
+        # محتواهای نهایی‌شده قدیمی؛ JSON هر محتوا با zlib فشرده می‌شود و فقط برای گزارش خوانده می‌شود.
+        cur.execute("""
+            CREATE TABLE IF NOT EXISTS submission_archive (
+                submission_id TEXT PRIMARY KEY,
+                project_id INT NOT NULL,
+                finalized_at TIMESTAMPTZ,
+                archived_at TIMESTAMPTZ NOT NULL DEFAULT now(),
+                data BYTEA NOT NULL
+            );
+        """)
+        cur.execute("""
+            CREATE INDEX IF NOT EXISTS submission_archive_project_idx
+            ON submission_archive (project_id, finalized_at);
+        """)
+        # شماره نسخه برای UPSERT شرطی (compare-and-swap) بین نویسنده‌های همزمان
+        cur.execute("ALTER TABLE projects ADD COLUMN IF NOT EXISTS version INT NOT NULL DEFAULT 0;")
+        cur.execute("ALTER TABLE submissions ADD COLUMN IF NOT EXISTS version INT NOT NULL DEFAULT 0;")
+        cur.execute("""
+            CREATE INDEX IF NOT EXISTS submissions_project_status_idx
+            ON submissions (project_id, status);
+        """)
+        cur.execute("""
+            CREATE INDEX IF NOT EXISTS submissions_media_message_idx
+            ON submissions (media_message_id);
+        """)
+        # شناسه پروژه‌های جدید از یک sequence مشترک بین workerها گرفته می‌شود.
+        cur.execute("CREATE SEQUENCE IF NOT EXISTS project_id_seq;")
+        cur.execute("""
+            SELECT setval('project_id_seq',
+                          GREATEST(MAX(id), (SELECT last_value FROM project_id_seq)))
+            FROM projects HAVING MAX(id) IS NOT NULL;
+        """)
+        migrate_embedded_submissions(cur)
+        self.backfill_versions(cur)
+
+    def next_project_id(self, cur):
+        cur.execute("SELECT nextval('project_id_seq');")
+        return cur.fetchone()[0]
+
+    def notify(self, cur, payloads):
+        cur.execute("SELECT pg_notify(%s, payload) FROM unnest(%s) AS payload;",
+                    (DB_NOTIFY_CHANNEL, payloads))
+
+    # سطر جدید (نسخه ۱) INSERT می‌شود و سطر موجود فقط اگر نسخه‌اش تغییر نکرده باشد UPDATE؛
+    # سطری که برنگردد (RETURNING) یعنی نویسنده دیگری آن را تغییر داده یا حذف کرده است.
+    def insert_projects(self, cur, rows):
+        return {row[0] for row in psycopg2.extras.execute_values(cur, """
+            INSERT INTO projects (id, data, version) 
+            VALUES %s
+            ON CONFLICT (id) DO NOTHING
+            RETURNING id;
+        """, rows, fetch=True)}
+
+    def update_projects(self, cur, rows):
+        return {row[0] for row in psycopg2.extras.execute_values(cur, """
+            UPDATE projects AS p
+            SET data = v.data, version = v.version
+            FROM (VALUES %s) AS v (id, data, version)
+            WHERE p.id = v.id AND p.version = v.version - 1
+            RETURNING p.id;
+        """, rows, template="(%s, %s::jsonb, %s)", fetch=True)}
+
+    def insert_submissions(self, cur, rows):
+        # محتوای جدید فقط برای پروژه‌ای که هنوز وجود دارد ثبت می‌شود.
+        return {row[0] for row in psycopg2.extras.execute_values(cur, """
+            INSERT INTO submissions
+                (submission_id, project_id, position, status, media_message_id, data, version)
+            SELECT v.* FROM (VALUES %s) AS v
+                (submission_id, project_id, position, status, media_message_id, data, version)
+            WHERE EXISTS (SELECT 1 FROM projects p WHERE p.id = v.project_id)
+            ON CONFLICT (submission_id) DO NOTHING
+            RETURNING submission_id;
+        """, rows, template="(%s, %s, %s, %s, %s::bigint, %s::jsonb, %s)", fetch=True)}
+
+    def update_submissions(self, cur, rows):
+        return {row[0] for row in psycopg2.extras.execute_values(cur, """
+            UPDATE submissions AS s
+            SET status = v.status,
+                media_message_id = v.media_message_id,
+                data = v.data,
+                version = v.version
+            FROM (VALUES %s) AS v
+                (submission_id, project_id, position, status, media_message_id, data, version)
+            WHERE s.submission_id = v.submission_id AND s.version = v.version - 1
+            RETURNING s.submission_id;
+        """, rows, template="(%s, %s, %s, %s, %s::bigint, %s::jsonb, %s)", fetch=True)}
+
+    def upsert_state(self, cur, rows):
+        psycopg2.extras.execute_values(cur, """
+            INSERT INTO conversation_state (kind, id, data)
+            VALUES %s
+            ON CONFLICT (kind, id) DO UPDATE SET data = EXCLUDED.data;
+        """, rows)
+
+    def insert_outbox(self, cur, rows):
+        psycopg2.extras.execute_values(cur, """
+            INSERT INTO outbox (chat_id, priority, payload)
+            VALUES %s;
+        """, rows, template="(%s, %s, %s::jsonb)")
+
+
+class SQLiteCursor(sqlite3.Cursor):
+    """cursor با placeholder سبک psycopg2 (%s) تا SQL مشترک برای هر دو backend یکی بماند."""
+
+    def execute(self, query, params=()):
+        return super().execute(query.replace('%s', '?'), params)
+
+    def executemany(self, query, params):
+        return super().executemany(query.replace('%s', '?'), params)
+
+
+class SQLiteConnection(sqlite3.Connection):
+
+    def cursor(self, factory=SQLiteCursor):
+        return super().cursor(factory)
+
+
+class SQLitePool:
+    """Pool اتصال‌های SQLite با همان رابط getconn/putconn در ThreadedConnectionPool."""
+
+    def __init__(self, path, maxconn=20):
+        self.path = path
+        self._idle = []
+        self._lock = threading.Lock()
+        self._slots = threading.BoundedSemaphore(maxconn)
+
+    def _connect(self):
+        # BEGIN IMMEDIATE پیش از اولین نوشتن: قفل نوشتن از ابتدای تراکنش گرفته می‌شود تا
+        # خواندن دوباره سطر متعارض (_resolve_conflict) تا commit معتبر بماند.
+        conn = sqlite3.connect(self.path, timeout=30, isolation_level='IMMEDIATE',
+                               check_same_thread=False, factory=SQLiteConnection)
+        conn.execute("PRAGMA synchronous = NORMAL;")  # در حالت WAL بدون از دست رفتن سازگاری
+        return conn
+
+    def getconn(self):
+        self._slots.acquire()
+        with self._lock:
+            if self._idle:
+                return self._idle.pop()
+        try:
+            return self._connect()
+        except Exception:
+            self._slots.release()
+            raise
+
+    def putconn(self, conn):
+        conn.rollback()
+        with self._lock:
+            self._idle.append(conn)
+        self._slots.release()
+
+    def closeall(self):
+        """بستن اتصال‌های بیکار (مثل ThreadedConnectionPool.closeall)."""
+        with self._lock:
+            idle, self._idle = self._idle, []
+        for conn in idle:
+            conn.close()
+
+
+class SQLiteStorage(StorageBackend):
+    """SQLite محلی در حالت WAL برای استقرارهای کوچک تک-worker و بنچمارک بدون Postgres.
+
+    اعلان بین workerها، outbox و آرشیو وجود ندارد: اطلاعیه‌ها مستقیم ارسال می‌شوند و
+    محتواهای نهایی‌شده در جدول submissions می‌مانند.
+    """
+    name = 'sqlite'
+
+    def __init__(self, path):
+        self.path = path
+
+    def create_pool(self):
+        return SQLitePool(self.path)
+
+    def create_schema(self, cur):
+        cur.execute("PRAGMA journal_mode = WAL;")
+        cur.execute("""
+            CREATE TABLE IF NOT EXISTS projects (
+                id INTEGER PRIMARY KEY,
+                data TEXT NOT NULL,
+                version INTEGER NOT NULL DEFAULT 0
+            );
+        """)
+        cur.execute("""
+            CREATE TABLE IF NOT EXISTS submissions (
+                submission_id TEXT PRIMARY KEY,
+                project_id INTEGER NOT NULL,
+                position INTEGER NOT NULL,
+                status TEXT NOT NULL,
+                media_message_id INTEGER,
+                data TEXT NOT NULL,
+                version INTEGER NOT NULL DEFAULT 0
+            );
+        """)
+        cur.execute("""
+            CREATE INDEX IF NOT EXISTS submissions_project_status_idx
+            ON submissions (project_id, status);
+        """)
+        cur.execute("""
+            CREATE INDEX IF NOT EXISTS submissions_media_message_idx
+            ON submissions (media_message_id);
+        """)
+        cur.execute("""
+            CREATE TABLE IF NOT EXISTS conversation_state (
+                kind TEXT NOT NULL,
+                id INTEGER NOT NULL,
+                data TEXT NOT NULL,
+                PRIMARY KEY (kind, id)
+            );
+        """)
+        # خالی می‌ماند (آرشیو فقط در PostgreSQL)؛ خواندن فهرست و حذف پروژه مثل Postgres کار می‌کنند.
+        cur.execute("""
+            CREATE TABLE IF NOT EXISTS submission_archive (
+                submission_id TEXT PRIMARY KEY,
+                project_id INTEGER NOT NULL,
+                finalized_at REAL,
+                archived_at TEXT NOT NULL DEFAULT CURRENT_TIMESTAMP,
+                data BLOB NOT NULL
+            );
+        """)
+        cur.execute("CREATE TABLE IF NOT EXISTS project_id_seq (last_value INTEGER NOT NULL);")
+        cur.execute("""
+            INSERT INTO project_id_seq (last_value)
+            SELECT 0 WHERE NOT EXISTS (SELECT 1 FROM project_id_seq);
+        """)
+        self.backfill_versions(cur)
+
+    def next_project_id(self, cur):
+        cur.execute("""
+            UPDATE project_id_seq
+            SET last_value = MAX(last_value, (SELECT COALESCE(MAX(id), 0) FROM projects)) + 1
+            RETURNING last_value;
+        """)
+        return cur.fetchone()[0]
+
+
+def storage_backend(database_url):
+    """انتخاب backend از روی DATABASE_URL: sqlite:///bot.db (نسبی)، sqlite:////var/bot.db یا PostgreSQL."""
+    if database_url and database_url.startswith("sqlite:///"):
+        return SQLiteStorage(database_url[len("sqlite:///"):])
+    return PostgresStorage(database_url)
+
+
+STORAGE = storage_backend(DATABASE_URL)
+
+
 def get_db_conn():
     """دریافت یک اتصال از Pool."""
     global DB_POOL
@@ -49,140 +748,2484 @@ def release_db_conn(conn):
 
 def setup_db():
     """تنظیمات اولیه دیتابیس و ایجاد Pool."""
-    global DB_POOL
-    DATABASE_URL = os.environ.get("DATABASE_URL")
+    global DB_POOL, DB_CONN_KWARGS
     if not DATABASE_URL:
         logger.warning("⚠️ DATABASE_URL تنظیم نشده است. ذخیره سازی دائمی غیرفعال است.")
         return
 
     try:
-        # پارس کردن URL دیتابیس
-        url = urlparse(DATABASE_URL)
-        dbname = url.path[1:]
-        user = url.username
-        password = url.password
-        host = url.hostname
-        port = url.port
+        started = time.perf_counter()
+        DB_POOL = STORAGE.create_pool()
+        DB_CONN_KWARGS = STORAGE.connect_kwargs()
+        STARTUP_TIMINGS['pool'] = time.perf_counter() - started
 
-        # ایجاد Threaded Connection Pool
-        DB_POOL = psycopg2.pool.ThreadedConnectionPool(1, 20, 
-            database=dbname,
-            user=user,
-            password=password,
-            host=host,
-            port=port,
-            sslmode='require' # برای Render الزامی است
+        started = time.perf_counter()
+        conn = DB_POOL.getconn()
+        STORAGE.create_schema(conn.cursor())
+        conn.commit()
+        STARTUP_TIMINGS['schema'] = time.perf_counter() - started
+        logger.info(f"✅ جداول دیتابیس ({STORAGE.name}) با موفقیت بررسی/ایجاد شدند.")
+        DB_POOL.putconn(conn)
+
+    except Exception as e:
+        logger.error(f"❌ خطای اتصال/تنظیم دیتابیس: {e}")
+        DB_POOL = None 
+        DB_CONN_KWARGS = None
+
+def migrate_embedded_submissions(cur):
+    """مهاجرت لیست submissions داخل JSONB پروژه‌های قدیمی به جدول submissions.
+
+    در همان تراکنش setup_db اجرا می‌شود و روی داده‌های مهاجرت‌شده اثری ندارد.
+    """
+    cur.execute("""
+        INSERT INTO submissions
+            (submission_id, project_id, position, status, media_message_id, data)
+        SELECT sub.value->>'submission_id', p.id, (sub.ordinality - 1)::INT,
+               sub.value->>'status', (sub.value->>'media_message_id')::BIGINT,
+               sub.value
+        FROM projects p,
+             jsonb_array_elements(p.data->'submissions') WITH ORDINALITY AS sub(value, ordinality)
+        WHERE p.data ? 'submissions'
+        ON CONFLICT (submission_id) DO NOTHING;
+    """)
+    migrated = cur.rowcount
+    cur.execute("""
+        UPDATE projects SET data = data - 'submissions'
+        WHERE data ? 'submissions';
+    """)
+    if cur.rowcount:
+        logger.info(
+            f"✅ {migrated} محتوا از JSONB {cur.rowcount} پروژه به جدول 'submissions' منتقل شد."
         )
 
-        conn = DB_POOL.getconn()
-        cur = conn.cursor()
 
-        # ایجاد جدول projects (id به عنوان کلید اصلی و data به صورت JSONB)
+def load_project_data():
+    """بارگذاری اطلاعات پایه همه پروژه‌ها (بدون محتواها) از دیتابیس در حافظه.
+
+    محتواهای هر پروژه در اولین load_project همان پروژه خوانده می‌شوند؛ شمارنده‌های
+    وضعیت از شمارش دیتابیس ساخته می‌شوند تا داشبورد و لیست‌ها به محتواها نیاز نداشته باشند.
+    """
+    status_counts = {}
+    archived_counts = {}
+    conn = get_db_conn()
+    if not conn:
+        PROJECT_DATA.reset({})
+        rebuild_indexes()
+        return
+
+    try:
+        # پر کردن کش سراسری از نتایج دیتابیس
+        projects, status_counts, archived_counts, versions = fetch_project_catalog(
+            conn.cursor())
+        PROJECT_DATA.reset(projects)
+        WRITE_QUEUE.reset_versions(versions)
+        logger.info(
+            f"✅ داده‌های پروژه از دیتابیس با موفقیت بارگذاری شدند. ({len(PROJECT_DATA)} پروژه)"
+        )
+    except Exception as e:
+        logger.error(f"❌ خطای بارگذاری داده از دیتابیس: {e}. با داده خالی ادامه می‌یابد.")
+        PROJECT_DATA.reset({})
+        status_counts = {}
+        archived_counts = {}
+        conn.rollback()
+    finally:
+        release_db_conn(conn)
+        rebuild_indexes(status_counts, archived_counts)
+
+
+def fetch_project_catalog(cur):
+    """خواندن اطلاعات پایه همه پروژه‌ها و تعداد محتواهای هر وضعیت (بدون خود محتواها).
+
+    خروجی (projects، status_counts، archived_counts، versions)؛ status_counts به صورت
+    project_id -> {وضعیت: تعداد} و archived_counts به صورت project_id -> تعداد آرشیوشده‌ها است.
+    """
+    versions = {}
+    projects = {}
+    cur.execute("SELECT id, CAST(data AS TEXT), version FROM projects;")
+    for row_project_id, data, version in cur.fetchall():
+        projects[str(row_project_id)] = Project.from_json(data)
+        versions[('project', str(row_project_id))] = (version, data)
+
+    status_counts = {}
+    cur.execute("""
+        SELECT project_id, status, COUNT(*) FROM submissions
+        GROUP BY project_id, status;
+    """)
+    for row_project_id, status, count in cur.fetchall():
+        if str(row_project_id) in projects:
+            status_counts.setdefault(str(row_project_id), {})[status] = count
+
+    cur.execute("SELECT project_id, COUNT(*) FROM submission_archive GROUP BY project_id;")
+    archived_counts = {
+        str(row_project_id): count for row_project_id, count in cur.fetchall()
+        if str(row_project_id) in projects
+    }
+    return projects, status_counts, archived_counts, versions
+
+
+def fetch_projects(cur, project_id=None):
+    """خواندن پروژه‌ها (همه یا فقط project_id) همراه با محتواهایشان به ترتیب ارسال.
+
+    خروجی (projects، versions)؛ versions برای هر سطر (نسخه، JSON خوانده‌شده) را دارد.
+    """
+    versions = {}
+    if project_id is None:
+        cur.execute("SELECT id, CAST(data AS TEXT), version FROM projects;")
+    else:
+        cur.execute("SELECT id, CAST(data AS TEXT), version FROM projects WHERE id = %s;",
+                    (int(project_id),))
+    projects = {}
+    for row_project_id, data, version in cur.fetchall():
+        project_data = projects[str(row_project_id)] = Project.from_json(data)
+        project_data.submissions = []
+        versions[('project', str(row_project_id))] = (version, data)
+
+    if project_id is None:
         cur.execute("""
-            CREATE TABLE IF NOT EXISTS projects (
-                id INT PRIMARY KEY,
-                data JSONB NOT NULL
-            );
+            SELECT project_id, CAST(data AS TEXT), version FROM submissions
+            ORDER BY project_id, position;
         """)
+    else:
+        cur.execute("""
+            SELECT project_id, CAST(data AS TEXT), version FROM submissions
+            WHERE project_id = %s ORDER BY position;
+        """, (int(project_id),))
+    for row_project_id, data, version in cur.fetchall():
+        project_data = projects.get(str(row_project_id))
+        if project_data is not None:
+            submission = Submission.from_json(data)
+            project_data.submissions.append(submission)
+            versions[('submission', submission.submission_id)] = (version, data)
+    return projects, versions
+
+
+def fetch_project_from_db(project_id):
+    """خواندن دوباره یک پروژه از دیتابیس؛ خروجی (project_data یا None اگر حذف شده، versions).
+
+    سطرهای کثیف همین پروژه ابتدا flush می‌شوند تا تغییرات ذخیره‌نشده این worker از
+    بین نرود. در صورت خطا استثنا بالا می‌رود.
+    """
+    WRITE_QUEUE.flush(WRITE_QUEUE.pending_keys(project_id))
+    conn = get_db_conn()
+    if not conn:
+        raise RuntimeError("اتصال دیتابیس غیرفعال است")
+    try:
+        projects, versions = fetch_projects(conn.cursor(), project_id)
+        return projects.get(str(project_id)), versions
+    finally:
+        conn.rollback()
+        release_db_conn(conn)
+
+
+def fetch_project_catalog_from_db():
+    """خواندن دوباره اطلاعات پایه همه پروژه‌ها (پس از قطع اتصال LISTEN و از دست رفتن اعلان‌ها)."""
+    WRITE_QUEUE.flush()
+    conn = get_db_conn()
+    if not conn:
+        raise RuntimeError("اتصال دیتابیس غیرفعال است")
+    try:
+        return fetch_project_catalog(conn.cursor())
+    finally:
+        conn.rollback()
+        release_db_conn(conn)
+
+
+def find_media_owner_in_db(project_ids, media_message_id):
+    """یافتن (project_id، submission_id) پیام media_message_id در میان پروژه‌های project_ids.
+
+    برای پروژه‌های سردی که محتواهایشان در MEDIA_MESSAGE_INDEX نیست؛ None اگر یافت نشود.
+    """
+    conn = get_db_conn()
+    if not conn:
+        raise RuntimeError("اتصال دیتابیس غیرفعال است")
+    try:
+        cur = conn.cursor()
+        project_ids = [int(project_id) for project_id in project_ids]
+        cur.execute(f"""
+            SELECT project_id, submission_id FROM submissions
+            WHERE media_message_id = %s AND project_id IN ({', '.join(['%s'] * len(project_ids))})
+            LIMIT 1;
+        """, (media_message_id, *project_ids))
+        row = cur.fetchone()
+        return (str(row[0]), row[1]) if row else None
+    finally:
+        conn.rollback()
+        release_db_conn(conn)
+
+
+def fetch_state_from_db(kind, state_id=None):
+    """خواندن user_data/chat_data (همه یا فقط state_id) به صورت id -> JSON."""
+    conn = get_db_conn()
+    if not conn:
+        raise RuntimeError("اتصال دیتابیس غیرفعال است")
+    try:
+        cur = conn.cursor()
+        if state_id is None:
+            cur.execute("SELECT id, CAST(data AS TEXT) FROM conversation_state WHERE kind = %s;",
+                        (kind, ))
+        else:
+            cur.execute("""
+                SELECT id, CAST(data AS TEXT) FROM conversation_state WHERE kind = %s AND id = %s;
+            """, (kind, int(state_id)))
+        return dict(cur.fetchall())
+    finally:
+        conn.rollback()
+        release_db_conn(conn)
+
+
+def delete_state_from_db(kind, state_id):
+    """حذف user_data/chat_data یک کاربر یا چت."""
+    conn = get_db_conn()
+    if not conn:
+        return
+    try:
+        cur = conn.cursor()
+        cur.execute("DELETE FROM conversation_state WHERE kind = %s AND id = %s;",
+                    (kind, int(state_id)))
+        notify_state_changes(cur, [(kind, int(state_id))])
         conn.commit()
-        logger.info("✅ جدول 'projects' با موفقیت بررسی/ایجاد شد.")
-        DB_POOL.putconn(conn)
+    except Exception as e:
+        logger.error(f"❌ خطای حذف {kind} شناسه {state_id} از دیتابیس: {e}")
+        conn.rollback()
+    finally:
+        release_db_conn(conn)
+
+
+def allocate_project_id_from_db():
+    """گرفتن شناسه پروژه جدید از sequence دیتابیس (یکتا بین همه workerها)."""
+    conn = get_db_conn()
+    if not conn:
+        return None
+    try:
+        project_id = STORAGE.next_project_id(conn.cursor())
+        conn.commit()
+        return str(project_id)
+    except Exception as e:
+        logger.error(f"❌ خطای گرفتن شناسه پروژه جدید از دیتابیس: {e}")
+        conn.rollback()
+        return None
+    finally:
+        release_db_conn(conn)
+
+
+def notify_project_changes(cur, project_ids, op):
+    """اعلام تغییر پروژه‌ها روی DB_NOTIFY_CHANNEL.
+
+    در همان تراکنش تغییر اجرا می‌شود، پس اعلان فقط پس از commit به workerهای دیگر می‌رسد.
+    """
+    STORAGE.notify(cur, [
+        json.dumps({'origin': WORKER_ID, 'op': op, 'project_id': project_id})
+        for project_id in sorted(project_ids)
+    ])
+
+
+def notify_state_changes(cur, keys):
+    """اعلام تغییر user_data/chat_data (کلیدهای (kind، id)) تا workerهای دیگر کش خود را باطل کنند."""
+    STORAGE.notify(cur, [
+        json.dumps({'origin': WORKER_ID, 'op': kind, 'id': state_id})
+        for kind, state_id in sorted(keys)
+    ])
+
+
+def project_row(project_id, project_data):
+    """سطر جدول projects: اطلاعات پروژه بدون لیست submissions."""
+    return (int(project_id), project_data.meta_json())
+
+
+def submission_row(project_id, position, submission):
+    """سطر جدول submissions برای یک محتوای ارسالی."""
+    return (submission.submission_id, int(project_id), position,
+            submission.status.value, submission.media_message_id,
+            submission.to_json())
+
+
+_MISSING = object()
+
+
+def merge_row_data(base, local, remote):
+    """ادغام سه‌طرفه یک سطر: تغییرات این worker (local نسبت به base) روی نسخه remote.
+
+    فیلدهایی که فقط طرف مقابل تغییر داده دست نمی‌خورند. اگر هر دو طرف به یک لیست
+    (مثل feedback) آیتم اضافه کرده باشند، هر دو حفظ می‌شوند. در بقیه برخوردها
+    تغییر این worker اعمال می‌شود. خروجی (merged، تعداد فیلدهای متعارض).
+    """
+    merged = dict(remote)
+    clashes = 0
+    for field in set(base) | set(local):
+        base_value = base.get(field, _MISSING)
+        ours = local.get(field, _MISSING)
+        if ours == base_value:
+            continue
+        theirs = remote.get(field, _MISSING)
+        if theirs != base_value and theirs != ours:
+            if (isinstance(base_value, list) and isinstance(ours, list) and isinstance(theirs, list)
+                    and ours[:len(base_value)] == base_value
+                    and theirs[:len(base_value)] == base_value):
+                merged[field] = theirs + ours[len(base_value):]
+                continue
+            clashes += 1
+        if ours is _MISSING:
+            merged.pop(field, None)
+        else:
+            merged[field] = ours
+    return merged, clashes
+
+
+def _status_change_applies(base, local, remote):
+    """آیا تغییر وضعیت این worker روی نسخه تازه دیتابیس هنوز مجاز است.
+
+    اگر هر دو طرف وضعیت را تغییر داده باشند، تغییر ما مثل هندلرها از وضعیت فعلی دیتابیس
+    بررسی می‌شود؛ مثلاً تأیید نهایی محتوایی که worker دیگر همزمان رد کرده (یا همان تصمیم
+    تکراری) اعمال نمی‌شود.
+    """
+    ours, theirs, base_status = local.get('status'), remote.get('status'), base.get('status')
+    if base_status is None or ours == base_status or theirs == base_status:
+        return True
+    return is_valid_transition(theirs, ours)
+
+
+def _resolve_conflict(cur, kind, row, base_json):
+    """خواندن دوباره (با قفل سطر) و اعمال دوباره تغییر یک سطر متعارض در همان تراکنش.
+
+    خروجی (وضعیت، تعداد فیلدهای متعارض)؛ وضعیت 'dropped' یعنی سطر در این فاصله حذف شده
+    و 'rejected' یعنی تغییر وضعیت محتوا از وضعیت فعلی دیتابیس مجاز نبود و اعمال نشد.
+    """
+    if kind == 'project':
+        cur.execute(f"SELECT CAST(data AS TEXT) FROM projects WHERE id = %s{STORAGE.row_lock};",
+                    (row[0],))
+    else:
+        cur.execute(
+            f"SELECT CAST(data AS TEXT) FROM submissions WHERE submission_id = %s{STORAGE.row_lock};",
+            (row[0],))
+    current = cur.fetchone()
+    if current is None:
+        return 'dropped', 0
+
+    base = json.loads(base_json) if base_json else {}
+    local = json.loads(row[-2])
+    remote = json.loads(current[0])
+    if kind == 'submission' and not _status_change_applies(base, local, remote):
+        logger.warning(
+            f"⚠️ تغییر وضعیت محتوای {row[0]} به {local.get('status')} رد شد: "
+            f"وضعیت فعلی آن در دیتابیس {remote.get('status')} است.")
+        return 'rejected', 1
+    merged, clashes = merge_row_data(base, local, remote)
+    if kind == 'project':
+        cur.execute("""
+            UPDATE projects SET data = %s, version = version + 1 WHERE id = %s;
+        """, (json.dumps(merged), row[0]))
+    else:
+        cur.execute("""
+            UPDATE submissions
+            SET status = %s, media_message_id = %s, data = %s, version = version + 1
+            WHERE submission_id = %s;
+        """, (merged['status'], merged.get('media_message_id'), json.dumps(merged), row[0]))
+    return 'merged', clashes
+
+
+def save_rows_to_db(project_rows, submission_rows, base_rows=None, state_rows=(),
+                    outbox_rows=()):
+    """ذخیره‌سازی دسته‌ای سطرهای تغییرکرده با INSERT ... ON CONFLICT چندسطری در یک تراکنش.
+
+    آخرین عنصر هر سطر نسخه جدید آن است و UPSERT فقط وقتی انجام می‌شود که نسخه فعلی
+    دیتابیس یکی کمتر باشد (compare-and-swap). سطرهایی که در این فاصله نویسنده دیگری
+    تغییر داده، در همان تراکنش دوباره خوانده و با base_rows (کلید -> JSON پایه) ادغام
+    می‌شوند. خروجی None یعنی خطا؛ در غیر این صورت دیکشنری کلید -> (وضعیت، تعداد
+    فیلدهای متعارض) برای سطرهای متعارض (خالی یعنی همه بدون برخورد نوشته شدند).
+
+    state_rows سطرهای (kind، id، JSON) حالت گفتگوها هستند و بدون نسخه بازنویسی می‌شوند.
+    outbox_rows سطرهای (کلید، chat_id، اولویت، JSON پیام) اطلاعیه‌های همان تغییرات‌اند و
+    در همین تراکنش در جدول outbox درج می‌شوند (مگر سطر آن‌ها در این فاصله حذف شده یا
+    تغییر وضعیت آن رد شده باشد).
+    """
+    if not project_rows and not submission_rows and not state_rows and not outbox_rows:
+        return {}
+
+    conn = get_db_conn()
+    if not conn:
+        logger.warning(
+            f"❌ {len(project_rows)} پروژه و {len(submission_rows)} محتوا در دیتابیس ذخیره نشد: اتصال دیتابیس غیرفعال است."
+        )
+        return None
+
+    base_rows = base_rows or {}
+    try:
+        cur = conn.cursor()
+        pending = []
+        if project_rows:
+            written = STORAGE.insert_projects(cur, [row for row in project_rows if row[-1] == 1])
+            written |= STORAGE.update_projects(cur, [row for row in project_rows if row[-1] > 1])
+            pending += [(('project', str(row[0])), row) for row in project_rows
+                        if row[0] not in written]
+        if submission_rows:
+            written = STORAGE.insert_submissions(
+                cur, [row for row in submission_rows if row[-1] == 1])
+            written |= STORAGE.update_submissions(
+                cur, [row for row in submission_rows if row[-1] > 1])
+            pending += [(('submission', row[0]), row) for row in submission_rows
+                        if row[0] not in written]
+
+        conflicts = {
+            key: _resolve_conflict(cur, key[0], row, base_rows.get(key))
+            for key, row in pending
+        }
+        if project_rows or submission_rows:
+            notify_project_changes(
+                cur, {row[0] for row in project_rows} | {row[1] for row in submission_rows},
+                'save')
+        if state_rows:
+            STORAGE.upsert_state(cur, state_rows)
+            notify_state_changes(cur, {(row[0], row[1]) for row in state_rows})
+        outbox_rows = [row[1:] for row in outbox_rows
+                       if conflicts.get(row[0], ('written',))[0] not in ('dropped', 'rejected')]
+        if outbox_rows:
+            STORAGE.insert_outbox(cur, outbox_rows)
+        
+        conn.commit()
+        if project_rows or submission_rows:
+            project_codes = ", ".join(
+                sorted({f"P{row[0]}" for row in project_rows} |
+                       {f"P{row[1]}" for row in submission_rows}))
+            logger.info(
+                f"💾 پروژه‌های {project_codes} با موفقیت در دیتابیس ذخیره/به‌روزرسانی شدند "
+                f"({len(project_rows)} پروژه، {len(submission_rows)} محتوا).")
+        if conflicts:
+            logger.warning(
+                f"⚠️ {len(conflicts)} سطر همزمان توسط نویسنده دیگری تغییر کرده بود و دوباره بررسی شد.")
+        return conflicts
+    except Exception as e:
+        logger.error(
+            f"❌ خطای ذخیره‌سازی دسته‌ای {len(project_rows)} پروژه و {len(submission_rows)} محتوا در دیتابیس: {e}"
+        )
+        conn.rollback()
+        return None
+    finally:
+        release_db_conn(conn)
+
+
+def project_snapshot(project_id, submission_id=None):
+    """کلید صف و سطر فعلی پروژه (یا فقط یک محتوای آن)؛ None اگر در حافظه نباشد."""
+    project_data = PROJECT_DATA.peek(project_id)
+    if project_data is None:
+        logger.error(f"❌ پروژه P{project_id} در حافظه یافت نشد تا ذخیره شود.")
+        return None
+
+    if submission_id is None:
+        return ('project', project_id), project_row(project_id, project_data)
+
+    submission = get_submission(project_id, submission_id)
+    if submission is None:
+        logger.error(f"❌ محتوای {submission_id} در پروژه P{project_id} یافت نشد تا ذخیره شود.")
+        return None
+    return ('submission', submission_id), submission_row(
+        project_id, submission_position(submission_id), submission)
+
+
+def save_project_to_db(project_id, submission_id=None):
+    """ذخیره‌سازی/به‌روزرسانی همگام یک پروژه در دیتابیس (UPSERT).
+
+    اگر submission_id داده شود فقط سطر همان محتوا نوشته می‌شود، وگرنه فقط سطر پروژه.
+    """
+    snapshot = project_snapshot(project_id, submission_id)
+    if snapshot is None:
+        return False
+    WRITE_QUEUE.mark_dirty(*snapshot)
+    return WRITE_QUEUE.flush([snapshot[0]])
+
+def delete_project_from_db(project_id):
+    """حذف یک پروژه مشخص و محتواهای آن از دیتابیس."""
+    conn = get_db_conn()
+    if not conn:
+        logger.warning(f"❌ پروژه P{project_id} حذف نشد: اتصال دیتابیس غیرفعال است.")
+        return
+    
+    try:
+        cur = conn.cursor()
+        cur.execute("DELETE FROM submissions WHERE project_id = %s;", (int(project_id),))
+        cur.execute("DELETE FROM submission_archive WHERE project_id = %s;", (int(project_id),))
+        cur.execute("DELETE FROM projects WHERE id = %s;", (int(project_id),))
+        notify_project_changes(cur, [int(project_id)], 'delete')
+        conn.commit()
+        logger.info(f"🗑️ پروژه P{project_id} با موفقیت از دیتابیس حذف شد.")
+    except Exception as e:
+        logger.error(f"❌ خطای حذف پروژه P{project_id} از دیتابیس: {e}")
+        conn.rollback()
+    finally:
+        release_db_conn(conn)
+
+# --------------------------------------------------------------------------------------------------
+# ۱.۵.۱. رابط ناهمگام دیتابیس (بدون مسدود کردن حلقه رویداد)
+# --------------------------------------------------------------------------------------------------
+
+
+def _db_executor_for(project_id):
+    """انتخاب shard ثابت برای یک پروژه تا نوشتن‌های آن به ترتیب اجرا شوند."""
+    return DB_EXECUTORS[int(project_id) % len(DB_EXECUTORS)]
+
+
+async def run_in_db_executor(executor, func, *args, **kwargs):
+    """اجرای یک تابع همگام دیتابیس روی executor و انتظار برای نتیجه آن."""
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(
+        executor, functools.partial(func, *args, **kwargs))
+
+
+class WriteBehindQueue:
+    """صف write-behind برای ذخیره پروژه‌ها و محتواها.
+
+    هر سطر (پروژه یا محتوا) با آخرین snapshot خود «کثیف» علامت می‌خورد؛ چند ذخیره
+    پشت سر هم یک سطر ادغام می‌شوند و یک نخ پس‌زمینه هر DB_FLUSH_INTERVAL_MS
+    میلی‌ثانیه یا با رسیدن به DB_FLUSH_MAX_ITEMS سطر، همه را با UPSERT چندسطری
+    می‌نویسد.
+
+    صف نسخه هر سطر در دیتابیس و JSON همان نسخه را نگه می‌دارد؛ هر snapshot با نسخه‌ای
+    که بر پایه آن ساخته شده نوشته می‌شود تا تغییر همزمان نویسنده دیگر (worker دیگر)
+    تشخیص داده و ادغام شود، نه اینکه بی‌صدا بازنویسی شود.
+
+    اطلاعیه‌های یک تغییر (outbox) به کلید همان سطر وصل می‌شوند و فقط همراه آن، در
+    همان تراکنش، نوشته می‌شوند.
+    """
+
+    def __init__(self, interval_ms, max_items):
+        self.interval = interval_ms / 1000
+        self.max_items = max_items
+        # ('project', project_id) یا ('submission', submission_id) -> (آخرین سطر، (نسخه پایه، JSON پایه))
+        self._pending = {}
+        # کلید -> (نسخه، JSON) آخرین حالت شناخته‌شده سطر در دیتابیس
+        self._versions = {}
+        # کلید -> [(chat_id، اولویت، JSON پیام)] اطلاعیه‌هایی که با آن سطر درج می‌شوند
+        self._outbox = {}
+        # ('submission', submission_id) -> شناسه پروژه آن؛ گروه قفل محتوایی که دیگر در صف
+        # نیست (flush پس‌زمینه آن را برداشته) هم از روی کلید پیدا می‌شود.
+        self._submission_groups = {}
+        # پس از ادغام سطرهای متعارض با شناسه پروژه‌های آن‌ها صدا زده می‌شود.
+        self.on_conflict = None
+        # پس از commit سطرهای جدید outbox صدا زده می‌شود (بیدار کردن ارسال‌کننده).
+        self.on_outbox = None
+        self.conflicts = 0
+        self.merged = 0
+        self.clashes = 0
+        self.dropped = 0
+        self.rejected = 0
+        self._state_lock = threading.Lock()
+        # گروه (پروژه یا نوع حالت گفتگو) -> قفل flush/حذف آن گروه؛ نوشتن‌های یک پروژه به ترتیب
+        # snapshotها انجام می‌شوند اما flush پروژه‌های مختلف منتظر هم نمی‌ماند.
+        self._flush_locks = {}
+        self._wakeup = threading.Event()
+        self._closed = False
+        self._thread = None
+
+    def mark_dirty(self, key, row, outbox=()):
+        """ثبت آخرین snapshot یک سطر برای flush بعدی (بر پایه آخرین نسخه شناخته‌شده)."""
+        with self._state_lock:
+            self._pending[key] = (row, self._versions.get(key, (0, None)))
+            if key[0] == 'submission':
+                self._submission_groups[key] = self._lock_group(key, row)
+            if outbox:
+                self._outbox.setdefault(key, []).extend(outbox)
+            pending_count = len(self._pending)
+            if self._thread is None and not self._closed:
+                self._thread = threading.Thread(target=self._run,
+                                                name="db-write-behind",
+                                                daemon=True)
+                self._thread.start()
+        if pending_count >= self.max_items:
+            self._wakeup.set()
+
+    def pending_count(self):
+        with self._state_lock:
+            return len(self._pending)
+
+    def pending_keys(self, project_id):
+        """کلیدهای کثیف یک پروژه (سطر پروژه و محتواهای آن)."""
+        with self._state_lock:
+            return [
+                key for key, (row, _) in self._pending.items()
+                if key == ('project', project_id) or (
+                    key[0] == 'submission' and row[1] == int(project_id))
+            ]
+
+    def pending_projects(self):
+        """شناسه پروژه‌هایی که سطر ذخیره‌نشده (و اطلاعیه‌های outbox آن) در صف دارند."""
+        with self._state_lock:
+            return {
+                key[1] if key[0] == 'project' else str(row[1])
+                for key, (row, _) in self._pending.items()
+                if key[0] in ('project', 'submission')
+            }
+
+    def discard(self, keys):
+        """حذف سطرهای کثیف بدون نوشتن آن‌ها (داده جدیدتری از جای دیگر رسیده است)."""
+        with self._state_lock:
+            for key in keys:
+                self._pending.pop(key, None)
+                self._outbox.pop(key, None)
+
+    def reset_versions(self, versions):
+        """جایگزینی همه نسخه‌ها (پس از بارگذاری کامل از دیتابیس)."""
+        with self._state_lock:
+            self._versions = dict(versions)
+
+    def update_versions(self, versions):
+        """ثبت نسخه‌های تازه‌خوانده‌شده چند سطر (پس از خواندن دوباره یک پروژه)."""
+        with self._state_lock:
+            self._versions.update(versions)
+
+    def forget(self, keys):
+        """حذف نسخه سطرهایی که دیگر در حافظه نیستند."""
+        with self._state_lock:
+            for key in keys:
+                self._versions.pop(key, None)
+                self._submission_groups.pop(key, None)
+
+    def _record_written(self, key, row, base_version):
+        """پیشبرد نسخه سطری که بدون برخورد نوشته شد (و snapshotهای بعدی همان پایه)."""
+        written = (base_version + 1, row[-1])  # آخرین عنصر سطر، JSON آن است.
+        if self._versions.get(key, (0, None))[0] <= base_version:
+            self._versions[key] = written
+        entry = self._pending.get(key)
+        if entry is not None and entry[1][0] == base_version:
+            self._pending[key] = (entry[0], written)
+
+    @staticmethod
+    def _lock_group(key, row):
+        """گروه قفل یک سطر: شناسه پروژه برای پروژه و محتواهایش، نوع حالت برای حالت گفتگوها."""
+        if key[0] == 'project':
+            return key[1]
+        if key[0] == 'submission':
+            return str(row[1])
+        return key[0]
+
+    def _key_group(self, key):
+        """گروه قفل یک کلید، چه سطر آن در صف باشد چه نه (زیر _state_lock صدا زده می‌شود)."""
+        entry = self._pending.get(key)
+        if entry is not None:
+            return self._lock_group(key, entry[0])
+        if key[0] == 'submission':
+            return self._submission_groups.get(key)
+        return self._lock_group(key, None)
+
+    @contextlib.contextmanager
+    def _hold_groups(self, groups):
+        """گرفتن قفل چند گروه به ترتیب ثابت (بدون بن‌بست بین flushهای همزمان)."""
+        with self._state_lock:
+            locks = [self._flush_locks.setdefault(group, threading.Lock())
+                     for group in sorted(groups)]
+        with contextlib.ExitStack() as stack:
+            for lock in locks:
+                stack.enter_context(lock)
+            yield
+
+    def flush(self, keys=None):
+        """نوشتن سطرهای کثیف (همه یا فقط keys) در دیتابیس.
+
+        فقط قفل پروژه‌های همین سطرها گرفته می‌شود؛ سطرهای پروژه‌هایی که پس از آن کثیف
+        شده‌اند به flush بعدی می‌رسند. با keys قفل گروه هر کلید همیشه گرفته می‌شود، حتی
+        اگر flush پس‌زمینه سطر را از صف برداشته باشد؛ پس خروجی True یعنی snapshot در
+        دیتابیس commit شده است و نه اینکه نوشتن آن هنوز در جریان است.
+        """
+        keys = None if keys is None else set(keys)
+        with self._state_lock:
+            if keys is None:
+                groups = {self._lock_group(key, row) for key, (row, _) in self._pending.items()}
+            else:
+                groups = {self._key_group(key) for key in keys} - {None}
+        if not groups:
+            return True
+        with self._hold_groups(groups):
+            with self._state_lock:
+                batch = {
+                    key: entry for key, entry in self._pending.items()
+                    if (keys is None or key in keys)
+                    and self._lock_group(key, entry[0]) in groups
+                }
+                for key in batch:
+                    del self._pending[key]
+                outbox = {key: self._outbox.pop(key) for key in batch if key in self._outbox}
+            if not batch:
+                return True
+
+            items = list(batch.items())
+            ok = True
+            outbox_written = False
+            conflicted_projects = set()
+            for start in range(0, len(items), self.max_items):
+                chunk = items[start:start + self.max_items]
+                # هر سطر با نسخه جدید (نسخه پایه + ۱) نوشته می‌شود.
+                project_rows = [row + (base[0] + 1,)
+                                for (kind, _), (row, base) in chunk if kind == 'project']
+                submission_rows = [row + (base[0] + 1,)
+                                   for (kind, _), (row, base) in chunk if kind == 'submission']
+                state_rows = [row for (kind, _), (row, _) in chunk if kind in STATE_KINDS]
+                outbox_rows = [(key,) + message
+                               for key, _ in chunk for message in outbox.get(key, ())]
+                conflicts = save_rows_to_db(
+                    project_rows, submission_rows,
+                    {key: base[1] for key, (_, base) in chunk}, state_rows, outbox_rows)
+                with self._state_lock:
+                    if conflicts is None:
+                        ok = False
+                        # بازگرداندن به صف، مگر اینکه در این فاصله snapshot جدیدتری ثبت شده باشد.
+                        for key, entry in chunk:
+                            self._pending.setdefault(key, entry)
+                            if key in outbox:
+                                # اطلاعیه‌های قدیمی‌تر جلوتر از اطلاعیه‌های بعدی همان سطر می‌مانند.
+                                self._outbox[key] = outbox[key] + self._outbox.get(key, [])
+                        continue
+                    if outbox_rows:
+                        outbox_written = True
+                    for key, (row, base) in chunk:
+                        if key[0] in STATE_KINDS:
+                            continue
+                        if key not in conflicts:
+                            self._record_written(key, row, base[0])
+                            continue
+                        # نسخه پایه جلو نمی‌رود تا خواندن دوباره پروژه، حافظه و نسخه را با هم تازه کند.
+                        outcome, clashes = conflicts[key]
+                        self.conflicts += 1
+                        self.clashes += clashes
+                        if outcome == 'merged':
+                            self.merged += 1
+                        elif outcome == 'rejected':
+                            self.rejected += 1
+                        else:
+                            self.dropped += 1
+                        conflicted_projects.add(key[1] if key[0] == 'project' else str(row[1]))
+            if conflicted_projects and self.on_conflict:
+                self.on_conflict(conflicted_projects)
+            if outbox_written and self.on_outbox:
+                self.on_outbox()
+            return ok
+
+    def delete(self, project_id):
+        """حذف پروژه از صف و دیتابیس، بدون اینکه flush همزمان آن را دوباره بنویسد."""
+        with self._hold_groups({str(project_id)}):
+            with self._state_lock:
+                self._pending = {
+                    key: entry
+                    for key, entry in self._pending.items()
+                    if key != ('project', project_id) and not (
+                        key[0] == 'submission' and entry[0][1] == int(project_id))
+                }
+                # اطلاعیه‌های پروژه حذف‌شده هم دیگر ارسال نمی‌شوند.
+                self._outbox = {key: messages for key, messages in self._outbox.items()
+                                if key in self._pending}
+                self._submission_groups = {key: group
+                                           for key, group in self._submission_groups.items()
+                                           if group != str(project_id)}
+            delete_project_from_db(project_id)
+
+    def close(self):
+        """flush نهایی هنگام خاموش شدن فرآیند."""
+        self._closed = True
+        self._wakeup.set()
+        if self.pending_count():
+            logger.info(f"💾 flush نهایی {self.pending_count()} سطر پیش از خاموش شدن...")
+        self.flush()
+
+    def stats(self):
+        """وضعیت صف و برخوردهای نوشتن همزمان برای مسیر /stats."""
+        with self._state_lock:
+            outbox_pending = sum(len(messages) for messages in self._outbox.values())
+        return {
+            'pending': self.pending_count(),
+            'outbox_pending': outbox_pending,
+            'conflicts': self.conflicts,
+            'merged': self.merged,
+            'field_clashes': self.clashes,
+            'dropped': self.dropped,
+            'rejected': self.rejected
+        }
+
+    def _run(self):
+        while not self._closed:
+            self._wakeup.wait(self.interval)
+            self._wakeup.clear()
+            try:
+                self.flush()
+            except Exception as e:
+                logger.error(f"❌ خطای flush پس‌زمینه صف write-behind: {e}")
+
+
+WRITE_QUEUE = WriteBehindQueue(DB_FLUSH_INTERVAL_MS, DB_FLUSH_MAX_ITEMS)
+atexit.register(WRITE_QUEUE.close)
+
+
+async def save_project(project_id, submission_id=None, durability=DURABILITY_SYNC,
+                       outbox=()):
+    """ذخیره ناهمگام پروژه از طریق صف write-behind.
+
+    بدون submission_id فقط سطر پروژه (نام، وضعیت، نقش‌ها) و با آن فقط سطر همان
+    محتوا نوشته می‌شود. durability=DURABILITY_SYNC تا commit شدن در دیتابیس صبر
+    می‌کند؛ DURABILITY_DEFERRED فقط سطر را کثیف علامت می‌زند و بلافاصله برمی‌گردد.
+    outbox پیام‌های ساخته‌شده با outbox_message است که در همان تراکنش ثبت می‌شوند.
+    فراخواننده یک بار برای هر ذخیره با outbox_enabled تصمیم می‌گیرد: اگر ارسال‌کننده outbox
+    روی این worker اجرا نمی‌شود، outbox خالی می‌دهد و همان تصمیم را به outbox_sends می‌دهد
+    تا پیام‌ها مستقیماً ارسال شوند.
+
+    خروجی True یعنی سطر commit شد و False یعنی نوشتن ناموفق بود و سطر برای تلاش دوباره
+    flush پس‌زمینه در صف ماند؛ بدون دیتابیس یا با ذخیره DEFERRED (منتظر commit نمی‌ماند) None است.
+    """
+    if not DB_POOL:
+        logger.warning(f"❌ پروژه P{project_id} در دیتابیس ذخیره نشد: اتصال دیتابیس غیرفعال است.")
+        return None
+
+    # سریال‌سازی روی نخ حلقه انجام می‌شود تا یک snapshot سازگار به صف برسد.
+    snapshot = project_snapshot(project_id, submission_id)
+    if snapshot is None:
+        return None
+    key, row = snapshot
+
+    WRITE_QUEUE.mark_dirty(key, row, [
+        (int(message['chat_id']), message['priority'], json.dumps(message))
+        for message in outbox
+    ])
+
+    if durability == DURABILITY_SYNC or not DB_DEFERRED_WRITES:
+        saved = await run_in_db_executor(_db_executor_for(project_id),
+                                         WRITE_QUEUE.flush, [key])
+        if not saved:
+            logger.warning(f"⚠️ ذخیره P{project_id} ({key[0]}) ناموفق بود؛ flush پس‌زمینه دوباره تلاش می‌کند.")
+        return saved
+    return None
+
+
+def save_note(saved):
+    """پسوند پاسخ کاربر برای خروجی save_project (فقط وقتی نوشتن همگام ناموفق بود)."""
+    return SAVE_PENDING_NOTE if saved is False else ""
+
+
+async def delete_project(project_id):
+    """نسخه ناهمگام delete_project_from_db."""
+    await run_in_db_executor(_db_executor_for(project_id),
+                             WRITE_QUEUE.delete, project_id)
+
+
+async def flush_pending_writes(application=None):
+    """hook خاموش شدن Application: نوشتن همه سطرهای کثیف."""
+    await run_in_db_executor(DB_EXECUTORS[0], WRITE_QUEUE.flush)
+
+
+async def load_projects():
+    """نسخه ناهمگام load_project_data."""
+    await run_in_db_executor(DB_EXECUTORS[0], load_project_data)
+
+
+async def next_project_id():
+    """شناسه پروژه جدید: از sequence دیتابیس، یا بدون دیتابیس بزرگ‌ترین شناسه + ۱."""
+    if DB_POOL:
+        project_id = await run_in_db_executor(DB_EXECUTORS[0],
+                                              allocate_project_id_from_db)
+        if project_id is not None:
+            return project_id
+    if SORTED_PROJECT_IDS:
+        return str(SORTED_PROJECT_IDS[-1] + 1)
+    return '1'
+
+
+def apply_project_refresh(project_id, fresh_data, versions=None):
+    """جایگزینی نسخه حافظه یک پروژه با نسخه دیتابیس و به‌روزرسانی ایندکس‌ها و نسخه‌ها.
+
+    شیء Project موجود در جا به‌روز می‌شود تا ارجاع‌های هندلرهای در حال اجرا معتبر بماند.
+    """
+    current = PROJECT_DATA.peek(project_id)
+    if current is not None:
+        unindex_project(project_id, current)
+    if fresh_data is None:
+        PROJECT_DATA.pop(project_id, None)
+        ARCHIVED_COUNTS.pop(project_id, None)
+        return
+    if current is not None:
+        current.replace_with(fresh_data)
+        fresh_data = current
+    versions = versions or {}
+    PROJECT_DATA.store(project_id, fresh_data,
+                       sum(len(data) for _, data in versions.values()))
+    index_project(project_id, fresh_data)
+    WRITE_QUEUE.update_versions(versions)
+
+
+async def refresh_project(project_id):
+    """خواندن دوباره یک پروژه از دیتابیس پس از اعلان تغییر از worker دیگر یا برخورد نوشتن."""
+    # زیر قفل پروژه تا هندلری بین flush، خواندن و جایگزینی آن را تغییر ندهد.
+    async with PROJECT_LOCKS.hold(project_id):
+        cold = not PROJECT_DATA.is_resident(project_id)
+        try:
+            fresh_data, versions = await run_in_db_executor(
+                _db_executor_for(project_id), fetch_project_from_db, project_id)
+        except Exception as e:
+            logger.error(f"❌ خطای به‌روزرسانی پروژه P{project_id} از دیتابیس: {e}")
+            return False
+        # اعمال روی نخ حلقه، همان جایی که هندلرها PROJECT_DATA را تغییر می‌دهند.
+        apply_project_refresh(project_id, fresh_data, versions)
+        if cold:
+            # برای پروژه سرد فقط اطلاعات پایه و شمارنده‌ها لازم بود؛ محتواها در حافظه نمی‌مانند.
+            PROJECT_DATA.evict(project_id)
+    return True
+
+
+def schedule_project_refresh(project_ids):
+    """زمان‌بندی خواندن دوباره پروژه‌ها روی حلقه ربات (از نخ‌های دیگر، مثل flush پس‌زمینه)."""
+    loop = UPDATE_DISPATCHER.loop
+    if loop is None or loop.is_closed():
+        return
+    for project_id in project_ids:
+        asyncio.run_coroutine_threadsafe(refresh_project(project_id), loop)
+
+
+async def resync_projects():
+    """بارگذاری دوباره همه پروژه‌ها (وقتی ممکن است اعلان‌هایی از دست رفته باشند).
+
+    همه پروژه‌ها سرد می‌شوند و محتواهایشان در دسترسی بعدی دوباره خوانده می‌شود.
+    """
+    try:
+        projects, status_counts, archived_counts, versions = await run_in_db_executor(
+            DB_EXECUTORS[0], fetch_project_catalog_from_db)
+    except Exception as e:
+        logger.error(f"❌ خطای همگام‌سازی دوباره پروژه‌ها از دیتابیس: {e}")
+        return False
+    PROJECT_DATA.reset(projects)
+    WRITE_QUEUE.reset_versions(versions)
+    rebuild_indexes(status_counts, archived_counts)
+    logger.info(f"🔄 همه پروژه‌ها از دیتابیس همگام شدند ({len(PROJECT_DATA)} پروژه).")
+    return True
+
+
+class ProjectChangeListener:
+    """گوش دادن به اعلان‌های DB_NOTIFY_CHANNEL روی یک اتصال اختصاصی.
+
+    هر اعلان از worker دیگر باعث خواندن دوباره همان پروژه روی حلقه ربات می‌شود.
+    پس از هر اتصال (از جمله اولین اتصال، که بعد از بارگذاری اولیه در warm_up برقرار
+    می‌شود) ممکن است اعلان‌هایی از دست رفته باشند؛ بنابراین همه پروژه‌ها دوباره خوانده می‌شوند.
+    """
+
+    def __init__(self, channel, poll_interval=1.0, retry_delay=5.0):
+        self.channel = channel
+        self.poll_interval = poll_interval
+        self.retry_delay = retry_delay
+        self.loop = None
+        self._closed = threading.Event()
+        self._thread = None
+        self.received = 0
+        self.ignored_own = 0
+        self.refreshes = 0
+        self.resyncs = 0
+        self.reconnects = 0
+
+    def start(self, loop):
+        """شروع نخ listener؛ بدون دیتابیس کاری انجام نمی‌دهد."""
+        if not DB_CONN_KWARGS or self._thread is not None:
+            return
+        self.loop = loop
+        self._closed.clear()
+        self._thread = threading.Thread(target=self._run, name="db-listen",
+                                        daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._closed.set()
+        if self._thread is not None:
+            self._thread.join(self.poll_interval + 1)
+            self._thread = None
+
+    def _connect(self):
+        conn = psycopg2.connect(**DB_CONN_KWARGS)
+        conn.autocommit = True
+        conn.cursor().execute(
+            psycopg2.sql.SQL("LISTEN {};").format(psycopg2.sql.Identifier(self.channel)))
+        return conn
+
+    def _run(self):
+        connected_before = False
+        while not self._closed.is_set():
+            conn = None
+            try:
+                conn = self._connect()
+                if connected_before:
+                    self.reconnects += 1
+                # LISTEN فعال است؛ تغییرات از زمان بارگذاری قبلی تا این لحظه با یک resync پوشش داده می‌شوند.
+                self.loop.call_soon_threadsafe(STATE_PERSISTENCE.invalidate_all)
+                self._schedule(resync_projects())
+                self.resyncs += 1
+                connected_before = True
+                logger.info(f"✅ گوش دادن به تغییرات پروژه‌ها روی کانال '{self.channel}' شروع شد.")
+                while not self._closed.is_set():
+                    if select.select([conn], [], [], self.poll_interval)[0]:
+                        conn.poll()
+                        self._dispatch(conn.notifies)
+                        conn.notifies.clear()
+            except Exception as e:
+                logger.error(f"❌ خطای اتصال LISTEN تغییرات پروژه‌ها: {e}")
+                self._closed.wait(self.retry_delay)
+            finally:
+                if conn is not None:
+                    conn.close()
+
+    def _dispatch(self, notifies):
+        """ادغام اعلان‌های یک دور poll و زمان‌بندی یک بار به‌روزرسانی برای هر پروژه."""
+        project_ids = set()
+        for notify in notifies:
+            self.received += 1
+            try:
+                payload = json.loads(notify.payload)
+            except ValueError:
+                logger.warning(f"⚠️ اعلان نامعتبر روی کانال '{self.channel}': {notify.payload}")
+                continue
+            if payload.get('origin') == WORKER_ID:
+                self.ignored_own += 1
+                continue
+            if payload.get('op') in STATE_KINDS:
+                self.loop.call_soon_threadsafe(STATE_PERSISTENCE.invalidate,
+                                               payload['op'], payload['id'])
+                continue
+            if payload.get('op') == 'archive':
+                self.loop.call_soon_threadsafe(note_archived, str(payload['project_id']),
+                                               payload.get('archived', 0))
+            project_ids.add(str(payload['project_id']))
+        for project_id in project_ids:
+            self.refreshes += 1
+            self._schedule(refresh_project(project_id))
+
+    def _schedule(self, coro):
+        asyncio.run_coroutine_threadsafe(coro, self.loop)
+
+    def stats(self):
+        """وضعیت هماهنگی کش برای مسیر /stats."""
+        return {
+            'worker_id': WORKER_ID,
+            'listening': self._thread is not None,
+            'received': self.received,
+            'ignored_own': self.ignored_own,
+            'refreshes': self.refreshes,
+            'resyncs': self.resyncs,
+            'reconnects': self.reconnects
+        }
+
+
+PROJECT_LISTENER = ProjectChangeListener(DB_NOTIFY_CHANNEL)
+# سطرهای ادغام‌شده با نسخه دیتابیس در حافظه جایگزین می‌شوند.
+WRITE_QUEUE.on_conflict = schedule_project_refresh
+
+
+# --------------------------------------------------------------------------------------------------
+# ۱.۵.۲. حالت گفتگوها (user_data/chat_data) مشترک بین workerها
+# --------------------------------------------------------------------------------------------------
+
+
+class DatabaseStatePersistence(BasePersistence):
+    """Persistence تلگرام برای user_data و chat_data در جدول conversation_state.
+
+    داده‌ها در حافظه Application می‌مانند و خواندن حالت هیچ کوئری‌ای ندارد. هر
+    STATE_UPDATE_INTERVAL ثانیه حالت‌های تغییرکرده از طریق WRITE_QUEUE دسته‌ای نوشته
+    می‌شوند و با NOTIFY به workerهای دیگر اعلام می‌شوند؛ آن‌ها فقط همان کاربر را
+    کهنه علامت می‌زنند و پیش از پردازش آپدیت بعدی‌اش دوباره از دیتابیس می‌خوانند.
+    """
+
+    def __init__(self, update_interval=STATE_UPDATE_INTERVAL):
+        super().__init__(
+            store_data=PersistenceInput(bot_data=False, chat_data=True,
+                                        user_data=True, callback_data=False),
+            update_interval=update_interval)
+        self._written = {}  # (kind، id) -> آخرین JSON نوشته/خوانده‌شده (برای نادیده گرفتن ذخیره بی‌تغییر)
+        self._stale = set()  # کلیدهایی که worker دیگری تغییر داده است
+        self._all_stale = False  # پس از قطع LISTEN: همه کلیدها یک بار دوباره خوانده می‌شوند
+        self._checked = set()
+        self.hits = 0
+        self.reloads = 0
+        self.writes = 0
+        self.unchanged = 0
+
+    def invalidate(self, kind, state_id):
+        """علامت زدن حالت یک کاربر/چت به عنوان کهنه (از اعلان worker دیگر)."""
+        self._stale.add((kind, int(state_id)))
+
+    def invalidate_all(self):
+        self._all_stale = True
+        self._checked.clear()
+
+    async def _load(self, kind):
+        try:
+            rows = await run_in_db_executor(DB_EXECUTORS[0], fetch_state_from_db, kind)
+        except Exception as e:
+            logger.error(f"❌ خطای بارگذاری {kind} از دیتابیس: {e}")
+            return {}
+        for state_id, data in rows.items():
+            self._written[(kind, state_id)] = data
+        return {state_id: json.loads(data) for state_id, data in rows.items()}
+
+    def _write(self, kind, state_id, data):
+        if not DB_POOL:
+            return  # اتصال دیتابیس برقرار نشد؛ حالت فقط در حافظه همین worker می‌ماند.
+        key = (kind, int(state_id))
+        try:
+            payload = json.dumps(data)
+        except (TypeError, ValueError) as e:
+            logger.error(f"❌ {kind} شناسه {state_id} قابل ذخیره در دیتابیس نیست: {e}")
+            return
+        if self._written.get(key, '{}') == payload:
+            self.unchanged += 1
+            return
+        self._written[key] = payload
+        self.writes += 1
+        WRITE_QUEUE.mark_dirty(key, (kind, int(state_id), payload))
+
+    async def _refresh(self, kind, state_id, data):
+        key = (kind, int(state_id))
+        if key not in self._stale and (not self._all_stale or key in self._checked):
+            self.hits += 1
+            return
+        self._stale.discard(key)
+        if self._all_stale:
+            self._checked.add(key)
+        # نسخه worker دیگر جدیدتر است؛ snapshot قدیمی این worker نوشته نمی‌شود.
+        WRITE_QUEUE.discard([key])
+        try:
+            rows = await run_in_db_executor(DB_EXECUTORS[0], fetch_state_from_db,
+                                            kind, state_id)
+        except Exception as e:
+            logger.error(f"❌ خطای خواندن دوباره {kind} شناسه {state_id} از دیتابیس: {e}")
+            return
+        self.reloads += 1
+        data.clear()
+        if int(state_id) in rows:
+            self._written[key] = rows[int(state_id)]
+            data.update(json.loads(rows[int(state_id)]))
+        else:
+            self._written.pop(key, None)
+
+    async def _drop(self, kind, state_id):
+        key = (kind, int(state_id))
+        WRITE_QUEUE.discard([key])
+        self._written.pop(key, None)
+        await run_in_db_executor(DB_EXECUTORS[0], delete_state_from_db, kind, state_id)
+
+    async def get_user_data(self):
+        return await self._load('user_data')
+
+    async def get_chat_data(self):
+        return await self._load('chat_data')
+
+    async def get_bot_data(self):
+        return {}
+
+    async def get_callback_data(self):
+        return None
+
+    async def get_conversations(self, name):
+        return {}
+
+    async def update_conversation(self, name, key, new_state):
+        pass
+
+    async def update_user_data(self, user_id, data):
+        self._write('user_data', user_id, data)
+
+    async def update_chat_data(self, chat_id, data):
+        self._write('chat_data', chat_id, data)
+
+    async def update_bot_data(self, data):
+        pass
+
+    async def update_callback_data(self, data):
+        pass
+
+    async def drop_user_data(self, user_id):
+        await self._drop('user_data', user_id)
+
+    async def drop_chat_data(self, chat_id):
+        await self._drop('chat_data', chat_id)
+
+    async def refresh_user_data(self, user_id, user_data):
+        await self._refresh('user_data', user_id, user_data)
+
+    async def refresh_chat_data(self, chat_id, chat_data):
+        await self._refresh('chat_data', chat_id, chat_data)
+
+    async def refresh_bot_data(self, bot_data):
+        pass
+
+    async def flush(self):
+        """هنگام توقف Application: نوشتن همه سطرهای کثیف."""
+        await flush_pending_writes()
+
+    def stats(self):
+        """وضعیت کش حالت گفتگوها برای مسیر /stats."""
+        return {
+            'cached': len(self._written),
+            'hits': self.hits,
+            'reloads': self.reloads,
+            'writes': self.writes,
+            'unchanged': self.unchanged,
+            'stale': len(self._stale)
+        }
+
+
+STATE_PERSISTENCE = DatabaseStatePersistence()
+
+
+# --------------------------------------------------------------------------------------------------
+# ۱.۵.۳. صندوق خروجی اطلاعیه‌ها (outbox) و ارسال پس‌زمینه آن
+# --------------------------------------------------------------------------------------------------
+
+
+def outbox_enabled():
+    """اطلاعیه‌ها فقط وقتی در outbox نوشته می‌شوند که ارسال‌کننده آن روی همین worker در حال اجراست.
+
+    outbox فقط روی PostgreSQL راه‌اندازی می‌شود؛ بدون دیتابیس، با SQLite یا پیش از راه‌اندازی
+    Application (و پس از توقف آن) اطلاعیه‌ها مستقیم ارسال می‌شوند تا در جدول معطل نمانند.
+    """
+    return OUTBOX_DISPATCHER.running
+
+
+def claim_outbox_batch(limit, lease_seconds):
+    """claim تا limit اطلاعیه ارسال‌نشده برای این worker؛ خروجی [(id، JSON پیام، تعداد تلاش)].
+
+    سطرهایی که worker دیگری همزمان قفل کرده با SKIP LOCKED رد می‌شوند و سطرهای claim‌شده
+    تا پایان مهلت (claimed_until) به هیچ worker دیگری داده نمی‌شوند.
+    """
+    conn = get_db_conn()
+    if not conn:
+        return []
+    try:
+        cur = conn.cursor()
+        cur.execute("""
+            UPDATE outbox AS o
+            SET claimed_until = now() + make_interval(secs => %s),
+                attempts = o.attempts + 1
+            FROM (
+                SELECT id FROM outbox
+                WHERE delivered_at IS NULL AND failed_at IS NULL
+                  AND (claimed_until IS NULL OR claimed_until < now())
+                ORDER BY priority, id
+                LIMIT %s
+                FOR UPDATE SKIP LOCKED
+            ) AS batch
+            WHERE o.id = batch.id
+            RETURNING o.id, o.payload::text, o.attempts;
+        """, (lease_seconds, limit))
+        rows = cur.fetchall()
+        conn.commit()
+        return rows
+    except Exception as e:
+        logger.error(f"❌ خطای claim اطلاعیه‌های outbox: {e}")
+        conn.rollback()
+        return []
+    finally:
+        release_db_conn(conn)
+
+
+def complete_outbox_batch(delivered, retry, failed):
+    """ثبت نتیجه ارسال یک دسته: شناسه‌های delivered و لیست‌های (id، خطا) برای retry و failed.
+
+    سطرهای retry با تاخیر نمایی (حداکثر ۵ دقیقه) دوباره قابل claim می‌شوند.
+    """
+    conn = get_db_conn()
+    if not conn:
+        return False
+    try:
+        cur = conn.cursor()
+        if delivered:
+            cur.execute("""
+                UPDATE outbox SET delivered_at = now(), claimed_until = NULL
+                WHERE id = ANY(%s);
+            """, (list(delivered),))
+        if retry:
+            psycopg2.extras.execute_values(cur, """
+                UPDATE outbox AS o
+                SET claimed_until = now() + make_interval(secs => LEAST(300, 5 * power(2, o.attempts))),
+                    last_error = v.error
+                FROM (VALUES %s) AS v (id, error)
+                WHERE o.id = v.id;
+            """, retry)
+        if failed:
+            psycopg2.extras.execute_values(cur, """
+                UPDATE outbox AS o
+                SET failed_at = now(), claimed_until = NULL, last_error = v.error
+                FROM (VALUES %s) AS v (id, error)
+                WHERE o.id = v.id;
+            """, failed)
+        conn.commit()
+        return True
+    except Exception as e:
+        logger.error(f"❌ خطای ثبت نتیجه ارسال اطلاعیه‌های outbox: {e}")
+        conn.rollback()
+        return False
+    finally:
+        release_db_conn(conn)
+
+
+def prune_outbox(retention_hours):
+    """حذف اطلاعیه‌های تحویل‌شده یا ناموفق قدیمی‌تر از retention_hours ساعت."""
+    conn = get_db_conn()
+    if not conn:
+        return
+    try:
+        cur = conn.cursor()
+        cur.execute("""
+            DELETE FROM outbox
+            WHERE COALESCE(delivered_at, failed_at) < now() - make_interval(hours => %s);
+        """, (retention_hours,))
+        conn.commit()
+        if cur.rowcount:
+            logger.info(f"🧹 {cur.rowcount} اطلاعیه قدیمی از outbox حذف شد.")
+    except Exception as e:
+        logger.error(f"❌ خطای پاک‌سازی outbox: {e}")
+        conn.rollback()
+    finally:
+        release_db_conn(conn)
+
+
+class OutboxDispatcher:
+    """ارسال پس‌زمینه اطلاعیه‌های جدول outbox روی حلقه ربات.
+
+    هر دور تا batch_size سطر claim، همزمان ارسال و سپس delivered علامت می‌خورد؛ چند
+    worker سطرهای متفاوتی برمی‌دارند. اگر worker بعد از ارسال و پیش از ثبت نتیجه از کار
+    بیفتد، سطر پس از پایان مهلت claim دوباره ارسال می‌شود (حداقل یک بار). خطاهای موقت
+    (شبکه، RetryAfter) دوباره تلاش می‌شوند؛ BadRequest/Forbidden یا رسیدن به max_attempts
+    سطر را failed می‌کند.
+    """
+
+    def __init__(self, batch_size, poll_interval, lease_seconds, max_attempts,
+                 retention_hours):
+        self.batch_size = batch_size
+        self.poll_interval = poll_interval
+        self.lease_seconds = lease_seconds
+        self.max_attempts = max_attempts
+        self.retention_hours = retention_hours
+        self.bot = None
+        self.loop = None
+        self._task = None
+        self._wakeup = None
+        self._last_prune = 0.0
+        self.batches = 0
+        self.delivered = 0
+        self.retried = 0
+        self.failed = 0
+
+    @property
+    def running(self):
+        return self._task is not None and not self._task.done()
+
+    def start(self, bot):
+        """شروع ارسال پس‌زمینه روی حلقه فعلی؛ بدون PostgreSQL کاری نمی‌کند.
+
+        دور اول بلافاصله اجرا می‌شود، پس سطرهای باقی‌مانده از workerی که از کار افتاده
+        همان هنگام راه‌اندازی (و نه با اولین ترافیک) ارسال می‌شوند.
+        """
+        if (not OUTBOX_ENABLED or DB_POOL is None or not STORAGE.multi_worker
+                or self._task is not None):
+            return
+        self.bot = bot
+        self.loop = asyncio.get_running_loop()
+        self._wakeup = asyncio.Event()
+        self._task = self.loop.create_task(self._run())
+
+    async def stop(self):
+        """سطرهای ارسال‌نشده در جدول می‌مانند و بعداً (یا توسط worker دیگر) ارسال می‌شوند."""
+        if self._task is None:
+            return
+        self._task.cancel()
+        with contextlib.suppress(asyncio.CancelledError):
+            await self._task
+        self._task = None
+
+    def wake(self):
+        """بیدار کردن ارسال‌کننده پس از commit سطرهای جدید (از هر نخی قابل صدا زدن است)."""
+        loop = self.loop
+        if self._task is None or loop is None or loop.is_closed():
+            return
+        loop.call_soon_threadsafe(self._wakeup.set)
+
+    async def _run(self):
+        while True:
+            self._wakeup.clear()
+            try:
+                claimed = await self.dispatch_once()
+            except Exception as e:
+                logger.error(f"❌ خطای ارسال اطلاعیه‌های outbox: {e}")
+                claimed = 0
+            if claimed >= self.batch_size:
+                continue  # احتمالاً سطرهای بیشتری منتظرند.
+            with contextlib.suppress(asyncio.TimeoutError):
+                await asyncio.wait_for(self._wakeup.wait(), self.poll_interval)
+
+    async def dispatch_once(self):
+        """claim، ارسال و ثبت نتیجه یک دسته؛ خروجی تعداد سطرهای claim‌شده."""
+        if time.monotonic() - self._last_prune > 3600:
+            self._last_prune = time.monotonic()
+            await run_in_db_executor(DB_EXECUTORS[0], prune_outbox, self.retention_hours)
+
+        rows = await run_in_db_executor(DB_EXECUTORS[0], claim_outbox_batch,
+                                        self.batch_size, self.lease_seconds)
+        if not rows:
+            return 0
+        results = await asyncio.gather(*(self._deliver(*row) for row in rows))
+        delivered = [outbox_id for outbox_id, outcome, _ in results if outcome == 'delivered']
+        retry = [(outbox_id, error) for outbox_id, outcome, error in results if outcome == 'retry']
+        failed = [(outbox_id, error) for outbox_id, outcome, error in results if outcome == 'failed']
+        await run_in_db_executor(DB_EXECUTORS[0], complete_outbox_batch,
+                                 delivered, retry, failed)
+        self.batches += 1
+        self.delivered += len(delivered)
+        self.retried += len(retry)
+        self.failed += len(failed)
+        return len(rows)
+
+    async def _deliver(self, outbox_id, payload, attempts):
+        message = json.loads(payload)
+        async with NOTIFY_FANOUT_SLOTS:
+            try:
+                await deliver_message(self.bot, message)
+            except (BadRequest, Forbidden) as e:
+                logger.warning(f"⚠️ اطلاعیه {outbox_id} به چت {message['chat_id']} ارسال نشد: {e}")
+                return outbox_id, 'failed', str(e)
+            except Exception as e:
+                if attempts >= self.max_attempts:
+                    logger.error(
+                        f"❌ اطلاعیه {outbox_id} به چت {message['chat_id']} بعد از {attempts} تلاش رها شد: {e}")
+                    return outbox_id, 'failed', str(e)
+                return outbox_id, 'retry', str(e)
+        return outbox_id, 'delivered', None
+
+    def stats(self):
+        """وضعیت ارسال outbox برای مسیر /stats."""
+        return {
+            'running': self.running,
+            'batches': self.batches,
+            'delivered': self.delivered,
+            'retried': self.retried,
+            'failed': self.failed
+        }
+
+
+OUTBOX_DISPATCHER = OutboxDispatcher(OUTBOX_BATCH_SIZE, OUTBOX_POLL_INTERVAL,
+                                     OUTBOX_LEASE_SECONDS, OUTBOX_MAX_ATTEMPTS,
+                                     OUTBOX_RETENTION_HOURS)
+WRITE_QUEUE.on_outbox = OUTBOX_DISPATCHER.wake
+
+
+# --------------------------------------------------------------------------------------------------
+# ۱.۵.۴. کش پروژه‌ها (بارگذاری در اولین دسترسی و حذف LRU)
+# --------------------------------------------------------------------------------------------------
+
+
+class ProjectNotLoaded(LookupError):
+    """دسترسی همگام به پروژه سرد؛ محتواهای آن باید با await load_project(project_id) خوانده شوند."""
+
+
+class ProjectCache(MutableMapping):
+    """کش read-through پروژه‌ها با حذف LRU (جایگزین دیکشنری ساده PROJECT_DATA).
+
+    اطلاعات پایه همه پروژه‌ها (نام، وضعیت، ادیتور و کارفرما) همیشه در حافظه است و
+    ایندکس نقش‌ها و شمارنده‌های وضعیت برای همه کامل می‌مانند؛ اما لیست submissions فقط
+    برای پروژه‌های «گرم» نگه داشته می‌شود و در اولین دسترسی از دیتابیس خوانده می‌شود.
+    وقتی تعداد پروژه‌های گرم از max_projects یا حجم تخمینی آن‌ها (طول JSON سطرها) از
+    max_bytes بیشتر شود، کم‌استفاده‌ترین پروژه‌ها سرد می‌شوند؛ مگر قفل پروژه گرفته شده
+    باشد، سطر ذخیره‌نشده (یا اطلاعیه outbox) در WRITE_QUEUE داشته باشد یا در حال
+    بارگذاری باشد. بدون دیتابیس هیچ پروژه‌ای سرد نمی‌شود.
+
+    هندلرها پیش از دسترسی به محتواها await load_project(project_id) را صدا می‌زنند و
+    برای نام و نقش‌ها از peek استفاده می‌کنند. دسترسی همگام ([]، get، items و values) هرگز
+    دیتابیس را روی حلقه نمی‌خواند: پروژه گرم برگردانده می‌شود و پروژه سرد ProjectNotLoaded
+    می‌دهد. in و len همه پروژه‌ها (گرم و سرد) را در نظر می‌گیرند.
+    """
+
+    def __init__(self, max_projects, max_bytes):
+        self.max_projects = max_projects
+        self.max_bytes = max_bytes
+        # project_id -> Project (submissions فقط برای پروژه‌های گرم، در بقیه None)
+        self._projects = {}
+        # project_id -> حجم تخمینی (بایت) پروژه‌های گرم، به ترتیب آخرین دسترسی
+        self._resident = OrderedDict()
+        self._bytes = 0
+        self._loading = {}  # project_id -> Future بارگذاری در جریان (درخواست‌های همزمان منتظر همان می‌مانند)
+        self.hits = 0
+        self.misses = 0
+        self.load_errors = 0
+        self.evictions = 0
+        self.pinned_skips = 0  # دفعاتی که پروژه کم‌استفاده به خاطر کار در جریان سرد نشد
+        self._load_times = deque(maxlen=1024)
+
+    # --- رابط دیکشنری (شامل پروژه‌های سرد) ---
+
+    def __contains__(self, project_id):
+        return project_id in self._projects
+
+    def __iter__(self):
+        return iter(self._projects)
+
+    def __len__(self):
+        return len(self._projects)
+
+    def __getitem__(self, project_id):
+        project_data = self._projects[project_id]
+        if project_id not in self._resident:
+            raise ProjectNotLoaded(project_id)
+        self.hits += 1
+        self._resident.move_to_end(project_id)
+        return project_data
+
+    def __setitem__(self, project_id, project_data):
+        self.store(project_id, project_data)
+
+    def __delitem__(self, project_id):
+        del self._projects[project_id]
+        self._bytes -= self._resident.pop(project_id, 0)
+
+    def pop(self, project_id, *default):
+        """حذف پروژه بدون بارگذاری محتواهای آن."""
+        if project_id not in self._projects:
+            if default:
+                return default[0]
+            raise KeyError(project_id)
+        project_data = self._projects[project_id]
+        del self[project_id]
+        return project_data
+
+    def clear(self):
+        self.reset({})
+
+    # --- کش ---
+
+    def reset(self, projects):
+        """جایگزینی همه پروژه‌ها با اطلاعات پایه (بدون submissions)؛ همه پروژه‌ها سرد می‌شوند."""
+        self._projects = dict(projects)
+        self._resident.clear()
+        self._bytes = 0
+
+    def peek(self, project_id):
+        """اطلاعات پایه پروژه بدون بارگذاری محتواها و بدون اثر روی ترتیب LRU (None اگر وجود نداشته باشد)."""
+        return self._projects.get(project_id)
+
+    def catalog_items(self):
+        """(project_id، Project) همه پروژه‌ها، گرم یا سرد، بدون بارگذاری."""
+        return self._projects.items()
+
+    def is_resident(self, project_id):
+        return project_id in self._resident
+
+    def store(self, project_id, project_data, nbytes=None):
+        """افزودن یا جایگزینی یک پروژه؛ با لیست submissions، پروژه گرم ثبت می‌شود."""
+        self._projects[project_id] = project_data
+        if project_data.submissions is None:
+            self._bytes -= self._resident.pop(project_id, 0)
+            return
+        if nbytes is None:
+            nbytes = len(project_data.to_json())
+        self._admit(project_id, nbytes)
+
+    def grow(self, project_id, submission):
+        """افزودن حجم تخمینی یک محتوای جدید به پروژه گرم."""
+        if project_id in self._resident:
+            nbytes = len(submission.to_json())
+            self._resident[project_id] += nbytes
+            self._bytes += nbytes
+            self._enforce_budget(keep=project_id)
+
+    def evict(self, project_id):
+        """سرد کردن یک پروژه (بدون بررسی کار در جریان؛ فراخواننده مسئول آن است)."""
+        nbytes = self._resident.pop(project_id, None)
+        if nbytes is None:
+            return False
+        self._bytes -= nbytes
+        release_submissions(project_id, self._projects[project_id])
+        return True
+
+    async def load(self, project_id):
+        """read-through: پروژه همراه با محتواها، یا None اگر وجود نداشته باشد یا خواندن ناموفق باشد."""
+        project_data = self._projects.get(project_id)
+        if project_data is None:
+            return None
+        if project_id in self._resident:
+            self.hits += 1
+            self._resident.move_to_end(project_id)
+            return project_data
+        future = self._loading.get(project_id)
+        if future is None:
+            self.misses += 1
+            future = self._loading[project_id] = asyncio.ensure_future(self._fetch(project_id))
+        # لغو شدن یک هندلر، بارگذاری مشترک بقیه منتظرها را لغو نمی‌کند.
+        if not await asyncio.shield(future):
+            return None
+        return self._projects.get(project_id)
+
+    async def _fetch(self, project_id):
+        started = time.perf_counter()
+        try:
+            fresh_data, versions = await run_in_db_executor(
+                _db_executor_for(project_id), fetch_project_from_db, project_id)
+            self._load_times.append(time.perf_counter() - started)
+            # ممکن است در این فاصله پروژه حذف یا با refresh_project گرم شده باشد.
+            if project_id in self._projects and project_id not in self._resident:
+                self._attach(project_id, fresh_data, versions)
+            return True
+        except Exception as e:
+            self.load_errors += 1
+            logger.error(f"❌ خطای بارگذاری محتواهای پروژه P{project_id} از دیتابیس: {e}")
+            return False
+        finally:
+            self._loading.pop(project_id, None)
+
+    def _attach(self, project_id, fresh_data, versions):
+        """گرم کردن پروژه سرد با محتواهای خوانده‌شده از دیتابیس.
+
+        اطلاعات پایه حافظه (که با اعلان‌های LISTEN به‌روز می‌ماند و ممکن است تغییر
+        ذخیره‌نشده داشته باشد) دست نمی‌خورد؛ فقط submissions اضافه می‌شوند.
+        """
+        if fresh_data is None:
+            # پروژه در دیتابیس حذف شده است.
+            apply_project_refresh(project_id, None)
+            return
+        project_data = self._projects[project_id]
+        attach_submissions(project_id, project_data, fresh_data.submissions)
+        WRITE_QUEUE.update_versions({
+            key: version for key, version in versions.items() if key[0] == 'submission'
+        })
+        self._admit(project_id, sum(len(data) for _, data in versions.values()))
+
+    def _admit(self, project_id, nbytes):
+        self._bytes += nbytes - self._resident.get(project_id, 0)
+        self._resident[project_id] = nbytes
+        self._resident.move_to_end(project_id)
+        self._enforce_budget(keep=project_id)
+
+    def _over_budget(self):
+        return bool((self.max_projects and len(self._resident) > self.max_projects) or
+                    (self.max_bytes and self._bytes > self.max_bytes))
+
+    def _enforce_budget(self, keep=None):
+        """سرد کردن کم‌استفاده‌ترین پروژه‌هایی که کار در جریان ندارند تا رسیدن به سقف."""
+        if not DB_POOL or not self._over_budget():
+            return
+        dirty = WRITE_QUEUE.pending_projects()
+        for project_id in list(self._resident):
+            if not self._over_budget():
+                break
+            if (project_id == keep or project_id in dirty or project_id in self._loading
+                    or PROJECT_LOCKS.is_held(project_id)):
+                self.pinned_skips += 1
+                continue
+            self.evict(project_id)
+            self.evictions += 1
+
+    def stats(self):
+        """آمار کش برای مسیر /stats (برای تعیین اندازه مناسب سقف‌ها)."""
+        lookups = self.hits + self.misses
+        return {
+            'projects': len(self._projects),
+            'resident': len(self._resident),
+            'resident_mb': round(self._bytes / (1024 * 1024), 2),
+            'max_projects': self.max_projects,
+            'max_mb': round(self.max_bytes / (1024 * 1024), 2),
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_ratio': round(self.hits / lookups, 4) if lookups else None,
+            'evictions': self.evictions,
+            'pinned_skips': self.pinned_skips,
+            'load_errors': self.load_errors,
+            'load': _latency_summary(list(self._load_times))
+        }
+
+
+PROJECT_DATA = ProjectCache(PROJECT_CACHE_MAX_PROJECTS,
+                            int(PROJECT_CACHE_MAX_MB * 1024 * 1024))
+
+
+async def load_project(project_id):
+    """پروژه همراه با محتواهایش (در صورت نیاز خوانده‌شده از دیتابیس)؛ None اگر یافت نشود."""
+    return await PROJECT_DATA.load(project_id)
+
+
+# --------------------------------------------------------------------------------------------------
+# ۱.۵.۵. آرشیو محتواهای نهایی‌شده (انتقال از حافظه و جدول submissions به submission_archive)
+# --------------------------------------------------------------------------------------------------
+
+
+def find_archive_candidates(keep, cutoff, limit):
+    """شناسه پروژه‌هایی که محتوای نهایی‌شده قابل آرشیو دارند (بیش از keep یا قدیمی‌تر از cutoff)."""
+    conn = get_db_conn()
+    if not conn:
+        return []
+    try:
+        cur = conn.cursor()
+        cur.execute("""
+            SELECT project_id FROM (
+                SELECT project_id,
+                       row_number() OVER (PARTITION BY project_id ORDER BY position DESC) AS rank,
+                       COALESCE((data->>'finalized_at')::float8, 0) AS finalized_at
+                FROM submissions WHERE status = 'ManagerApproved'
+            ) AS finalized
+            WHERE rank > %s OR finalized_at < %s
+            GROUP BY project_id
+            LIMIT %s;
+        """, (keep, cutoff, limit))
+        return [str(row[0]) for row in cur.fetchall()]
+    finally:
+        conn.rollback()
+        release_db_conn(conn)
+
+
+def archive_project_submissions(project_id, keep, cutoff):
+    """انتقال محتواهای نهایی‌شده قدیمی یک پروژه به submission_archive در یک تراکنش.
+
+    آخرین keep محتوای نهایی‌شده می‌مانند مگر finalized_at آن‌ها پیش از cutoff (epoch)
+    باشد؛ محتواهای قدیمی بدون finalized_at قدیمی حساب می‌شوند. جایگاه (position)
+    محتواهای باقی‌مانده از صفر شماره‌گذاری می‌شود تا با لیست حافظه یکی بماند و
+    workerهای دیگر با اعلان 'archive' پروژه را دوباره می‌خوانند. خروجی شناسه
+    محتواهای آرشیوشده (در صورت خطا لیست خالی).
+    """
+    # سطرهای کثیف همین پروژه اول نوشته می‌شوند تا آرشیو آخرین نسخه آن‌ها را داشته باشد.
+    WRITE_QUEUE.flush(WRITE_QUEUE.pending_keys(project_id))
+    conn = get_db_conn()
+    if not conn:
+        return []
+    try:
+        cur = conn.cursor()
+        cur.execute("""
+            SELECT submission_id, data::text FROM submissions
+            WHERE project_id = %s AND status = 'ManagerApproved'
+            ORDER BY position DESC
+            FOR UPDATE;
+        """, (int(project_id),))
+        rows = []
+        for rank, (submission_id, data) in enumerate(cur.fetchall()):
+            finalized_at = json.loads(data).get('finalized_at')
+            if rank >= keep or (finalized_at or 0) < cutoff:
+                rows.append((submission_id, int(project_id), finalized_at,
+                             psycopg2.Binary(zlib.compress(data.encode()))))
+        if not rows:
+            conn.rollback()
+            return []
+
+        psycopg2.extras.execute_values(cur, """
+            INSERT INTO submission_archive (submission_id, project_id, finalized_at, data)
+            VALUES %s
+            ON CONFLICT (submission_id) DO NOTHING;
+        """, rows, template="(%s, %s, to_timestamp(%s::float8), %s)")
+        archived = [row[0] for row in rows]
+        cur.execute("DELETE FROM submissions WHERE submission_id = ANY(%s);", (archived, ))
+        cur.execute("""
+            UPDATE submissions AS s SET position = r.new_position
+            FROM (
+                SELECT submission_id, (row_number() OVER (ORDER BY position) - 1)::INT AS new_position
+                FROM submissions WHERE project_id = %s
+            ) AS r
+            WHERE s.submission_id = r.submission_id AND s.position <> r.new_position;
+        """, (int(project_id),))
+        cur.execute("SELECT pg_notify(%s, %s);", (DB_NOTIFY_CHANNEL, json.dumps({
+            'origin': WORKER_ID, 'op': 'archive', 'project_id': int(project_id),
+            'archived': len(archived)
+        })))
+        conn.commit()
+        logger.info(f"📦 {len(archived)} محتوای نهایی‌شده پروژه P{project_id} به آرشیو منتقل شد.")
+        return archived
+    except Exception as e:
+        logger.error(f"❌ خطای آرشیو محتواهای پروژه P{project_id}: {e}")
+        conn.rollback()
+        return []
+    finally:
+        release_db_conn(conn)
+
+
+def fetch_archived_submissions(project_id, offset, limit):
+    """خواندن یک صفحه از محتواهای آرشیوشده پروژه (جدیدترین نهایی‌شده‌ها اول)."""
+    conn = get_db_conn()
+    if not conn:
+        raise RuntimeError("اتصال دیتابیس غیرفعال است")
+    try:
+        cur = conn.cursor()
+        cur.execute("""
+            SELECT data FROM submission_archive
+            WHERE project_id = %s
+            ORDER BY finalized_at DESC NULLS LAST, submission_id
+            OFFSET %s LIMIT %s;
+        """, (int(project_id), offset, limit))
+        return [Submission.from_json(zlib.decompress(bytes(row[0]))) for row in cur.fetchall()]
+    finally:
+        conn.rollback()
+        release_db_conn(conn)
+
+
+class SubmissionArchiver:
+    """آرشیو دوره‌ای محتواهای نهایی‌شده روی حلقه ربات.
+
+    هر interval ثانیه پروژه‌های دارای محتوای قابل آرشیو از دیتابیس پیدا می‌شوند و هر
+    پروژه زیر قفل خودش آرشیو می‌شود تا هندلرها بین نوشتن دیتابیس و حذف از حافظه آن را
+    تغییر ندهند. اجرای همزمان در چند worker بی‌خطر است (سطرها با FOR UPDATE قفل می‌شوند).
+    """
+
+    def __init__(self, keep, after_hours, interval, batch_projects):
+        self.keep = keep
+        self.after_hours = after_hours
+        self.interval = interval
+        self.batch_projects = batch_projects
+        self._task = None
+        self.runs = 0
+        self.projects = 0
+        self.archived = 0
+
+    def start(self):
+        """شروع آرشیو پس‌زمینه روی حلقه فعلی؛ آرشیو فقط روی PostgreSQL انجام می‌شود."""
+        if not DB_POOL or not STORAGE.multi_worker or self._task is not None:
+            return
+        self._task = asyncio.get_running_loop().create_task(self._run())
+
+    async def stop(self):
+        if self._task is None:
+            return
+        self._task.cancel()
+        with contextlib.suppress(asyncio.CancelledError):
+            await self._task
+        self._task = None
+
+    async def _run(self):
+        while True:
+            try:
+                archived = await self.archive_once()
+            except Exception as e:
+                logger.error(f"❌ خطای آرشیو محتواهای نهایی‌شده: {e}")
+                archived = 0
+            if not archived:
+                await asyncio.sleep(self.interval)
+
+    async def archive_once(self):
+        """یک دور آرشیو (حداکثر batch_projects پروژه)؛ خروجی تعداد محتواهای آرشیوشده."""
+        cutoff = time.time() - self.after_hours * 3600
+        project_ids = await run_in_db_executor(DB_EXECUTORS[0], find_archive_candidates,
+                                               self.keep, cutoff, self.batch_projects)
+        archived_total = 0
+        for project_id in project_ids:
+            async with PROJECT_LOCKS.hold(project_id):
+                archived = await run_in_db_executor(
+                    _db_executor_for(project_id), archive_project_submissions,
+                    project_id, self.keep, cutoff)
+                if archived:
+                    drop_archived_submissions(project_id, archived)
+            archived_total += len(archived)
+            self.projects += bool(archived)
+        self.runs += 1
+        self.archived += archived_total
+        return archived_total
+
+    def stats(self):
+        """وضعیت آرشیو برای مسیر /stats."""
+        return {
+            'running': self._task is not None,
+            'runs': self.runs,
+            'projects': self.projects,
+            'archived': self.archived,
+            'archived_in_catalog': sum(ARCHIVED_COUNTS.values())
+        }
+
+
+SUBMISSION_ARCHIVER = SubmissionArchiver(ARCHIVE_KEEP_FINALIZED, ARCHIVE_AFTER_HOURS,
+                                         ARCHIVE_INTERVAL, ARCHIVE_BATCH_PROJECTS)
+
+
+# --------------------------------------------------------------------------------------------------
+# ۱.۶. توابع کمکی (برای دسترسی و اعتبارسنجی)
+# --------------------------------------------------------------------------------------------------
+
+
+def get_project_and_validate(project_id):
+    """اعتبارسنجی وجود پروژه (فقط اطلاعات پایه؛ محتواهای پروژه سرد بارگذاری نمی‌شوند)."""
+    project_data = PROJECT_DATA.peek(project_id)
+    if project_data is None:
+        return None, f"❌ پروژه P{project_id} یافت نشد."
+    return project_data, None
+
+
+def is_manager(chat_id):
+    """بررسی اینکه آیا کاربر مدیر است یا خیر."""
+    return str(chat_id) == str(MANAGER_CHAT_ID)
+
+
+# --------------------------------------------------------------------------------------------------
+# ۱.۷. ایندکس‌های درون‌حافظه (تعیین نقش بدون پیمایش همه پروژه‌ها)
+# --------------------------------------------------------------------------------------------------
+
+ROLE_KEYS = {'editor_chat_id': 'editor_of', 'client_chat_id': 'client_of'}
+
+
+def _add_role(chat_id, role, project_id):
+    if chat_id:
+        entry = CHAT_ROLE_INDEX.setdefault(chat_id, {
+            'editor_of': set(),
+            'client_of': set()
+        })
+        if role == 'editor_of' and project_id not in entry[role]:
+            insort(EDITOR_PROJECT_IDS.setdefault(chat_id, []), int(project_id))
+        entry[role].add(project_id)
+
+
+def _remove_role(chat_id, role, project_id):
+    entry = CHAT_ROLE_INDEX.get(chat_id)
+    if entry:
+        if role == 'editor_of' and project_id in entry[role]:
+            editor_ids = EDITOR_PROJECT_IDS[chat_id]
+            del editor_ids[bisect_left(editor_ids, int(project_id))]
+            if not editor_ids:
+                del EDITOR_PROJECT_IDS[chat_id]
+        entry[role].discard(project_id)
+        if not entry['editor_of'] and not entry['client_of']:
+            del CHAT_ROLE_INDEX[chat_id]
+
+
+def _count_status(project_id, status, delta):
+    """اعمال تغییر delta روی شمارنده‌های پروژه و سراسری وضعیت status."""
+    counts = PROJECT_STATUS_COUNTS.setdefault(project_id, {})
+    counts[status] = counts.get(status, 0) + delta
+    GLOBAL_STATUS_COUNTS[status] = GLOBAL_STATUS_COUNTS.get(status, 0) + delta
+    projects = PROJECTS_BY_STATUS.setdefault(status, set())
+    if counts[status] > 0:
+        projects.add(project_id)
+    else:
+        del counts[status]
+        projects.discard(project_id)
+
+
+def _drop_status_counts(project_id):
+    """حذف همه شمارنده‌های وضعیت یک پروژه از شمارنده‌های سراسری."""
+    for status, count in PROJECT_STATUS_COUNTS.pop(project_id, {}).items():
+        GLOBAL_STATUS_COUNTS[status] = GLOBAL_STATUS_COUNTS.get(status, 0) - count
+        PROJECTS_BY_STATUS.setdefault(status, set()).discard(project_id)
+
+
+def set_submission_status(project_id, submission, new_status):
+    """تغییر وضعیت یک محتوا همراه با به‌روزرسانی شمارنده‌ها."""
+    old_status = submission.status
+    new_status = SubmissionStatus(new_status)
+    if old_status == new_status:
+        return
+    submission.status = new_status
+    if new_status == SubmissionStatus.MANAGER_APPROVED:
+        # زمان نهایی شدن مبنای آرشیو محتوا پس از ARCHIVE_AFTER_HOURS است.
+        submission.finalized_at = int(time.time())
+    _count_status(project_id, old_status, -1)
+    _count_status(project_id, new_status, +1)
+
+
+def project_status_counts(project_id):
+    """شمارش وضعیت محتواهای یک پروژه، با مقدار صفر برای وضعیت‌های بدون محتوا."""
+    counts = dict.fromkeys(SUBMISSION_STATUSES, 0)
+    counts.update(PROJECT_STATUS_COUNTS.get(project_id, {}))
+    return counts
+
+
+def index_submission(project_id, project_data, submission, position=None):
+    """افزودن یک محتوای ارسالی به ایندکس‌ها (پیش‌فرض: آخرین محتوای لیست پروژه)."""
+    if position is None:
+        position = len(project_data.submissions) - 1
+    SUBMISSION_INDEX[submission.submission_id] = (project_id, submission,
+                                                  position)
+    _count_status(project_id, submission.status, +1)
+
+    media_message_id = submission.media_message_id
+    if media_message_id is not None:
+        MEDIA_MESSAGE_INDEX[(project_data.client_chat_id,
+                             media_message_id)] = (project_id,
+                                                   submission.submission_id)
+
+
+def unindex_submission(project_id, project_data, submission):
+    """حذف یک محتوای ارسالی از ایندکس‌های دسترسی (شمارنده‌های وضعیت دست نمی‌خورند)."""
+    SUBMISSION_INDEX.pop(submission.submission_id, None)
+    MEDIA_MESSAGE_INDEX.pop(
+        (project_data.client_chat_id, submission.media_message_id), None)
+
+
+def index_project(project_id, project_data, status_counts=None):
+    """افزودن پروژه به ایندکس‌ها (هنگام ایجاد یا بارگذاری).
+
+    برای پروژه سرد (بدون submissions) شمارنده‌ها از status_counts ({وضعیت: تعداد}) ساخته می‌شوند.
+    """
+    position = bisect_left(SORTED_PROJECT_IDS, int(project_id))
+    if position == len(SORTED_PROJECT_IDS) or SORTED_PROJECT_IDS[position] != int(project_id):
+        SORTED_PROJECT_IDS.insert(position, int(project_id))
+    for chat_key, role in ROLE_KEYS.items():
+        _add_role(project_data.chat_id(chat_key), role, project_id)
+    for position, submission in enumerate(project_data.submissions or ()):
+        index_submission(project_id, project_data, submission, position)
+    for status, count in (status_counts or {}).items():
+        _count_status(project_id, status, count)
+
+
+def unindex_project(project_id, project_data):
+    """حذف پروژه (گرم یا سرد) از ایندکس‌ها (هنگام حذف یا پیش از جایگزینی با نسخه دیتابیس)."""
+    position = bisect_left(SORTED_PROJECT_IDS, int(project_id))
+    if position < len(SORTED_PROJECT_IDS) and SORTED_PROJECT_IDS[position] == int(project_id):
+        del SORTED_PROJECT_IDS[position]
+    for chat_key, role in ROLE_KEYS.items():
+        _remove_role(project_data.chat_id(chat_key), role, project_id)
+    for submission in project_data.submissions or ():
+        unindex_submission(project_id, project_data, submission)
+    _drop_status_counts(project_id)
+    WRITE_QUEUE.forget([('project', project_id)] + [
+        ('submission', submission.submission_id)
+        for submission in project_data.submissions or ()
+    ])
+
+
+def attach_submissions(project_id, project_data, submissions):
+    """گرم کردن پروژه سرد: افزودن محتواهای خوانده‌شده از دیتابیس به پروژه و ایندکس‌ها."""
+    # شمارنده‌های پروژه سرد از شمارش دیتابیس آمده بودند؛ حالا از خود محتواها ساخته می‌شوند.
+    _drop_status_counts(project_id)
+    project_data.submissions = submissions
+    for position, submission in enumerate(submissions):
+        index_submission(project_id, project_data, submission, position)
+
+
+def release_submissions(project_id, project_data):
+    """سرد کردن پروژه: حذف محتواها از حافظه و ایندکس‌ها (نقش‌ها و شمارنده‌های وضعیت می‌مانند)."""
+    submissions = project_data.submissions or []
+    project_data.submissions = None
+    for submission in submissions:
+        unindex_submission(project_id, project_data, submission)
+    WRITE_QUEUE.forget([('submission', submission.submission_id)
+                        for submission in submissions])
+
+
+def drop_archived_submissions(project_id, submission_ids):
+    """حذف محتواهای آرشیوشده از حافظه و شمارنده‌ها (پس از archive_project_submissions).
+
+    در پروژه گرم محتواها از لیست حذف و جایگاه بقیه در ایندکس به‌روز می‌شود؛ در پروژه
+    سرد فقط شمارنده ManagerApproved کم می‌شود.
+    """
+    project_data = PROJECT_DATA.peek(project_id)
+    if project_data is None:
+        return
+    archived = set(submission_ids)
+    submissions = project_data.submissions
+    if submissions is None:
+        _count_status(project_id, SubmissionStatus.MANAGER_APPROVED, -len(archived))
+    else:
+        removed = [s for s in submissions if s.submission_id in archived]
+        submissions[:] = [s for s in submissions if s.submission_id not in archived]
+        for submission in removed:
+            unindex_submission(project_id, project_data, submission)
+            _count_status(project_id, submission.status, -1)
+        for position, submission in enumerate(submissions):
+            SUBMISSION_INDEX[submission.submission_id] = (project_id, submission, position)
+        WRITE_QUEUE.forget([('submission', submission.submission_id)
+                            for submission in removed])
+        PROJECT_DATA.store(project_id, project_data)
+    ARCHIVED_COUNTS[project_id] = ARCHIVED_COUNTS.get(project_id, 0) + len(archived)
+
+
+def note_archived(project_id, count):
+    """ثبت آرشیو انجام‌شده در worker دیگر (شمارنده‌های وضعیت با بازخوانی پروژه درست می‌شوند)."""
+    ARCHIVED_COUNTS[project_id] = ARCHIVED_COUNTS.get(project_id, 0) + count
+
+
+def reindex_role(project_id, project_data, chat_key, old_chat_id):
+    """به‌روزرسانی ایندکس پس از تغییر ادیتور یا کارفرمای پروژه.
+
+    project_data باید مقدار جدید chat_key را داشته باشد.
+    """
+    role = ROLE_KEYS[chat_key]
+    _remove_role(old_chat_id, role, project_id)
+    _add_role(project_data.chat_id(chat_key), role, project_id)
+
+    if chat_key == 'client_chat_id':
+        # کلید ایندکس پیام‌ها به کارفرما وابسته است.
+        new_chat_id = project_data.client_chat_id
+        for submission in project_data.submissions or ():
+            media_message_id = submission.media_message_id
+            entry = MEDIA_MESSAGE_INDEX.pop((old_chat_id, media_message_id), None)
+            if entry is not None:
+                MEDIA_MESSAGE_INDEX[(new_chat_id, media_message_id)] = entry
+
+
+def rebuild_indexes(status_counts=None, archived_counts=None):
+    """ساخت دوباره همه ایندکس‌ها از روی PROJECT_DATA (پس از بارگذاری از دیتابیس).
+
+    status_counts شمارش وضعیت پروژه‌های سرد است: project_id -> {وضعیت: تعداد}.
+    archived_counts تعداد محتواهای آرشیوشده هر پروژه است: project_id -> تعداد.
+    """
+    CHAT_ROLE_INDEX.clear()
+    EDITOR_PROJECT_IDS.clear()
+    SORTED_PROJECT_IDS.clear()
+    MEDIA_MESSAGE_INDEX.clear()
+    SUBMISSION_INDEX.clear()
+    PROJECT_STATUS_COUNTS.clear()
+    GLOBAL_STATUS_COUNTS.clear()
+    GLOBAL_STATUS_COUNTS.update(dict.fromkeys(SUBMISSION_STATUSES, 0))
+    for projects in PROJECTS_BY_STATUS.values():
+        projects.clear()
+    ARCHIVED_COUNTS.clear()
+    ARCHIVED_COUNTS.update(archived_counts or {})
+    status_counts = status_counts or {}
+    for project_id, project_data in PROJECT_DATA.catalog_items():
+        index_project(project_id, project_data,
+                      None if project_data.submissions is not None
+                      else status_counts.get(project_id))
+
+
+def projects_of(chat_id, role):
+    """مجموعه شناسه پروژه‌هایی که chat_id در آن‌ها نقش role ('editor_of'/'client_of') دارد."""
+    entry = CHAT_ROLE_INDEX.get(str(chat_id))
+    return entry[role] if entry else set()
+
+
+async def find_submission_by_media(client_chat_id, media_message_id):
+    """یافتن (project_id, submission) برای پیامی که کارفرما روی آن ریپلای کرده است.
+
+    ایندکس فقط محتواهای پروژه‌های گرم را دارد؛ اگر کارفرما پروژه سردی داشته باشد، صاحب
+    پیام از دیتابیس پیدا و همان پروژه بارگذاری می‌شود.
+    """
+    entry = MEDIA_MESSAGE_INDEX.get((client_chat_id, media_message_id))
+    if entry is None:
+        entry = await find_cold_media_owner(client_chat_id, media_message_id)
+    if entry is None:
+        return None, None
+    project_id, submission_id = entry
+    project_data = await load_project(project_id)
+    if not project_data or project_data.client_chat_id != client_chat_id:
+        return None, None
+    submission = get_submission(project_id, submission_id)
+    if submission is None:
+        return None, None
+    return project_id, submission
+
+
+async def find_cold_media_owner(client_chat_id, media_message_id):
+    """(project_id، submission_id) پیام در پروژه‌های سرد کارفرما؛ بدون پروژه سرد کوئری‌ای اجرا نمی‌شود."""
+    cold_projects = [
+        project_id for project_id in projects_of(client_chat_id, 'client_of')
+        if not PROJECT_DATA.is_resident(project_id)
+    ]
+    if not cold_projects:
+        return None
+    try:
+        return await run_in_db_executor(DB_EXECUTORS[0], find_media_owner_in_db,
+                                        cold_projects, media_message_id)
+    except Exception as e:
+        logger.error(f"❌ خطای یافتن محتوای پیام {media_message_id} در دیتابیس: {e}")
+        return None
+
+
+def get_submission(project_id, submission_id, status=None):
+    """دسترسی O(1) به محتوای submission_id از پروژه project_id (و در صورت نیاز با وضعیت status)."""
+    entry = SUBMISSION_INDEX.get(submission_id)
+    if entry is None or entry[0] != project_id:
+        return None
+    submission = entry[1]
+    if status is not None and submission.status != status:
+        return None
+    return submission
+
+
+def submission_position(submission_id):
+    """جایگاه محتوا در لیست submissions پروژه (ستون position در دیتابیس)."""
+    entry = SUBMISSION_INDEX.get(submission_id)
+    return entry[2] if entry else None
+
+
+def paginate_ids(sorted_ids, cursor=None, page_size=PROJECT_LIST_PAGE_SIZE,
+                 predicate=None):
+    """ساخت تنبل یک صفحه از لیست مرتب شناسه‌ها.
+
+    cursor: None (صفحه اول)، ('a', id) برای صفحه بعد از id یا ('b', id) برای
+    صفحه قبل از id. فقط به اندازه یک صفحه (به علاوه یک مورد) پیمایش می‌شود.
+    خروجی: (شناسه‌های صفحه، صفحه قبلی دارد؟، صفحه بعدی دارد؟)
+    """
+    matches = (lambda i: True) if predicate is None else predicate
+
+    if cursor is not None and cursor[0] == 'b':
+        end = bisect_left(sorted_ids, cursor[1])
+        backward = (sorted_ids[i] for i in range(end - 1, -1, -1)
+                    if matches(sorted_ids[i]))
+        page = list(islice(backward, page_size + 1))
+        if len(page) > page_size:
+            return page[page_size - 1::-1], True, True
+        # به ابتدای لیست رسیدیم: صفحه اول کامل نمایش داده می‌شود.
+        cursor = None
+
+    start = 0 if cursor is None else bisect_right(sorted_ids, cursor[1])
+    forward = (sorted_ids[i] for i in range(start, len(sorted_ids))
+               if matches(sorted_ids[i]))
+    page = list(islice(forward, page_size + 1))
+    return page[:page_size], cursor is not None, len(page) > page_size
+
+
+def parse_page_cursor(token):
+    """تبدیل توکن 'a12'/'b12' در callback_data به cursor برای paginate_ids."""
+    if token and token[0] in 'ab' and token[1:].isdigit():
+        return token[0], int(token[1:])
+    return None
+
+
+def is_editor(chat_id):
+    """بررسی اینکه آیا کاربر ادیتور حداقل یک پروژه است یا خیر."""
+    return bool(projects_of(chat_id, 'editor_of'))
+
 
-    except Exception as e:
-        logger.error(f"❌ خطای اتصال/تنظیم دیتابیس: {e}")
-        DB_POOL = None 
+def is_client(chat_id):
+    """بررسی اینکه آیا کاربر کارفرمای حداقل یک پروژه است یا خیر."""
+    return bool(projects_of(chat_id, 'client_of'))
 
-def load_project_data():
-    """بارگذاری داده‌های پروژه از دیتابیس در حافظه."""
-    global PROJECT_DATA
-    
-    conn = get_db_conn()
-    if not conn:
-        PROJECT_DATA = {}
-        return
 
-    try:
-        cur = conn.cursor()
-        cur.execute("SELECT id, data FROM projects;")
-        rows = cur.fetchall()
+# --------------------------------------------------------------------------------------------------
+# ۱.۸. قفل‌های هر پروژه (سریال‌سازی تغییرات در پردازش همزمان آپدیت‌ها)
+# --------------------------------------------------------------------------------------------------
 
-        # پر کردن دیکشنری سراسری از نتایج دیتابیس
-        PROJECT_DATA = {str(row[0]): row[1] for row in rows}
-        logger.info(
-            f"✅ داده‌های پروژه از دیتابیس با موفقیت بارگذاری شدند. ({len(PROJECT_DATA)} پروژه)"
-        )
-    except Exception as e:
-        logger.error(f"❌ خطای بارگذاری داده از دیتابیس: {e}. با داده خالی ادامه می‌یابد.")
-        PROJECT_DATA = {}
-        conn.rollback()
-    finally:
-        release_db_conn(conn)
 
+class KeyedLocks:
+    """یک asyncio.Lock برای هر کلید (پروژه یا چت) که فقط تا وقتی کسی منتظر آن است نگه داشته می‌شود.
 
-def save_project_to_db(project_id, project_data=None):
-    """ذخیره‌سازی/به‌روزرسانی یک پروژه در دیتابیس (UPSERT)."""
-    conn = get_db_conn()
-    if not conn:
-        logger.warning(f"❌ پروژه P{project_id} در دیتابیس ذخیره نشد: اتصال دیتابیس غیرفعال است.")
-        return
+    تغییرات PROJECT_DATA[project_id] و محتواهای آن زیر قفل همان پروژه انجام می‌شود؛
+    پروژه‌های دیگر و نمایش‌های فقط‌خواندنی (داشبورد، راهنما) منتظر نمی‌مانند.
+    قفل‌ها reentrant نیستند: داخل hold(key) نباید دوباره همان key گرفته شود.
+    """
 
-    if project_data is None:
-        project_data = PROJECT_DATA.get(project_id)
-        if project_data is None:
-             logger.error(f"❌ پروژه P{project_id} در حافظه یافت نشد تا ذخیره شود.")
-             return
+    def __init__(self, name):
+        self.name = name
+        self._locks = {}  # key -> [asyncio.Lock، تعداد نگه‌دارنده/منتظر]
+        self.acquired = 0
+        self.contended = 0  # دفعاتی که قفل آزاد نبود
+        self._wait_times = deque(maxlen=1024)
 
-    try:
-        cur = conn.cursor()
-        # منطق UPSERT: اگر ID وجود ندارد، INSERT کن؛ در غیر این صورت، data را UPDATE کن.
-        cur.execute("""
-            INSERT INTO projects (id, data) 
-            VALUES (%s, %s)
-            ON CONFLICT (id) DO UPDATE 
-            SET data = EXCLUDED.data;
-        """, (int(project_id), json.dumps(project_data)))
-        
-        conn.commit()
-        logger.info(f"💾 پروژه P{project_id} با موفقیت در دیتابیس ذخیره/به‌روزرسانی شد.")
-    except Exception as e:
-        logger.error(f"❌ خطای ذخیره‌سازی پروژه P{project_id} در دیتابیس: {e}")
-        conn.rollback()
-    finally:
-        release_db_conn(conn)
+    def is_held(self, key):
+        """آیا قفل key گرفته شده یا کسی منتظر آن است (برای سرد نکردن پروژه در حال تغییر)."""
+        return key in self._locks
+
+    @contextlib.asynccontextmanager
+    async def hold(self, key):
+        entry = self._locks.get(key)
+        if entry is None:
+            entry = self._locks[key] = [asyncio.Lock(), 0]
+        entry[1] += 1
+        try:
+            if entry[0].locked():
+                self.contended += 1
+                started = time.perf_counter()
+                await entry[0].acquire()
+                self._wait_times.append(time.perf_counter() - started)
+            else:
+                await entry[0].acquire()
+            self.acquired += 1
+            try:
+                yield
+            finally:
+                entry[0].release()
+        finally:
+            entry[1] -= 1
+            if not entry[1]:
+                del self._locks[key]
+
+    def stats(self):
+        """وضعیت قفل‌ها برای مسیر /stats."""
+        return {
+            'active': len(self._locks),
+            'acquired': self.acquired,
+            'contended': self.contended,
+            'wait': _latency_summary(list(self._wait_times))
+        }
+
+
+PROJECT_LOCKS = KeyedLocks('project')
+CHAT_LOCKS = KeyedLocks('chat')  # ترتیب پیام‌های هر چت (مراحل ساخت پروژه در user_data)
 
-def delete_project_from_db(project_id):
-    """حذف یک پروژه مشخص از دیتابیس."""
-    conn = get_db_conn()
-    if not conn:
-        logger.warning(f"❌ پروژه P{project_id} حذف نشد: اتصال دیتابیس غیرفعال است.")
-        return
-    
-    try:
-        cur = conn.cursor()
-        cur.execute("DELETE FROM projects WHERE id = %s;", (int(project_id),))
-        conn.commit()
-        logger.info(f"🗑️ پروژه P{project_id} با موفقیت از دیتابیس حذف شد.")
-    except Exception as e:
-        logger.error(f"❌ خطای حذف پروژه P{project_id} از دیتابیس: {e}")
-        conn.rollback()
-    finally:
-        release_db_conn(conn)
 
 # --------------------------------------------------------------------------------------------------
-# ۱.۶. توابع کمکی (برای دسترسی و اعتبارسنجی)
+# ۱.۹. زمان‌بندی ارسال‌ها به Bot API (محدودیت سراسری و هر چت، اولویت و RetryAfter)
 # --------------------------------------------------------------------------------------------------
 
 
-def get_project_and_validate(project_id):
-    """اعتبارسنجی وجود پروژه."""
-    if project_id not in PROJECT_DATA:
-        return None, f"❌ پروژه P{project_id} یافت نشد."
-    return PROJECT_DATA[project_id], None
+class TokenBucket:
+    """سطل توکن: rate توکن در ثانیه تا سقف burst؛ pause برای احترام به retry_after تلگرام."""
+
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = float(burst)
+        self.updated = time.monotonic()
+        self.blocked_until = 0.0
+
+    def _refill(self, now):
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def delay(self):
+        """ثانیه‌های لازم تا آزاد شدن یک توکن (بدون برداشتن آن)."""
+        now = time.monotonic()
+        self._refill(now)
+        wait = self.blocked_until - now
+        if self.tokens < 1:
+            wait = max(wait, (1 - self.tokens) / self.rate)
+        return max(wait, 0.0)
+
+    def take(self):
+        self.tokens -= 1
+
+    def reserve(self):
+        """رزرو نوبت به ترتیب ورود؛ توکن‌ها می‌توانند منفی شوند و خروجی مدت انتظار است."""
+        wait = self.delay()
+        self.take()
+        return wait
+
+    def pause(self, seconds):
+        self.blocked_until = max(self.blocked_until, time.monotonic() + seconds)
+
+    def idle(self):
+        return self.delay() == 0 and self.tokens >= self.burst
+
+
+def _retry_after_seconds(error):
+    value = error.retry_after
+    return value.total_seconds() if hasattr(value, 'total_seconds') else float(value)
+
+
+# اولویت ارسال‌ها (عدد کمتر زودتر): تصمیم‌های مدیر قبل از اطلاعیه‌های انبوه.
+SEND_PRIORITY_HIGH = 0
+SEND_PRIORITY_NORMAL = 1
+SEND_PRIORITY_BULK = 2
+# پاسخ به دکمه‌ها و ویرایش پیام همان چت، پاسخ مستقیم به کلیک مدیر/کاربر است.
+SEND_HIGH_PRIORITY_ENDPOINTS = frozenset(
+    ('answerCallbackQuery', 'editMessageText', 'editMessageReplyMarkup'))
+
+OUTBOUND_GLOBAL_RATE = float(os.environ.get("OUTBOUND_GLOBAL_RATE", "30"))  # پیام در ثانیه
+OUTBOUND_CHAT_RATE = float(os.environ.get("OUTBOUND_CHAT_RATE", "1"))
+OUTBOUND_CHAT_BURST = int(os.environ.get("OUTBOUND_CHAT_BURST", "3"))
+OUTBOUND_MAX_RETRIES = int(os.environ.get("OUTBOUND_MAX_RETRIES", "3"))
+
+
+class SendScheduler(BaseRateLimiter):
+    """همه درخواست‌های Bot API از این زمان‌بند رد می‌شوند (builder.rate_limiter).
+
+    ابتدا نوبت سطل همان چت (به ترتیب ورود) و سپس سطل سراسری گرفته می‌شود؛ وقتی سطل
+    سراسری پر است منتظرها در یک heap بر اساس اولویت (rate_limit_args) صف می‌کشند.
+    RetryAfter سطل همان چت (یا سطل سراسری) را متوقف می‌کند و ارسال تا
+    OUTBOUND_MAX_RETRIES بار تکرار می‌شود؛ بعد از آن ارسال dropped شمرده و خطا بالا داده می‌شود.
+    """
+
+    def __init__(self, global_rate, chat_rate, chat_burst, max_retries):
+        # سقف سراسری بدون burst: در هیچ پنجره یک‌ثانیه‌ای بیش از global_rate ارسال نمی‌شود.
+        self.global_bucket = TokenBucket(global_rate, 1)
+        self.chat_rate = chat_rate
+        self.chat_burst = chat_burst
+        self.max_retries = max_retries
+        self._chat_buckets = {}
+        self._waiters = []  # heap: (اولویت، ترتیب ورود، future)
+        self._seq = 0
+        self._drainer = None
+        self._last_prune = time.monotonic()
+        self.sent = 0
+        self.queued = 0  # ارسال‌هایی که منتظر نوبت ماندند
+        self.delayed = 0  # RetryAfter دریافت‌شده از تلگرام
+        self.dropped = 0  # ارسال‌هایی که بعد از همه تلاش‌ها رها شدند
+        self._wait_times = deque(maxlen=1024)
+
+    async def initialize(self):
+        pass
+
+    async def shutdown(self):
+        if self._drainer:
+            self._drainer.cancel()
+            self._drainer = None
+        for _, _, waiter in self._waiters:
+            if not waiter.done():
+                waiter.cancel()
+        self._waiters.clear()
+
+    def _chat_bucket(self, chat_id):
+        bucket = self._chat_buckets.get(chat_id)
+        if bucket is None:
+            self._prune()
+            bucket = self._chat_buckets[chat_id] = TokenBucket(
+                self.chat_rate, self.chat_burst)
+        return bucket
+
+    def _prune(self):
+        now = time.monotonic()
+        if now - self._last_prune < 60:
+            return
+        self._last_prune = now
+        for chat_id in [c for c, b in self._chat_buckets.items() if b.idle()]:
+            del self._chat_buckets[chat_id]
 
+    async def _acquire_global(self, priority):
+        if not self._waiters and self.global_bucket.delay() == 0:
+            self.global_bucket.take()
+            return
+        self._seq += 1
+        waiter = asyncio.get_running_loop().create_future()
+        heapq.heappush(self._waiters, (priority, self._seq, waiter))
+        if self._drainer is None or self._drainer.done():
+            self._drainer = asyncio.create_task(self._drain())
+        await waiter
+
+    async def _drain(self):
+        """هر بار یک توکن سراسری به پراولویت‌ترین منتظر داده می‌شود."""
+        while self._waiters:
+            wait = self.global_bucket.delay()
+            if wait > 0:
+                await asyncio.sleep(wait)
+                continue
+            _, _, waiter = heapq.heappop(self._waiters)
+            if waiter.done():  # منتظر لغو شده
+                continue
+            self.global_bucket.take()
+            waiter.set_result(None)
+
+    async def process_request(self, callback, args, kwargs, endpoint, data,
+                              rate_limit_args):
+        chat_id = data.get('chat_id')
+        if rate_limit_args is not None:
+            priority = rate_limit_args
+        elif endpoint in SEND_HIGH_PRIORITY_ENDPOINTS:
+            priority = SEND_PRIORITY_HIGH
+        else:
+            priority = SEND_PRIORITY_NORMAL
+
+        for attempt in range(self.max_retries + 1):
+            # درخواست‌های بدون چت (getMe، answerCallbackQuery، setWebhook) فقط RetryAfter را رعایت می‌کنند.
+            if chat_id is not None:
+                started = time.perf_counter()
+                wait = self._chat_bucket(str(chat_id)).reserve()
+                if wait:
+                    await asyncio.sleep(wait)
+                await self._acquire_global(priority)
+                waited = time.perf_counter() - started
+                if waited > 0.001:
+                    self.queued += 1
+                    self._wait_times.append(waited)
+            try:
+                result = await callback(*args, **kwargs)
+            except RetryAfter as e:
+                self.delayed += 1
+                seconds = _retry_after_seconds(e)
+                if attempt == self.max_retries:
+                    self.dropped += 1
+                    logger.error(
+                        f"❌ ارسال {endpoint} به چت {chat_id} بعد از {attempt + 1} تلاش رها شد: {e}")
+                    raise
+                logger.warning(
+                    f"⚠️ محدودیت تلگرام برای {endpoint} (چت {chat_id}): {seconds} ثانیه توقف.")
+                if chat_id is not None:
+                    # ارسال‌های بعدی همان چت هم تا پایان توقف منتظر می‌مانند.
+                    self._chat_bucket(str(chat_id)).pause(seconds)
+                else:
+                    await asyncio.sleep(seconds)
+            else:
+                self.sent += 1
+                return result
+
+    def stats(self):
+        """وضعیت ارسال‌ها برای مسیر /stats."""
+        return {
+            'sent': self.sent,
+            'queued': self.queued,
+            'delayed': self.delayed,
+            'dropped': self.dropped,
+            'waiting': len(self._waiters),
+            'chats': len(self._chat_buckets),
+            'wait': _latency_summary(list(self._wait_times))
+        }
 
-def is_manager(chat_id):
-    """بررسی اینکه آیا کاربر مدیر است یا خیر."""
-    return str(chat_id) == str(MANAGER_CHAT_ID)
+
+SEND_SCHEDULER = SendScheduler(OUTBOUND_GLOBAL_RATE, OUTBOUND_CHAT_RATE,
+                               OUTBOUND_CHAT_BURST, OUTBOUND_MAX_RETRIES)
 
 
 # --------------------------------------------------------------------------------------------------
@@ -205,12 +3248,8 @@ async def smart_guidance(update: Update, context: ContextTypes.DEFAULT_TYPE):
     guidance_message = "🤔 *نقش نامشخص / کاربر ناشناس.* من این دستور را نمی‌شناسم. لطفاً از دستورات مجاز استفاده کنید."
 
     is_manager_user = is_manager(user_chat_id)
-    is_editor = any(
-        data.get('editor_chat_id') == user_chat_id
-        for data in PROJECT_DATA.values())
-    is_client = any(
-        data.get('client_chat_id') == user_chat_id
-        for data in PROJECT_DATA.values())
+    is_editor_user = is_editor(user_chat_id)
+    is_client_user = is_client(user_chat_id)
 
     if is_manager_user:
         guidance_message = "✅ *شما مدیر هستید.* لطفاً از لیست زیر اقدام کنید:"
@@ -227,7 +3266,7 @@ async def smart_guidance(update: Update, context: ContextTypes.DEFAULT_TYPE):
                                              callback_data='list_all')
                     ]]
 
-    elif is_editor:
+    elif is_editor_user:
         guidance_message = "🛠️ *شما ادیتور تعیین شده هستید.* لطفاً از لیست زیر اقدام کنید یا محتوای ادیت شده را به همراه کد پروژه (`P[ID]`) در کپشن ارسال کنید."
         keyboard = [[
             InlineKeyboardButton("📝 پروژه‌های من",
@@ -238,7 +3277,7 @@ async def smart_guidance(update: Update, context: ContextTypes.DEFAULT_TYPE):
                                              callback_data='editor_send_guide')
                     ]]
 
-    elif is_client:
+    elif is_client_user:
         guidance_message = "🤝 *سلام کارفرما، خوش آمدید.* پیام‌های شما یک دستور نیستند."
         keyboard = [[
             InlineKeyboardButton("❓ سوالات متداول کارفرما",
@@ -329,24 +3368,18 @@ async def handle_message(update: Update, context):
             project_name = context.user_data.pop('temp_project_name')
             client_chat_id = context.user_data.pop('temp_client_chat_id')
 
-            # تولید ID جدید پروژه
-            if PROJECT_DATA:
-                last_id = max(int(k) for k in PROJECT_DATA.keys())
-                project_id = str(last_id + 1)
-            else:
-                project_id = '1'
-
-            PROJECT_DATA[project_id] = {
-                "name": project_name,
-                "status": "ReadyForEditSubmission",
-                "client_chat_id": client_chat_id,
-                "editor_chat_id": editor_chat_id,
-                "submissions": []
-            }
+            # تولید ID جدید پروژه (یکتا بین همه workerها)
+            project_id = await next_project_id()
+
+            PROJECT_DATA[project_id] = Project(project_name,
+                                               client_chat_id=client_chat_id,
+                                               editor_chat_id=editor_chat_id,
+                                               submissions=[])
+            index_project(project_id, PROJECT_DATA[project_id])
             context.user_data['state'] = None
 
             # ⬅️ ذخیره در دیتابیس
-            save_project_to_db(project_id)
+            await save_project(project_id)
 
             try:
                 await context.bot.send_message(
@@ -370,12 +3403,6 @@ async def handle_message(update: Update, context):
             project_id = parts[3][1:]
             role_type = parts[4]
 
-            project_data, error = get_project_and_validate(project_id)
-            if error:
-                await update.message.reply_text(error)
-                context.user_data['state'] = None
-                return
-
             try:
                 new_chat_id = str(int(update.message.text))
             except ValueError:
@@ -385,20 +3412,28 @@ async def handle_message(update: Update, context):
                 return
 
             if role_type == 'editor':
-                old_id = project_data.get('editor_chat_id')
-                project_data['editor_chat_id'] = new_chat_id
+                chat_key = 'editor_chat_id'
                 role_name = "ادیتور"
             else:
-                old_id = project_data.get('client_chat_id')
-                project_data['client_chat_id'] = new_chat_id
+                chat_key = 'client_chat_id'
                 role_name = "کارفرما"
 
-            # ⬅️ ذخیره در دیتابیس
-            save_project_to_db(project_id)
+            async with PROJECT_LOCKS.hold(project_id):
+                project_data, error = get_project_and_validate(project_id)
+                if not error:
+                    old_id = project_data.chat_id(chat_key)
+                    project_data.set_chat_id(chat_key, new_chat_id)
+                    reindex_role(project_id, project_data, chat_key, old_id)
+
+                    # ⬅️ ذخیره در دیتابیس
+                    await save_project(project_id)
             context.user_data['state'] = None
+            if error:
+                await update.message.reply_text(error)
+                return
 
             await update.message.reply_text(
-                f"✅ *پروژه P{project_id} ({project_data['name']}):* نقش *{role_name}* با موفقیت تغییر کرد.\n"
+                f"✅ *پروژه P{project_id} ({project_data.name}):* نقش *{role_name}* با موفقیت تغییر کرد.\n"
                 f"*شناسه قدیمی:* `{old_id}`\n"
                 f"*شناسه جدید:* `{new_chat_id}`")
             return
@@ -408,35 +3443,45 @@ async def handle_message(update: Update, context):
     if update.message.reply_to_message:
         replied_message_id = update.message.reply_to_message.message_id
 
-        target_submission = None
-        target_project_id = None
-
-        for pid, pdata in PROJECT_DATA.items():
-            if pdata.get('client_chat_id') == user_chat_id:
-                for sub in pdata['submissions']:
-                    if sub.get('media_message_id') == replied_message_id:
-                        target_submission = sub
-                        target_project_id = pid
-                        break
-                if target_submission:
-                    break
+        target_project_id, target_submission = await find_submission_by_media(
+            user_chat_id, replied_message_id)
 
         if target_submission:
-            if target_submission.get('status') != 'AwaitingFeedback':
-                await update.message.reply_text(
-                    "❌ *اخطار:* شما قبلاً روی این محتوا بازخورد ثبت کرده‌اید. "
-                    "لطفاً به یاد داشته باشید که *تمام تغییرات مورد نیاز* باید در *یک ریپلای واحد* و در همان بار اول اعلام شوند."
-                )
+            already_reviewed_text = (
+                "❌ *اخطار:* شما قبلاً روی این محتوا بازخورد ثبت کرده‌اید. "
+                "لطفاً به یاد داشته باشید که *تمام تغییرات مورد نیاز* باید در *یک ریپلای واحد* و در همان بار اول اعلام شوند."
+            )
+            if target_submission.status != SubmissionStatus.AWAITING_FEEDBACK:
+                await update.message.reply_text(already_reviewed_text)
                 return
 
             if update.message.text:
 
-                target_submission['feedback'].append(update.message.text)
-                target_submission[
-                    'status'] = 'ClientReviewed'  # وضعیت تغییر می‌کند و ریپلای دوم مجاز نیست.
-                
-                # ⬅️ ذخیره در دیتابیس
-                save_project_to_db(target_project_id)
+                async with PROJECT_LOCKS.hold(target_project_id):
+                    # بررسی دوباره زیر قفل: ممکن است آپدیت همزمانی وضعیت را تغییر داده باشد.
+                    target_project_id, target_submission = await find_submission_by_media(
+                        user_chat_id, replied_message_id)
+                    accepted = bool(target_submission) and (
+                        target_submission.status == SubmissionStatus.AWAITING_FEEDBACK)
+                    if accepted:
+                        target_submission.feedback.append(update.message.text)
+                        set_submission_status(
+                            target_project_id, target_submission,
+                            SubmissionStatus.CLIENT_REVIEWED)  # وضعیت تغییر می‌کند و ریپلای دوم مجاز نیست.
+                        project_name = PROJECT_DATA.peek(target_project_id).name
+                        review_messages = manager_review_messages(
+                            target_project_id, target_submission, project_name,
+                            'feedback_submitted')
+
+                        # ⬅️ ذخیره در دیتابیس (همراه پیام‌های مدیر در outbox)
+                        queued = outbox_enabled()
+                        saved = await save_project(target_project_id,
+                                                   target_submission.submission_id,
+                                                   outbox=review_messages if queued else ())
+
+                if not accepted:
+                    await update.message.reply_text(already_reviewed_text)
+                    return
 
                 try:
                     await context.bot.edit_message_reply_markup(
@@ -450,13 +3495,10 @@ async def handle_message(update: Update, context):
 
                 await update.message.reply_text(
                     "💬 *بازخورد شما ثبت شد!* این محتوا برای تصمیم‌گیری مدیر ارسال شده است. نتیجه به شما اطلاع داده خواهد شد."
+                    + save_note(saved)
                 )
 
-                project_name = PROJECT_DATA[target_project_id]['name']
-                await send_to_manager_for_review(context, target_project_id,
-                                                 target_submission,
-                                                 project_name,
-                                                 'feedback_submitted')
+                await fan_out(outbox_sends(context.bot, review_messages, queued))
 
                 return
             else:
@@ -473,10 +3515,7 @@ async def handle_media(update: Update, context):
     user_chat_id = str(update.effective_chat.id)
     caption = update.message.caption if update.message.caption else ""
 
-    is_editor = any(
-        data.get('editor_chat_id') == user_chat_id
-        for data in PROJECT_DATA.values())
-    if not is_editor:
+    if not is_editor(user_chat_id):
         await update.message.reply_text(
             "⛔️ شما به عنوان ادیتور هیچ پروژه‌ای تعیین نشده‌اید.")
         return
@@ -494,15 +3533,15 @@ async def handle_media(update: Update, context):
         await update.message.reply_text(f"❌ پروژه *P{project_id}* یافت نشد.")
         return
 
-    project_data = PROJECT_DATA[project_id]
+    project_data = PROJECT_DATA.peek(project_id)
 
-    if project_data.get('editor_chat_id') != user_chat_id:
+    if project_data.editor_chat_id != user_chat_id:
         await update.message.reply_text(
             "⛔️ شما ادیتور تعیین شده برای این پروژه نیستید.")
         return
 
-    client_chat_id = project_data['client_chat_id']
-    project_name = project_data['name']
+    client_chat_id = project_data.client_chat_id
+    project_name = project_data.name
 
     # ۱. استخراج file_id و media_type
     if update.message.photo:
@@ -537,31 +3576,38 @@ async def handle_media(update: Update, context):
                                                  caption=caption,
                                                  reply_markup=client_keyboard)
 
-        # 3. ذخیره اطلاعات
-        new_submission = {
-            "submission_id": submission_id,
-            "media_message_id": sent_message.message_id,
-            "file_id": file_id,
-            "media_type": media_type,
-            "caption": caption,
-            "feedback": [],
-            "status": "AwaitingFeedback"
-        }
-        project_data['submissions'].append(new_submission)
-
-        # ⬅️ ذخیره در دیتابیس
-        save_project_to_db(project_id)
-
-        await context.bot.send_message(
-            chat_id=client_chat_id,
-            text=
-            f"✨ *محتوای جدید برای پروژه '{project_name}'* (P{project_id}) رسید.\n"
-            f"1️⃣ *برای تایید:* دکمه زیر محتوا را بزنید.\n"
-            f"2️⃣ *برای درخواست تغییر:* *مستقیماً روی محتوا ریپلای کنید* و نظر خود را بنویسید (فقط یک بار مجاز است)."
-        )
+        # 3. ذخیره اطلاعات (کپی بالا بیرون از قفل انجام شد تا بقیه آپدیت‌های پروژه منتظر نمانند)
+        new_submission = Submission(submission_id,
+                                    media_message_id=sent_message.message_id,
+                                    file_id=file_id,
+                                    media_type=media_type,
+                                    caption=caption)
+        async with PROJECT_LOCKS.hold(project_id):
+            project_data = await load_project(project_id)
+            if project_data is None:
+                await update.message.reply_text(
+                    f"❌ پروژه *P{project_id}* در این فاصله حذف شد و محتوا ثبت نشد.")
+                return
+            project_data.submissions.append(new_submission)
+            index_submission(project_id, project_data, new_submission)
+            PROJECT_DATA.grow(project_id, new_submission)
+            client_notice = outbox_message(
+                client_chat_id, 'send_message',
+                text=
+                f"✨ *محتوای جدید برای پروژه '{project_name}'* (P{project_id}) رسید.\n"
+                f"1️⃣ *برای تایید:* دکمه زیر محتوا را بزنید.\n"
+                f"2️⃣ *برای درخواست تغییر:* *مستقیماً روی محتوا ریپلای کنید* و نظر خود را بنویسید (فقط یک بار مجاز است).")
+
+            # ⬅️ ذخیره در دیتابیس؛ محتوای جدید پیش از تأیید به ادیتور commit می‌شود.
+            queued = outbox_enabled()
+            saved = await save_project(project_id, submission_id,
+                                       outbox=[client_notice] if queued else ())
+
+        await fan_out(outbox_sends(context.bot, [client_notice], queued))
 
         await update.message.reply_text(
             f"✅ محتوای ادیت شده با موفقیت برای کارفرما ارسال شد. (Submission ID: {submission_id})"
+            + save_note(saved)
         )
 
     except BadRequest as e:
@@ -569,8 +3615,11 @@ async def handle_media(update: Update, context):
             f"❌ اخطار: پیام به کارفرما ارسال نشد. (آیدی اشتباه یا ربات بلاک شده است.)"
         )
         # ⬅️ در صورت خطا، وضعیت پروژه را به دیتابیس نیز برمی‌گردانیم
-        project_data['status'] = 'Error_Client_Unreachable_Edit'
-        save_project_to_db(project_id)
+        async with PROJECT_LOCKS.hold(project_id):
+            project_data = PROJECT_DATA.peek(project_id)
+            if project_data is not None:
+                project_data.status = 'Error_Client_Unreachable_Edit'
+                await save_project(project_id)
 
 
 # --------------------------------------------------------------------------------------------------
@@ -583,30 +3632,21 @@ async def get_status_text(project_id, data, user_chat_id):
 
     is_manager_user = is_manager(user_chat_id)
 
-    submission_counts = {
-        'AwaitingFeedback': 0,
-        'ClientReviewed': 0,
-        'ClientApproved': 0,
-        'RejectedByClient_AwaitingEditor': 0,
-        'ManagerApproved': 0
-    }
-
-    for sub in data.get('submissions', []):
-        if sub['status'] in submission_counts:
-            submission_counts[sub['status']] += 1
-
-    total_submissions = len(data.get('submissions', []))
+    submission_counts = project_status_counts(project_id)
+    archived_count = ARCHIVED_COUNTS.get(project_id, 0)
+    total_submissions = sum(PROJECT_STATUS_COUNTS.get(project_id, {}).values()) + archived_count
+    archived_note = f" (📦 {archived_count} در آرشیو)" if archived_count else ""
     status_msg = f"پروژه در حال اجراست."
 
     if is_manager_user:
-        editor_info = f"✂️ ادیتور: *{data.get('editor_chat_id')}*"
-        client_info = f"👤 کارفرما: *{data.get('client_chat_id')}*"
+        editor_info = f"✂️ ادیتور: *{data.editor_chat_id}*"
+        client_info = f"👤 کارفرما: *{data.client_chat_id}*"
     else:
         editor_info = "✂️ ادیتور: 🔒 مخفی"
         client_info = "👤 کارفرما: 🔒 مخفی"
 
     return (
-        f"📋 *جزئیات پروژه P{project_id}: {data['name']}*\n"
+        f"📋 *جزئیات پروژه P{project_id}: {data.name}*\n"
         f"وضعیت کلی: *{status_msg}*\n"
         f"----------------------------------------\n"
         f"{editor_info}\n"
@@ -616,7 +3656,46 @@ async def get_status_text(project_id, data, user_chat_id):
         f" - 📝 در انتظار تصمیم مدیر (بازخورد کارفرما): *{submission_counts['ClientReviewed']}*\n"
         f" - 🟠 در انتظار تایید نهایی مدیر (تایید کارفرما): *{submission_counts['ClientApproved']}*\n"
         f" - ↩️ برگشت خورده به ادیتور: *{submission_counts['RejectedByClient_AwaitingEditor']}*\n"
-        f" - ✅ نهایی شده: *{submission_counts['ManagerApproved']}*\n")
+        f" - ✅ نهایی شده: *{submission_counts['ManagerApproved'] + archived_count}*{archived_note}\n")
+
+
+def archive_keyboard(project_id):
+    """دکمه مشاهده آرشیو پروژه (None اگر محتوای آرشیوشده‌ای نداشته باشد)."""
+    if not ARCHIVED_COUNTS.get(project_id):
+        return None
+    return [InlineKeyboardButton("📦 آرشیو محتواهای نهایی‌شده",
+                                 callback_data=f'archive_{project_id}_0')]
+
+
+async def get_archive_page(project_id, offset):
+    """متن و دکمه‌های یک صفحه از آرشیو پروژه (خواندن از دیتابیس در صورت نیاز)."""
+    rows = await run_in_db_executor(_db_executor_for(project_id),
+                                    fetch_archived_submissions, project_id,
+                                    offset, ARCHIVE_PAGE_SIZE + 1)
+    has_next = len(rows) > ARCHIVE_PAGE_SIZE
+    lines = [f"📦 آرشیو محتواهای نهایی‌شده پروژه P{project_id} "
+             f"({ARCHIVED_COUNTS.get(project_id, 0)} محتوا)\n"]
+    for number, submission in enumerate(rows[:ARCHIVE_PAGE_SIZE], start=offset + 1):
+        finalized_date = time.strftime('%Y-%m-%d', time.localtime(submission.finalized_at)) \
+            if submission.finalized_at else '—'
+        lines.append(f"{number}. [{submission.media_type or '—'}] "
+                     f"{submission.caption or '—'}\n"
+                     f"   ✅ {finalized_date} | 💬 {len(submission.feedback)} بازخورد")
+    if not rows:
+        lines.append("محتوایی در این صفحه نیست.")
+
+    nav_row = []
+    if offset > 0:
+        nav_row.append(InlineKeyboardButton(
+            "⬅️ قبلی",
+            callback_data=f'archive_{project_id}_{max(offset - ARCHIVE_PAGE_SIZE, 0)}'))
+    if has_next:
+        nav_row.append(InlineKeyboardButton(
+            "بعدی ➡️", callback_data=f'archive_{project_id}_{offset + ARCHIVE_PAGE_SIZE}'))
+    keyboard = [nav_row] if nav_row else []
+    keyboard.append([InlineKeyboardButton("بازگشت به وضعیت پروژه",
+                                          callback_data=f'status_{project_id}')])
+    return "\n".join(lines), InlineKeyboardMarkup(keyboard)
 
 
 async def check_project_status(update: Update, context):
@@ -625,9 +3704,7 @@ async def check_project_status(update: Update, context):
     user_chat_id = str(message.chat.id)
     if not update.message: return
 
-    is_authorized = is_manager(user_chat_id) or any(
-        data.get('editor_chat_id') == user_chat_id
-        for data in PROJECT_DATA.values())
+    is_authorized = is_manager(user_chat_id) or is_editor(user_chat_id)
     if not is_authorized:
         await message.reply_text(
             "⛔️ دسترسی محدود: فقط مدیر یا ادیتور مربوط به پروژه می‌تواند وضعیت را چک کند."
@@ -645,59 +3722,113 @@ async def check_project_status(update: Update, context):
         await message.reply_text(error)
         return
 
-    if not is_manager(user_chat_id) and project_data.get(
-            'editor_chat_id') != user_chat_id:
+    if not is_manager(user_chat_id) and project_data.editor_chat_id != user_chat_id:
         await message.reply_text("⛔️ شما به این پروژه دسترسی ندارید.")
         return
 
     status_text = await get_status_text(project_id, project_data, user_chat_id)
-    await message.reply_text(status_text, parse_mode='Markdown')
+    archive_row = archive_keyboard(project_id)
+    await message.reply_text(
+        status_text,
+        reply_markup=InlineKeyboardMarkup([archive_row]) if archive_row else None,
+        parse_mode='Markdown')
+
+
+# سقف طول پیام تلگرام ۴۰۹۶ کاراکتر است؛ کمی حاشیه برای Markdown در نظر گرفته می‌شود.
+TELEGRAM_MESSAGE_LIMIT = 4000
+DASHBOARD_MAX_PROJECTS = int(os.environ.get("DASHBOARD_MAX_PROJECTS", "40"))
+DASHBOARD_MAX_CHUNKS = int(os.environ.get("DASHBOARD_MAX_CHUNKS", "3"))
+
+
+def iter_dashboard_lines(max_projects=DASHBOARD_MAX_PROJECTS):
+    """تولید خط به خط متن داشبورد؛ حداکثر max_projects پروژه فوری فهرست می‌شود."""
+    waiting_manager_approval_count = (GLOBAL_STATUS_COUNTS['ClientApproved'] +
+                                      GLOBAL_STATUS_COUNTS['ClientReviewed'])
+
+    yield "📊 *داشبورد مدیریتی تیم محتوا*\n\n"
+    yield f"*تعداد کل پروژه‌ها:* {len(PROJECT_DATA)}\n"
+    yield f"*↩️ محتوای منتظر تأیید نهایی شما:* {waiting_manager_approval_count}\n"
+
+    if waiting_manager_approval_count == 0:
+        return
+
+    yield "\n*فوری (نیاز به اقدام مدیر):*\n"
+    pending_projects = (PROJECTS_BY_STATUS['ClientApproved'] |
+                        PROJECTS_BY_STATUS['ClientReviewed'])
+    # فقط max_projects پروژه با کوچک‌ترین شناسه انتخاب می‌شوند، بدون مرتب‌سازی کل مجموعه.
+    for pid in heapq.nsmallest(max_projects, pending_projects, key=int):
+        data = PROJECT_DATA.peek(pid)
+        counts = PROJECT_STATUS_COUNTS[pid]
+        for status, text in (
+            ('ClientApproved', "تایید کارفرما، منتظر تایید نهایی شما."),
+            ('ClientReviewed', "بازخورد کارفرما، منتظر تصمیم شما.")):
+            count = counts.get(status, 0)
+            if count:
+                multiplier = f" (×{count})" if count > 1 else ""
+                yield f" - P{pid} ({data.name}): {text}{multiplier}\n"
+
+    hidden_projects = len(pending_projects) - max_projects
+    if hidden_projects > 0:
+        yield (f"\n➕ *و {hidden_projects} پروژه دیگر.* "
+               "برای مشاهده همه از دکمه «موارد منتظر شما» استفاده کنید.\n")
+
+
+def chunk_lines(lines, limit=TELEGRAM_MESSAGE_LIMIT, max_chunks=None):
+    """بسته‌بندی خطوط در پیام‌هایی با طول حداکثر limit (حداکثر max_chunks پیام)."""
+    chunk = []
+    size = 0
+    produced = 0
+    for line in lines:
+        if len(line) > limit:
+            line = line[:limit - 2] + "…\n"
+        if size + len(line) > limit:
+            yield "".join(chunk)
+            produced += 1
+            if max_chunks is not None and produced >= max_chunks:
+                return
+            chunk = []
+            size = 0
+        chunk.append(line)
+        size += len(line)
+    if chunk:
+        yield "".join(chunk)
 
 
 async def dashboard(update: Update, context):
     """نمایش داشبورد مدیریتی و وضعیت پروژه‌ها."""
+    # از دستور /dashboard یک Update و از دکمه‌ها یک CallbackQuery می‌رسد.
+    is_callback = isinstance(update, telegram.CallbackQuery) or bool(
+        update.callback_query)
     message = update.message if update.message else update.callback_query.message
     if not is_manager(message.chat.id):
         await message.reply_text("⛔️ دسترسی محدود.")
         return
 
-    total_projects = len(PROJECT_DATA)
-
-    waiting_manager_approval_count = 0
-    for data in PROJECT_DATA.values():
-        for sub in data.get('submissions', []):
-            if sub['status'] in ['ClientApproved', 'ClientReviewed']:
-                waiting_manager_approval_count += 1
-
-    dashboard_text = (
-        "📊 *داشبورد مدیریتی تیم محتوا*\n\n"
-        f"*تعداد کل پروژه‌ها:* {total_projects}\n"
-        f"*↩️ محتوای منتظر تأیید نهایی شما:* {waiting_manager_approval_count}\n"
-    )
-
-    if waiting_manager_approval_count > 0:
-        dashboard_text += "\n*فوری (نیاز به اقدام مدیر):*\n"
-        for pid, data in PROJECT_DATA.items():
-            for sub in data.get('submissions', []):
-                if sub['status'] == 'ClientApproved':
-                    dashboard_text += f" - P{pid} ({data['name']}): تایید کارفرما، منتظر تایید نهایی شما.\n"
-                elif sub['status'] == 'ClientReviewed':
-                    dashboard_text += f" - P{pid} ({data['name']}): بازخورد کارفرما، منتظر تصمیم شما.\n"
+    chunks = list(
+        chunk_lines(iter_dashboard_lines(), max_chunks=DASHBOARD_MAX_CHUNKS))
 
     keyboard = [[
         InlineKeyboardButton("📄 *نمایش لیست کامل پروژه‌ها*",
                              callback_data='list_all')
     ]]
+    if PROJECTS_BY_STATUS['ClientApproved'] or PROJECTS_BY_STATUS['ClientReviewed']:
+        keyboard.insert(0, [
+            InlineKeyboardButton("🔥 موارد منتظر شما",
+                                 callback_data='list_all_pending')
+        ])
     reply_markup = InlineKeyboardMarkup(keyboard)
 
-    if update.callback_query:
-        await message.edit_text(dashboard_text,
-                                reply_markup=reply_markup,
-                                parse_mode='Markdown')
-    else:
-        await message.reply_text(dashboard_text,
-                                 reply_markup=reply_markup,
-                                 parse_mode='Markdown')
+    for index, dashboard_text in enumerate(chunks):
+        # دکمه‌ها فقط زیر آخرین بخش داشبورد قرار می‌گیرند.
+        markup = reply_markup if index == len(chunks) - 1 else None
+        if index == 0 and is_callback:
+            await message.edit_text(dashboard_text,
+                                    reply_markup=markup,
+                                    parse_mode='Markdown')
+        else:
+            await message.reply_text(dashboard_text,
+                                     reply_markup=markup,
+                                     parse_mode='Markdown')
 
 
 # --------------------------------------------------------------------------------------------------
@@ -705,12 +3836,77 @@ async def dashboard(update: Update, context):
 # --------------------------------------------------------------------------------------------------
 
 
-async def send_to_manager_for_review(context, project_id, submission,
-                                     project_name, action_type):
-    """تابع کمکی برای ارسال محتوا و گزارش بازخورد به مدیر جهت تصمیم‌گیری."""
+# حداکثر ارسال‌های همزمان یک fan-out (بقیه منتظر می‌مانند؛ سقف تلگرام را SEND_SCHEDULER رعایت می‌کند).
+NOTIFY_FANOUT_LIMIT = int(os.environ.get("NOTIFY_FANOUT_LIMIT", "8"))
+NOTIFY_FANOUT_SLOTS = asyncio.Semaphore(NOTIFY_FANOUT_LIMIT)
+
+
+async def _isolated_send(recipient, send):
+    async with NOTIFY_FANOUT_SLOTS:
+        try:
+            return await send
+        except Exception as e:
+            logger.warning(f"⚠️ ارسال به {recipient} ناموفق بود: {e}")
+            return None
+
+
+async def fan_out(sends):
+    """ارسال‌های مستقل [(گیرنده، coroutine)] را همزمان اجرا می‌کند.
+
+    خطای هر گیرنده فقط لاگ می‌شود و جلوی ارسال به بقیه را نمی‌گیرد؛ خروجی به ترتیب
+    ورودی است و برای ارسال‌های ناموفق None است.
+    """
+    return await asyncio.gather(
+        *(_isolated_send(recipient, send) for recipient, send in sends))
+
+
+MEDIA_SEND_METHODS = {'photo': 'send_photo', 'video': 'send_video', 'document': 'send_document'}
+
+
+def outbox_message(chat_id, method, priority=SEND_PRIORITY_BULK, fallback=None, **params):
+    """یک ارسال Bot API به شکل قابل ذخیره در outbox (متد ExtBot و پارامترهای آن).
+
+    fallback پیام دیگری است که اگر ارسال اصلی BadRequest بدهد (مثلاً file_id نامعتبر)
+    به جای آن فرستاده می‌شود.
+    """
+    if params.get('reply_markup') is not None:
+        params['reply_markup'] = params['reply_markup'].to_dict()
+    return {'chat_id': str(chat_id), 'method': method, 'priority': priority,
+            'params': params, 'fallback': fallback}
+
+
+async def deliver_message(bot, message):
+    """ارسال یک پیام outbox؛ خطاهای شبکه و RetryAfter بالا داده می‌شوند تا دوباره تلاش شود."""
+    params = dict(message['params'])
+    if params.get('reply_markup') is not None:
+        params['reply_markup'] = InlineKeyboardMarkup.de_json(params['reply_markup'], bot)
+    try:
+        return await getattr(bot, message['method'])(
+            message['chat_id'], rate_limit_args=message['priority'], **params)
+    except BadRequest as e:
+        if not message.get('fallback'):
+            raise
+        logger.error(f"Error sending {message['method']} to {message['chat_id']}: {e}")
+        return await deliver_message(bot, message['fallback'])
+
+
+def outbox_sends(bot, messages, queued):
+    """ارسال‌های مستقیم (برای fan_out) وقتی پیام‌ها در outbox ثبت نشده‌اند.
 
-    submission_id = submission['submission_id']
-    raw_feedback_report = submission.get('feedback', [])
+    queued همان تصمیم outbox_enabled پیش از save_project است؛ با آن پیام‌ها همراه تغییر
+    وضعیت در outbox ثبت شده‌اند و OUTBOX_DISPATCHER آن‌ها را می‌فرستد، پس خروجی خالی است.
+    """
+    if queued:
+        return []
+    return [(f"chat {message['chat_id']}", deliver_message(bot, message))
+            for message in messages]
+
+
+def manager_review_messages(project_id, submission, project_name, action_type):
+    """پیام‌های ارسال محتوا و گزارش بازخورد به مدیر جهت تصمیم‌گیری."""
+
+    submission_id = submission.submission_id
+    raw_feedback_report = submission.feedback
 
     if action_type == 'approve_without_feedback':
         raw_feedback_text = "کارفرما هیچ بازخورد متنی ثبت نکرد و مستقیماً محتوا را تایید نهایی کرد."
@@ -723,106 +3919,84 @@ async def send_to_manager_for_review(context, project_id, submission,
             raw_feedback_text = "کارفرما ریپلای کرد اما متن بازخورد خالی بود. نیاز به تصمیم‌گیری مدیر."
 
     # 2. کپی محتوای اصلی برای مدیر (از file_id ذخیره‌شده)
-    if submission['file_id']:
-        manager_caption = f"{manager_prompt}\n\n" \
-                          f"*پروژه:* P{project_id} - {project_name}\n" \
-                          f"*ID محتوا:* {submission_id}\n" \
-                          f"*بازخوردهای کارفرما:*\n" \
-                          f"```\n{raw_feedback_text}```\n" \
-                          f"----------------------------------------\n" \
-                          f"*تصمیم نهایی با شماست:*"
-
-        try:
-            if submission['media_type'] == 'photo':
-                await context.bot.send_photo(MANAGER_CHAT_ID,
-                                             submission['file_id'],
-                                             caption=manager_caption,
-                                             parse_mode='Markdown')
-            elif submission['media_type'] == 'video':
-                await context.bot.send_video(MANAGER_CHAT_ID,
-                                             submission['file_id'],
-                                             caption=manager_caption,
-                                             parse_mode='Markdown')
-            elif submission['media_type'] == 'document':  # ارسال فایل عمومی
-                await context.bot.send_document(MANAGER_CHAT_ID,
-                                                submission['file_id'],
-                                                caption=manager_caption,
-                                                parse_mode='Markdown')
-        except Exception as e:
-            logger.error(f"Error copying media to manager: {e}")
-            await context.bot.send_message(
-                MANAGER_CHAT_ID,
-                f"❌ *خطای ارسال محتوا مدیا* (P{project_id} - {submission_id}): فایل در تلگرام یافت نشد.\n\n"
+    if not submission.file_id:
+        return []
+    manager_caption = f"{manager_prompt}\n\n" \
+                      f"*پروژه:* P{project_id} - {project_name}\n" \
+                      f"*ID محتوا:* {submission_id}\n" \
+                      f"*بازخوردهای کارفرما:*\n" \
+                      f"```\n{raw_feedback_text}```\n" \
+                      f"----------------------------------------\n" \
+                      f"*تصمیم نهایی با شماست:*"
+
+    messages = []
+    media_method = MEDIA_SEND_METHODS.get(submission.media_type)
+    if media_method:
+        messages.append(outbox_message(
+            MANAGER_CHAT_ID, media_method, SEND_PRIORITY_NORMAL,
+            fallback=outbox_message(
+                MANAGER_CHAT_ID, 'send_message', SEND_PRIORITY_NORMAL,
+                text=f"❌ *خطای ارسال محتوا مدیا* (P{project_id} - {submission_id}): فایل در تلگرام یافت نشد.\n\n"
                 f"{manager_caption}",
-                parse_mode='Markdown')
-
-        # 3. ارسال دکمه‌های تصمیم‌گیری به مدیر
-
-        if action_type == 'feedback_submitted':
-            manager_keyboard = InlineKeyboardMarkup(
-                [[
-                    InlineKeyboardButton(
-                        "تایید بازخورد (بازگشت به ادیتور) 🔄",
-                        callback_data=
-                        f'manager_review_accept_{project_id}_{submission_id}')
-                ],
-                 [
-                     InlineKeyboardButton(
-                         "رد بازخورد (تایید نهایی) ✅",
-                         callback_data=
-                         f'manager_review_reject_{project_id}_{submission_id}')
-                 ]])
-            await context.bot.send_message(
-                MANAGER_CHAT_ID,
-                f"👆 محتوای *P{project_id} ({submission_id})* نیاز به تصمیم‌گیری دارد.",
-                reply_markup=manager_keyboard,
-                parse_mode='Markdown')
-
-        elif action_type == 'approve_without_feedback':
-            manager_keyboard = InlineKeyboardMarkup([[
+                parse_mode='Markdown'),
+            **{submission.media_type: submission.file_id},
+            caption=manager_caption,
+            parse_mode='Markdown'))
+
+    # 3. دکمه‌های تصمیم‌گیری همزمان با مدیا ارسال می‌شوند؛ هر دو پیام شناسه محتوا را دارند
+    # چون ترتیب رسیدن دو ارسال همزمان تضمین‌شده نیست.
+    if action_type == 'feedback_submitted':
+        manager_keyboard = InlineKeyboardMarkup(
+            [[
                 InlineKeyboardButton(
-                    "تایید نهایی مدیر ✅",
+                    "تایید بازخورد (بازگشت به ادیتور) 🔄",
                     callback_data=
-                    f'manager_final_approve_{project_id}_{submission_id}')
-            ]])
-            await context.bot.send_message(
-                MANAGER_CHAT_ID,
-                f"👆 محتوای *P{project_id} ({submission_id})* توسط کارفرما تایید شده. لطفا تایید نهایی کنید.",
-                reply_markup=manager_keyboard,
-                parse_mode='Markdown')
-
+                    f'manager_review_accept_{project_id}_{submission_id}')
+            ],
+             [
+                 InlineKeyboardButton(
+                     "رد بازخورد (تایید نهایی) ✅",
+                     callback_data=
+                     f'manager_review_reject_{project_id}_{submission_id}')
+             ]])
+        messages.append(outbox_message(
+            MANAGER_CHAT_ID, 'send_message', SEND_PRIORITY_HIGH,
+            text=f"🧭 محتوای *P{project_id} ({submission_id})* نیاز به تصمیم‌گیری دارد.",
+            reply_markup=manager_keyboard,
+            parse_mode='Markdown'))
+
+    elif action_type == 'approve_without_feedback':
+        manager_keyboard = InlineKeyboardMarkup([[
+            InlineKeyboardButton(
+                "تایید نهایی مدیر ✅",
+                callback_data=
+                f'manager_final_approve_{project_id}_{submission_id}')
+        ]])
+        messages.append(outbox_message(
+            MANAGER_CHAT_ID, 'send_message', SEND_PRIORITY_HIGH,
+            text=f"🧭 محتوای *P{project_id} ({submission_id})* توسط کارفرما تایید شده. لطفا تایید نهایی کنید.",
+            reply_markup=manager_keyboard,
+            parse_mode='Markdown'))
+    return messages
 
-async def send_media_to_editor(context, editor_chat_id, project_id, submission,
-                               message_prefix):
-    """تابع کمکی برای کپی کردن محتوای اصلی به ادیتور همراه با پیام."""
 
-    submission_id = submission['submission_id']
+def editor_media_messages(editor_chat_id, project_id, submission, message_prefix):
+    """پیام کپی محتوای اصلی برای ادیتور همراه با توضیح (خالی اگر file_id نداشته باشد)."""
 
-    if submission['file_id']:
-        editor_caption = f"{message_prefix}\n\n*پروژه:* P{project_id}\n*ID محتوا:* {submission_id}\n"
+    submission_id = submission.submission_id
+    media_method = MEDIA_SEND_METHODS.get(submission.media_type)
+    if not submission.file_id or not media_method:
+        return []
 
-        try:
-            if submission['media_type'] == 'photo':
-                await context.bot.send_photo(editor_chat_id,
-                                             submission['file_id'],
-                                             caption=editor_caption,
-                                             parse_mode='Markdown')
-            elif submission['media_type'] == 'video':
-                await context.bot.send_video(editor_chat_id,
-                                             submission['file_id'],
-                                             caption=editor_caption,
-                                             parse_mode='Markdown')
-            elif submission['media_type'] == 'document':  # ارسال فایل عمومی
-                await context.bot.send_document(editor_chat_id,
-                                                submission['file_id'],
-                                                caption=editor_caption,
-                                                parse_mode='Markdown')
-        except Exception as e:
-            logger.error(f"Error copying media to editor: {e}")
-            await context.bot.send_message(
-                editor_chat_id,
-                f"❌ *خطای ارسال محتوا* (P{project_id}): فایل محتوا در تلگرام یافت نشد."
-            )
+    editor_caption = f"{message_prefix}\n\n*پروژه:* P{project_id}\n*ID محتوا:* {submission_id}\n"
+    return [outbox_message(
+        editor_chat_id, media_method,
+        fallback=outbox_message(
+            editor_chat_id, 'send_message',
+            text=f"❌ *خطای ارسال محتوا* (P{project_id}): فایل محتوا در تلگرام یافت نشد."),
+        **{submission.media_type: submission.file_id},
+        caption=editor_caption,
+        parse_mode='Markdown')]
 
 
 # --------------------------------------------------------------------------------------------------
@@ -830,6 +4004,29 @@ async def send_media_to_editor(context, editor_chat_id, project_id, submission,
 # --------------------------------------------------------------------------------------------------
 
 
+# فیلترهای لیست پروژه‌های مدیر: کلید -> (برچسب دکمه، وضعیت‌های محتوا یا None برای همه)
+PROJECT_LIST_FILTERS = {
+    'all': ("همه", None),
+    'pending': ("منتظر مدیر", ('ClientApproved', 'ClientReviewed')),
+    'waiting': ("منتظر کارفرما", ('AwaitingFeedback', )),
+    'rework': ("برگشتی", ('RejectedByClient_AwaitingEditor', )),
+}
+
+
+def page_nav_row(callback_prefix, page, has_prev, has_next):
+    """ردیف دکمه‌های قبلی/بعدی؛ cursor همان اولین/آخرین شناسه صفحه فعلی است."""
+    nav_row = []
+    if has_prev:
+        nav_row.append(
+            InlineKeyboardButton("⬅️ قبلی",
+                                 callback_data=f'{callback_prefix}_b{page[0]}'))
+    if has_next:
+        nav_row.append(
+            InlineKeyboardButton("بعدی ➡️",
+                                 callback_data=f'{callback_prefix}_a{page[-1]}'))
+    return nav_row
+
+
 async def handle_callback(update: Update, context):
     """مدیریت کلیک روی دکمه های شیشه ای (Inline Buttons)."""
     query = update.callback_query
@@ -839,7 +4036,7 @@ async def handle_callback(update: Update, context):
     action = data[0]
 
     # --- منطق‌های عمومی (منو، داشبورد، وضعیت) ---
-    if action in ['menu', 'editor', 'list', 'status']:
+    if action in ['menu', 'editor', 'list', 'status', 'archive']:
         if action == 'menu':
             if data[1] == 'dashboard': return await dashboard(query, context)
             elif data[1] == 'new' and data[2] == 'project':
@@ -847,17 +4044,21 @@ async def handle_callback(update: Update, context):
         elif action == 'editor':
             editor_id = str(query.message.chat.id)
             if data[1] == 'my':
-                editor_projects = [(pid, data['name'])
-                                   for pid, data in PROJECT_DATA.items()
-                                   if data.get('editor_chat_id') == editor_id]
-                if not editor_projects:
+                # callback_data: editor_my_projects[_<cursor>]
+                editor_ids = EDITOR_PROJECT_IDS.get(editor_id)
+                if not editor_ids:
                     return await query.edit_message_text(
                         "شما پروژه فعالی ندارید.")
+                page, has_prev, has_next = paginate_ids(
+                    editor_ids, parse_page_cursor(data[3] if len(data) > 3 else None))
                 project_list_text = "📋 *پروژه‌های شما:*\n\n"
                 keyboard = [[
-                    InlineKeyboardButton(f"⚙️ P{pid}: {name}",
+                    InlineKeyboardButton(f"⚙️ P{pid}: {PROJECT_DATA.peek(str(pid)).name}",
                                          callback_data=f'status_{pid}')
-                ] for pid, name in editor_projects]
+                ] for pid in page]
+                nav_row = page_nav_row('editor_my_projects', page, has_prev, has_next)
+                if nav_row:
+                    keyboard.append(nav_row)
                 return await query.edit_message_text(
                     project_list_text,
                     reply_markup=InlineKeyboardMarkup(keyboard),
@@ -882,12 +4083,31 @@ async def handle_callback(update: Update, context):
 
         elif action == 'list' and data[1] == 'all':
             if not is_manager(query.message.chat.id): return
-            manager_projects = [(pid, data['name'])
-                                for pid, data in PROJECT_DATA.items()]
-            project_list_text = "📋 *لیست کامل پروژه‌ها (مدیر):*\n\n"
-
-            keyboard = []
-            for pid, name in manager_projects:
+            # callback_data: list_all[_<filter>[_<cursor>]]
+            list_filter = data[2] if len(data) > 2 and data[2] in PROJECT_LIST_FILTERS else 'all'
+            statuses = PROJECT_LIST_FILTERS[list_filter][1]
+            predicate = None
+            if statuses:
+                predicate = lambda pid: any(
+                    str(pid) in PROJECTS_BY_STATUS[status] for status in statuses)
+            page, has_prev, has_next = paginate_ids(
+                SORTED_PROJECT_IDS,
+                parse_page_cursor(data[3] if len(data) > 3 else None),
+                predicate=predicate)
+            project_list_text = (
+                "📋 *لیست کامل پروژه‌ها (مدیر):*\n"
+                f"فیلتر: *{PROJECT_LIST_FILTERS[list_filter][0]}*\n\n")
+            if not page:
+                project_list_text += "هیچ پروژه‌ای با این فیلتر یافت نشد."
+
+            keyboard = [[
+                InlineKeyboardButton(
+                    ("• " if key == list_filter else "") + label,
+                    callback_data=f'list_all_{key}')
+                for key, (label, _) in PROJECT_LIST_FILTERS.items()
+            ]]
+            for pid in page:
+                name = PROJECT_DATA.peek(str(pid)).name
                 status_button = InlineKeyboardButton(
                     f"⚙️ P{pid}: {name}", callback_data=f'status_{pid}')
                 manage_buttons = [
@@ -903,6 +4123,10 @@ async def handle_callback(update: Update, context):
                 ]
                 keyboard.append([status_button])
                 keyboard.append(manage_buttons)
+            nav_row = page_nav_row(f'list_all_{list_filter}', page, has_prev,
+                                   has_next)
+            if nav_row:
+                keyboard.append(nav_row)
 
             return await query.edit_message_text(
                 project_list_text,
@@ -911,12 +4135,13 @@ async def handle_callback(update: Update, context):
         elif action == 'status':
             project_id = data[1]
             if project_id in PROJECT_DATA:
-                project_data = PROJECT_DATA[project_id]
+                project_data = PROJECT_DATA.peek(project_id)
                 status_text = await get_status_text(project_id, project_data,
                                                     str(query.message.chat.id))
 
+                archive_row = archive_keyboard(project_id)
                 if is_manager(query.message.chat.id):
-                    back_keyboard = InlineKeyboardMarkup([[
+                    back_keyboard = InlineKeyboardMarkup(([archive_row] if archive_row else []) + [[
                         InlineKeyboardButton("بازگشت به لیست پروژه‌ها",
                                              callback_data='list_all')
                     ]])
@@ -925,10 +4150,29 @@ async def handle_callback(update: Update, context):
                         reply_markup=back_keyboard,
                         parse_mode='Markdown')
 
-                return await query.edit_message_text(status_text,
-                                                     parse_mode='Markdown')
+                return await query.edit_message_text(
+                    status_text,
+                    reply_markup=InlineKeyboardMarkup([archive_row]) if archive_row else None,
+                    parse_mode='Markdown')
             else:
                 return await query.edit_message_text("❌ پروژه یافت نشد.")
+        elif action == 'archive':
+            # callback_data: archive_<project_id>_<offset>
+            project_id = data[1]
+            project_data = PROJECT_DATA.peek(project_id)
+            if project_data is None:
+                return await query.edit_message_text("❌ پروژه یافت نشد.")
+            user_chat_id = str(query.message.chat.id)
+            if not is_manager(user_chat_id) and project_data.editor_chat_id != user_chat_id:
+                return await query.edit_message_text("⛔️ شما به این پروژه دسترسی ندارید.")
+            try:
+                archive_text, archive_markup = await get_archive_page(
+                    project_id, max(int(data[2]), 0) if len(data) > 2 else 0)
+            except Exception as e:
+                logger.error(f"❌ خطای خواندن آرشیو پروژه P{project_id}: {e}")
+                return await query.edit_message_text("❌ خواندن آرشیو پروژه ممکن نشد.")
+            return await query.edit_message_text(archive_text,
+                                                 reply_markup=archive_markup)
 
     # --- منطق تغییر نقش و حذف (فقط برای مدیر) ---
     elif action == 'manage' and is_manager(query.message.chat.id):
@@ -952,7 +4196,7 @@ async def handle_callback(update: Update, context):
             project_id = project_code[1:]
 
             if project_id in PROJECT_DATA:
-                project_name = PROJECT_DATA[project_id]['name']
+                project_name = PROJECT_DATA.peek(project_id).name
 
                 confirm_keyboard = InlineKeyboardMarkup([[
                     InlineKeyboardButton(
@@ -973,13 +4217,17 @@ async def handle_callback(update: Update, context):
             project_code = data[3]
             project_id = project_code[1:]
 
-            if project_id in PROJECT_DATA:
-                project_name = PROJECT_DATA[project_id]['name']
-                del PROJECT_DATA[project_id]
+            async with PROJECT_LOCKS.hold(project_id):
+                project_data = PROJECT_DATA.pop(project_id, None)
+                if project_data is not None:
+                    unindex_project(project_id, project_data)
+                    ARCHIVED_COUNTS.pop(project_id, None)
 
-                # ⬅️ حذف از دیتابیس
-                delete_project_from_db(project_id)
+                    # ⬅️ حذف از دیتابیس
+                    await delete_project(project_id)
 
+            if project_data is not None:
+                project_name = project_data.name
                 await query.edit_message_text(
                     f"🗑️ پروژه *'{project_name}' (P{project_id})* با موفقیت *حذف نهایی* شد."
                 )
@@ -1002,33 +4250,36 @@ async def handle_callback(update: Update, context):
         project_id = data[2]
         submission_id = data[3]
 
-        project_data = PROJECT_DATA.get(project_id)
-        if not project_data or str(
-                query.message.chat.id) != project_data['client_chat_id']:
-            return
+        async with PROJECT_LOCKS.hold(project_id):
+            project_data = await load_project(project_id)
+            if not project_data or str(
+                    query.message.chat.id) != project_data.client_chat_id:
+                return
 
-        target_submission = next((sub for sub in project_data['submissions']
-                                  if sub['submission_id'] == submission_id),
-                                 None)
+            target_submission = get_submission(project_id, submission_id,
+                                               status=SubmissionStatus.AWAITING_FEEDBACK)
+            if target_submission:
+                set_submission_status(project_id, target_submission,
+                                      SubmissionStatus.CLIENT_APPROVED)
+                review_messages = manager_review_messages(
+                    project_id, target_submission, project_data.name,
+                    'approve_without_feedback')
 
-        if not target_submission or target_submission[
-                'status'] != 'AwaitingFeedback':
+                # ⬅️ ذخیره در دیتابیس (همراه پیام‌های مدیر در outbox)
+                queued = outbox_enabled()
+                saved = await save_project(project_id, submission_id,
+                                           outbox=review_messages if queued else ())
+
+        if not target_submission:
             await query.edit_message_text(
                 "⚠️ این محتوا قبلاً بررسی شده یا وضعیت نامعتبری دارد.")
             return
 
-        target_submission['status'] = 'ClientApproved'
-        
-        # ⬅️ ذخیره در دیتابیس
-        save_project_to_db(project_id)
-
-        await query.edit_message_text(
-            f"✅ *تایید شد!* این محتوا برای تایید نهایی مدیر ارسال شد.")
-
-        await send_to_manager_for_review(context, project_id,
-                                         target_submission,
-                                         project_data['name'],
-                                         'approve_without_feedback')
+        await fan_out([
+            (f'client P{project_id}', query.edit_message_text(
+                f"✅ *تایید شد!* این محتوا برای تایید نهایی مدیر ارسال شد." + save_note(saved))),
+            *outbox_sends(context.bot, review_messages, queued)
+        ])
         return
 
     # --- منطق‌های تصمیم‌گیری مدیر ---
@@ -1038,135 +4289,199 @@ async def handle_callback(update: Update, context):
         project_id = data[3]
         submission_id = data[4]
 
-        if not is_manager(
-                query.message.chat.id) or project_id not in PROJECT_DATA:
+        if not is_manager(query.message.chat.id):
             return
 
-        project_data = PROJECT_DATA[project_id]
-        target_submission = next((sub for sub in project_data['submissions']
-                                  if sub['submission_id'] == submission_id
-                                  and sub['status'] == 'ClientReviewed'), None)
+        async with PROJECT_LOCKS.hold(project_id):
+            project_data = await load_project(project_id)
+            if project_data is None:
+                return
+            target_submission = get_submission(project_id, submission_id,
+                                               status=SubmissionStatus.CLIENT_REVIEWED)
+            if target_submission:
+                set_submission_status(project_id, target_submission,
+                                      SubmissionStatus.REJECTED_BY_CLIENT)
+
+                feedback_list = "\n".join(
+                    [f"  - {fb}" for fb in target_submission.feedback])
+                editor_message_prefix = f"❌ *نیاز به بازبینی:* محتوای شما نیاز به اصلاح دارد.\n\n*بازخوردهای کارفرما:*\n{feedback_list}\n\n*لطفاً پس از اصلاح، فایل جدید را مجدداً با کد پروژه ارسال کنید.*"
+                notifications = editor_media_messages(
+                    project_data.editor_chat_id, project_id, target_submission,
+                    editor_message_prefix) + [outbox_message(
+                        project_data.client_chat_id, 'send_message',
+                        text=f"🔄 *اطلاعیه:* بازخورد شما برای محتوای (ID: {submission_id}) توسط مدیر تایید شد و برای اصلاح به ادیتور بازگشت.",
+                        parse_mode='Markdown')]
+
+                # ⬅️ ذخیره در دیتابیس (همراه اطلاعیه‌های ادیتور و کارفرما در outbox)
+                queued = outbox_enabled()
+                saved = await save_project(project_id, submission_id,
+                                           outbox=notifications if queued else ())
 
         if not target_submission:
             return await query.edit_message_text("⚠️ وضعیت محتوا نامعتبر است.")
 
-        target_submission['status'] = 'RejectedByClient_AwaitingEditor'
-        
-        # ⬅️ ذخیره در دیتابیس
-        save_project_to_db(project_id)
-
-        await query.edit_message_text(
-            f"🔄 *بازگشت به ادیتور:* بازخورد کارفرما برای محتوای *P{project_id}* توسط مدیر تایید شد."
-        )
-
-        feedback_list = "\n".join(
-            [f"  - {fb}" for fb in target_submission['feedback']])
-        editor_message_prefix = f"❌ *نیاز به بازبینی:* محتوای شما نیاز به اصلاح دارد.\n\n*بازخوردهای کارفرما:*\n{feedback_list}\n\n*لطفاً پس از اصلاح، فایل جدید را مجدداً با کد پروژه ارسال کنید.*"
-        await send_media_to_editor(context, project_data['editor_chat_id'],
-                                   project_id, target_submission,
-                                   editor_message_prefix)
-        await context.bot.send_message(
-            project_data['client_chat_id'],
-            f"🔄 *اطلاعیه:* بازخورد شما برای محتوای (ID: {submission_id}) توسط مدیر تایید شد و برای اصلاح به ادیتور بازگشت.",
-            parse_mode='Markdown')
-        target_submission['feedback'] = []
+        # پاسخ به مدیر و (بدون دیتابیس) اطلاعیه‌های ادیتور و کارفرما همزمان ارسال می‌شوند.
+        await fan_out([
+            (f'manager P{project_id}', query.edit_message_text(
+                f"🔄 *بازگشت به ادیتور:* بازخورد کارفرما برای محتوای *P{project_id}* توسط مدیر تایید شد."
+                + save_note(saved)
+            )),
+            *outbox_sends(context.bot, notifications, queued)
+        ])
+        async with PROJECT_LOCKS.hold(project_id):
+            # ممکن است پروژه در این فاصله دوباره از دیتابیس خوانده، سرد یا حذف شده باشد.
+            await load_project(project_id)
+            target_submission = get_submission(project_id, submission_id)
+            if target_submission is not None:
+                target_submission.feedback = []
+                await save_project(project_id, submission_id,
+                                   durability=DURABILITY_DEFERRED)
 
     # 2. رد بازخورد کارفرما (تایید نهایی محتوا) ✅
     elif action == 'manager' and data[1] == 'review' and data[2] == 'reject':
         project_id = data[3]
         submission_id = data[4]
 
-        if not is_manager(
-                query.message.chat.id) or project_id not in PROJECT_DATA:
+        if not is_manager(query.message.chat.id):
             return
 
-        project_data = PROJECT_DATA[project_id]
-        target_submission = next((sub for sub in project_data['submissions']
-                                  if sub['submission_id'] == submission_id
-                                  and sub['status'] == 'ClientReviewed'), None)
+        async with PROJECT_LOCKS.hold(project_id):
+            project_data = await load_project(project_id)
+            if project_data is None:
+                return
+            target_submission = get_submission(project_id, submission_id,
+                                               status=SubmissionStatus.CLIENT_REVIEWED)
+            if target_submission:
+                set_submission_status(project_id, target_submission,
+                                      SubmissionStatus.MANAGER_APPROVED)
+
+                editor_message_prefix = f"✅ *تایید نهایی:* محتوای شما نهایی و تایید شد (علی‌رغم بازخورد کارفرما، مدیر آن را نهایی کرد)."
+                notification_text = f"✅ *تصمیم نهایی مدیر:* محتوای شما (ID: {submission_id}) از پروژه *P{project_id} - {project_data.name}* نهایی و تایید شد."
+                notifications = editor_media_messages(
+                    project_data.editor_chat_id, project_id, target_submission,
+                    editor_message_prefix) + [outbox_message(
+                        project_data.client_chat_id, 'send_message',
+                        text=f"🔔 اطلاعیه: {notification_text}",
+                        parse_mode='Markdown')]
+
+                # ⬅️ ذخیره در دیتابیس (همراه اطلاعیه‌های ادیتور و کارفرما در outbox)
+                queued = outbox_enabled()
+                saved = await save_project(project_id, submission_id,
+                                           outbox=notifications if queued else ())
 
         if not target_submission:
             return await query.edit_message_text("⚠️ وضعیت محتوا نامعتبر است.")
 
-        target_submission['status'] = 'ManagerApproved'
-        
-        # ⬅️ ذخیره در دیتابیس
-        save_project_to_db(project_id)
-
-        await query.edit_message_text(
-            f"✅ محتوای *P{project_id}* توسط مدیر نهایی شد (بازخورد کارفرما رد شد)."
-        )
-
-        editor_message_prefix = f"✅ *تایید نهایی:* محتوای شما نهایی و تایید شد (علی‌رغم بازخورد کارفرما، مدیر آن را نهایی کرد)."
-        await send_media_to_editor(context, project_data['editor_chat_id'],
-                                   project_id, target_submission,
-                                   editor_message_prefix)
-
-        notification_text = f"✅ *تصمیم نهایی مدیر:* محتوای شما (ID: {submission_id}) از پروژه *P{project_id} - {project_data['name']}* نهایی و تایید شد."
-        try:
-            await context.bot.send_message(project_data['client_chat_id'],
-                                           f"🔔 اطلاعیه: {notification_text}",
-                                           parse_mode='Markdown')
-        except:
-            pass
+        await fan_out([
+            (f'manager P{project_id}', query.edit_message_text(
+                f"✅ محتوای *P{project_id}* توسط مدیر نهایی شد (بازخورد کارفرما رد شد)."
+                + save_note(saved)
+            )),
+            *outbox_sends(context.bot, notifications, queued)
+        ])
 
     # --- تایید نهایی مدیر (حالت تایید سریع کارفرما) ---
     elif action == 'manager' and data[1] == 'final' and data[2] == 'approve':
         project_id = data[3]
         submission_id = data[4]
 
-        if not is_manager(
-                query.message.chat.id) or project_id not in PROJECT_DATA:
+        if not is_manager(query.message.chat.id):
             return
 
-        project_data = PROJECT_DATA[project_id]
-        target_submission = next((sub for sub in project_data['submissions']
-                                  if sub['submission_id'] == submission_id
-                                  and sub['status'] == 'ClientApproved'), None)
+        async with PROJECT_LOCKS.hold(project_id):
+            project_data = await load_project(project_id)
+            if project_data is None:
+                return
+            target_submission = get_submission(project_id, submission_id,
+                                               status=SubmissionStatus.CLIENT_APPROVED)
+            if target_submission:
+                set_submission_status(project_id, target_submission,
+                                      SubmissionStatus.MANAGER_APPROVED)
+
+                editor_message_prefix = f"🎉 *تایید نهایی:* محتوای شما توسط مدیر نهایی و تایید شد."
+                notification_text = f"🎉 محتوای شما (ID: {submission_id}) از پروژه *P{project_id} - {project_data.name}* توسط مدیر نهایی و تایید شد."
+                notifications = editor_media_messages(
+                    project_data.editor_chat_id, project_id, target_submission,
+                    editor_message_prefix) + [outbox_message(
+                        project_data.client_chat_id, 'send_message',
+                        text=f"🔔 اطلاعیه: {notification_text}",
+                        parse_mode='Markdown')]
+
+                # ⬅️ ذخیره در دیتابیس (همراه اطلاعیه‌های ادیتور و کارفرما در outbox)
+                queued = outbox_enabled()
+                saved = await save_project(project_id, submission_id,
+                                           outbox=notifications if queued else ())
 
         if not target_submission:
             return await query.edit_message_text(
                 "⚠️ وضعیت محتوا نامعتبری دارد یا قبلاً نهایی شده است.")
 
-        target_submission['status'] = 'ManagerApproved'
-        
-        # ⬅️ ذخیره در دیتابیس
-        save_project_to_db(project_id)
-
-        await query.edit_message_text(
-            f"✅ محتوای *P{project_id}* توسط مدیر نهایی شد.")
-
-        editor_message_prefix = f"🎉 *تایید نهایی:* محتوای شما توسط مدیر نهایی و تایید شد."
-        await send_media_to_editor(context, project_data['editor_chat_id'],
-                                   project_id, target_submission,
-                                   editor_message_prefix)
-
-        notification_text = f"🎉 محتوای شما (ID: {submission_id}) از پروژه *P{project_id} - {project_data['name']}* توسط مدیر نهایی و تایید شد."
-        try:
-            await context.bot.send_message(project_data['client_chat_id'],
-                                           f"🔔 اطلاعیه: {notification_text}",
-                                           parse_mode='Markdown')
-        except:
-            pass
+        await fan_out([
+            (f'manager P{project_id}', query.edit_message_text(
+                f"✅ محتوای *P{project_id}* توسط مدیر نهایی شد." + save_note(saved))),
+            *outbox_sends(context.bot, notifications, queued)
+        ])
 
 
 # --------------------------------------------------------------------------------------------------
 # ۶. اجرای نهایی ربات و ثبت Handlers (ساختار Webhook)
 # --------------------------------------------------------------------------------------------------
 
-def build_application():
-    """Application را برای Webhook می‌سازد و Handlers را ثبت می‌کند."""
-    
+def warm_up():
+    """اتصال به دیتابیس، بررسی جداول و بارگذاری پروژه‌ها؛ در پایان STARTUP_READY را تنظیم می‌کند.
+
+    با LAZY_STARTUP در نخ پس‌زمینه اجرا می‌شود (start_warm_up) و تا پایان آن Webhook
+    پاسخ 503 می‌دهد تا تلگرام آپدیت را بعداً دوباره بفرستد.
+    """
     # ⬅️ اتصال به دیتابیس و بارگذاری داده
     setup_db()
+    started = time.perf_counter()
     load_project_data()
+    STARTUP_TIMINGS['load'] = time.perf_counter() - started
+    STARTUP_TIMINGS['ready'] = time.perf_counter() - _IMPORT_STARTED
+    STARTUP_READY.set()
+    logger.info("✅ آماده پردازش آپدیت‌ها: " + ", ".join(
+        f"{phase}={seconds:.2f}s" for phase, seconds in STARTUP_TIMINGS.items()))
+
+
+def start_warm_up():
+    """اجرای warm_up در یک نخ پس‌زمینه (حالت LAZY_STARTUP)."""
+    threading.Thread(target=warm_up, name="warm-up", daemon=True).start()
+
+
+def startup_status():
+    """وضعیت آمادگی برای مسیر /ready (جدا از / که فقط زنده بودن فرآیند را نشان می‌دهد)."""
+    return {
+        'status': 'ready' if STARTUP_READY.is_set() else 'starting',
+        'lazy': LAZY_STARTUP,
+        'database': DB_POOL is not None,
+        'storage': STORAGE.name,
+        'projects': len(PROJECT_DATA),
+        'timings': {phase: round(seconds, 4) for phase, seconds in STARTUP_TIMINGS.items()}
+    }
+
+
+def build_application():
+    """Application را برای Webhook می‌سازد و Handlers را ثبت می‌کند (بدون کار دیتابیس)."""
 
     if not TELEGRAM_BOT_TOKEN or not MANAGER_CHAT_ID:
         raise ValueError(
             "❌ خطای پیکربندی: مقادیر BOT_TOKEN و MANAGER_ID باید تنظیم شوند."
         )
 
-    application = Application.builder().token(TELEGRAM_BOT_TOKEN).build()
+    # پردازش همزمان آپدیت‌ها؛ تغییرات هر پروژه با PROJECT_LOCKS سریال می‌شوند.
+    builder = (Application.builder().token(TELEGRAM_BOT_TOKEN)
+               .concurrent_updates(UPDATE_WORKERS)
+               .rate_limiter(SEND_SCHEDULER)  # سقف ارسال سراسری/هر چت و تکرار پس از RetryAfter
+               .post_shutdown(flush_pending_writes))
+    if BOT_API_BASE_URL:
+        file_url = BOT_API_FILE_URL or BOT_API_BASE_URL.rsplit("/bot", 1)[0] + "/file/bot"
+        builder = builder.base_url(BOT_API_BASE_URL).base_file_url(file_url)
+    if DATABASE_URL:
+        # حالت گفتگوها در دیتابیس تا هر worker بتواند مراحل چندمرحله‌ای را ادامه دهد.
+        # (Pool ممکن است هنوز ساخته نشده باشد؛ Application پس از warm_up مقداردهی می‌شود.)
+        builder = builder.persistence(STATE_PERSISTENCE)
+    application = builder.build()
 
     # Commands
     application.add_handler(CommandHandler("start", start))
@@ -1185,11 +4500,205 @@ def build_application():
     
     return application
 
+
+# --------------------------------------------------------------------------------------------------
+# ۶.۱. صف آپدیت‌ها و پردازش پس‌زمینه
+# --------------------------------------------------------------------------------------------------
+
+
+def _latency_summary(samples):
+    """خلاصه صدک‌های تاخیر (میلی‌ثانیه) برای گزارش وضعیت."""
+    if not samples:
+        return {'p50_ms': 0, 'p95_ms': 0, 'max_ms': 0}
+    ordered = sorted(samples)
+    pick = lambda pct: ordered[min(len(ordered) - 1, int(len(ordered) * pct))]
+    return {
+        'p50_ms': round(pick(0.50) * 1000, 2),
+        'p95_ms': round(pick(0.95) * 1000, 2),
+        'max_ms': round(ordered[-1] * 1000, 2)
+    }
+
+
+class UpdateDispatcher:
+    """صف محدود آپدیت‌های تلگرام و consumerهایی که آن را روی یک حلقه ماندگار خالی می‌کنند.
+
+    Webhook فقط آپدیت را در صف می‌گذارد و بلافاصله پاسخ می‌دهد؛ پردازش واقعی
+    (ارسال پیام‌ها و ذخیره در دیتابیس) در workerها انجام می‌شود.
+    """
+
+    def __init__(self, application, maxsize, workers):
+        self.application = application
+        self.maxsize = maxsize
+        self.workers = workers
+        self.loop = None
+        self.queue = None
+        self._tasks = []
+        self.received = 0
+        self.processed = 0
+        self.failed = 0
+        self.rejected = 0
+        self._wait_times = deque(maxlen=1024)  # زمان انتظار در صف
+        self._process_times = deque(maxlen=1024)  # زمان پردازش هر آپدیت
+
+    async def start(self, timeout=UPDATE_START_TIMEOUT):
+        """مقداردهی یک‌باره Application و راه‌اندازی workerها روی حلقه جاری.
+
+        loop و queue فقط پس از موفقیت همه مراحل تنظیم می‌شوند؛ اگر مقداردهی (مثلاً getMe)
+        شکست بخورد یا بیش از timeout طول بکشد، Application خاموش و خطا بالا داده می‌شود تا
+        Webhook به‌جای پذیرفتن آپدیت در صفی بدون worker پاسخ 503 بدهد و تلاش بعدی از نو شروع کند.
+        """
+        try:
+            await asyncio.wait_for(self._start_application(), timeout)
+        except BaseException:
+            await self.application.shutdown()
+            raise
+        loop = asyncio.get_running_loop()
+        self.queue = asyncio.Queue(self.maxsize)
+        self._tasks = [
+            asyncio.create_task(self._worker(), name=f"update-worker-{i}")
+            for i in range(self.workers)
+        ]
+        self.loop = loop
+        PROJECT_LISTENER.start(loop)
+        OUTBOX_DISPATCHER.start(self.application.bot)
+        SUBMISSION_ARCHIVER.start()
+        logger.info(
+            f"✅ صف آپدیت‌ها با {self.workers} worker و ظرفیت {self.maxsize} راه‌اندازی شد."
+        )
+
+    async def _start_application(self):
+        await self.application.initialize()
+        await self.application.start()
+
+    async def stop(self, timeout=UPDATE_SHUTDOWN_TIMEOUT):
+        """خالی کردن صف (حداکثر timeout ثانیه)، توقف workerها و خاموش کردن Application."""
+        if self.queue is None:
+            return
+        try:
+            await asyncio.wait_for(self.queue.join(), timeout)
+        except asyncio.TimeoutError:
+            logger.warning(
+                f"⚠️ {self.queue.qsize()} آپدیت هنگام خاموش شدن پردازش نشد.")
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        PROJECT_LISTENER.stop()
+        await OUTBOX_DISPATCHER.stop()
+        await SUBMISSION_ARCHIVER.stop()
+        await self.application.stop()
+        await self.application.shutdown()
+
+    async def enqueue(self, payload):
+        """افزودن آپدیت به صف؛ در صورت پر بودن صف False برمی‌گرداند."""
+        try:
+            self.queue.put_nowait((time.perf_counter(), payload))
+        except asyncio.QueueFull:
+            self.rejected += 1
+            return False
+        self.received += 1
+        return True
+
+    def submit(self, payload, timeout=5):
+        """نسخه thread-safe از enqueue برای فراخوانی از نخ‌های وب‌سرور (Flask)."""
+        future = asyncio.run_coroutine_threadsafe(self.enqueue(payload),
+                                                  self.loop)
+        return future.result(timeout)
+
+    async def _worker(self):
+        while True:
+            received_at, payload = await self.queue.get()
+            started = time.perf_counter()
+            self._wait_times.append(started - received_at)
+            try:
+                update = Update.de_json(payload, self.application.bot)
+                # پیام‌های یک چت به ترتیب رسیدن پردازش می‌شوند (مراحل ساخت پروژه و ترتیب
+                # ارسال‌های ادیتور)؛ کلیک دکمه‌ها و چت‌های مختلف همزمان اجرا می‌شوند.
+                chat_lock = (CHAT_LOCKS.hold(update.message.chat_id)
+                             if update.message else contextlib.nullcontext())
+                async with chat_lock:
+                    await self.application.update_processor.process_update(
+                        update, self.application.process_update(update))
+                self.processed += 1
+            except Exception as e:
+                self.failed += 1
+                logger.error(f"❌ خطای پردازش آپدیت {payload.get('update_id')}: {e}")
+            finally:
+                self._process_times.append(time.perf_counter() - started)
+                self.queue.task_done()
+
+    def stats(self):
+        """وضعیت صف برای مسیر /stats."""
+        return {
+            'queue_depth': self.queue.qsize() if self.queue else 0,
+            'queue_capacity': self.maxsize,
+            'workers': self.workers,
+            'received': self.received,
+            'processed': self.processed,
+            'failed': self.failed,
+            'rejected': self.rejected,
+            'queue_wait': _latency_summary(list(self._wait_times)),
+            'processing': _latency_summary(list(self._process_times))
+        }
+
+
+_BOT_LOOP_LOCK = threading.Lock()
+_BOT_LOOP = None
+
+
+def ensure_dispatcher_started():
+    """راه‌اندازی یک‌باره حلقه رویداد ماندگار ربات در یک نخ جدا (حالت Flask/Gunicorn).
+
+    اگر راه‌اندازی Application شکست بخورد یا از UPDATE_START_TIMEOUT بگذرد، خطا بالا داده
+    می‌شود و فراخوانی بعدی روی همان حلقه دوباره امتحان می‌کند.
+    """
+    global _BOT_LOOP
+    with _BOT_LOOP_LOCK:
+        if UPDATE_DISPATCHER.loop is not None:
+            return
+        if _BOT_LOOP is None:
+            _BOT_LOOP = asyncio.new_event_loop()
+            threading.Thread(target=_BOT_LOOP.run_forever, name="bot-loop",
+                             daemon=True).start()
+            atexit.register(stop_background_dispatcher, _BOT_LOOP)
+        asyncio.run_coroutine_threadsafe(UPDATE_DISPATCHER.start(),
+                                         _BOT_LOOP).result(UPDATE_START_TIMEOUT + 5)
+
+
+def start_dispatcher_in_background(retry_delay=UPDATE_START_RETRY):
+    """راه‌اندازی Application بلافاصله پس از warm_up، بدون انتظار برای اولین Webhook.
+
+    از hook post_worker_init در gunicorn.conf.py فراخوانی می‌شود تا listener تغییرات، outbox
+    و آرشیو از ابتدای عمر هر worker اجرا شوند؛ شکست‌ها هر retry_delay ثانیه تکرار می‌شوند.
+    """
+    def run():
+        STARTUP_READY.wait()
+        while UPDATE_DISPATCHER.loop is None:
+            try:
+                ensure_dispatcher_started()
+            except Exception as e:
+                logger.error(f"❌ خطای راه‌اندازی Application (تلاش دوباره تا {retry_delay} ثانیه دیگر): {e}")
+                time.sleep(retry_delay)
+
+    threading.Thread(target=run, name="dispatcher-start", daemon=True).start()
+
+
+def stop_background_dispatcher(loop):
+    """خاموش کردن منظم صف و Application هنگام خروج فرآیند."""
+    try:
+        asyncio.run_coroutine_threadsafe(UPDATE_DISPATCHER.stop(),
+                                         loop).result(UPDATE_SHUTDOWN_TIMEOUT + 5)
+    except Exception as e:
+        logger.error(f"❌ خطای خاموش کردن صف آپدیت‌ها: {e}")
+    loop.call_soon_threadsafe(loop.stop)
+
+
 # ⬅️ هسته اصلی Flask و Webhook
 # Gunicorn این نمونه 'app' را اجرا می کند.
 app = Flask(__name__)
 # Application ربات در خارج از تابع build_application ساخته می‌شود.
 TG_APPLICATION = build_application()
+UPDATE_DISPATCHER = UpdateDispatcher(TG_APPLICATION, UPDATE_QUEUE_SIZE,
+                                     UPDATE_WORKERS)
 
 # ⬅️ آدرس پینگ/Keep Alive (مسیر ریشه /)
 @app.route('/', methods=['GET'])
@@ -1197,19 +4706,198 @@ def home():
     """پاسخ به پینگ UptimeRobot."""
     return "Hello. I am alive!"
 
+# ⬅️ آمادگی (readiness): پس از بارگذاری پروژه‌ها 200، در حین راه‌اندازی 503
+@app.route('/ready', methods=['GET'])
+def ready():
+    """گزارش آمادگی پردازش آپدیت‌ها و زمان هر مرحله راه‌اندازی."""
+    status = startup_status()
+    return jsonify(status), 200 if status['status'] == 'ready' else 503
+
+def service_stats():
+    """وضعیت صف آپدیت‌ها همراه با وضعیت هماهنگی کش و نوشتن‌ها بین workerها."""
+    stats = UPDATE_DISPATCHER.stats()
+    stats['cache_sync'] = PROJECT_LISTENER.stats()
+    stats['writes'] = WRITE_QUEUE.stats()
+    stats['project_cache'] = PROJECT_DATA.stats()
+    stats['conversation_state'] = STATE_PERSISTENCE.stats()
+    stats['locks'] = {'project': PROJECT_LOCKS.stats(), 'chat': CHAT_LOCKS.stats()}
+    stats['outbound'] = SEND_SCHEDULER.stats()
+    stats['outbox'] = OUTBOX_DISPATCHER.stats()
+    stats['archive'] = SUBMISSION_ARCHIVER.stats()
+    stats['startup'] = startup_status()
+    return stats
+
+# ⬅️ وضعیت صف آپدیت‌ها (عمق صف و تاخیر پردازش)
+@app.route('/stats', methods=['GET'])
+def stats():
+    """گزارش وضعیت صف آپدیت‌ها."""
+    return jsonify(service_stats())
+
+def parse_webhook_request(secret_header, raw_body):
+    """اعتبارسنجی درخواست Webhook؛ خروجی (payload، کد HTTP خطا یا None)."""
+    # اعتبارسنجی هدر secret_token (در صورت تنظیم WEBHOOK_SECRET)
+    if WEBHOOK_SECRET and secret_header != WEBHOOK_SECRET:
+        return None, 403
+    try:
+        payload = json.loads(raw_body)
+    except ValueError:
+        return None, 400
+    if not isinstance(payload, dict) or "update_id" not in payload:
+        return None, 400
+    return payload, None
+
+
+WEBHOOK_ERROR_BODIES = {400: "bad request", 403: "forbidden", 503: "busy"}
+WEBHOOK_STARTING_BODY = {"status": "starting"}
+
 # ⬅️ آدرس Webhook اصلی (با استفاده از توکن به عنوان مسیر)
 @app.route(f"/{TELEGRAM_BOT_TOKEN}", methods=["POST"])
-async def handle_webhook():
-    """دریافت به‌روزرسانی (Update) از تلگرام و ارسال به Application."""
+def handle_webhook():
+    """دریافت به‌روزرسانی (Update) از تلگرام، قرار دادن در صف و پاسخ فوری."""
     
-    # اطمینان از مقداردهی اولیه Application 
-    await TG_APPLICATION.initialize()
-    
-    if request.method == "POST":
-        # دریافت داده JSON از درخواست تلگرام
-        update = Update.de_json(request.get_json(force=True), TG_APPLICATION.bot)
-        
-        # پردازش آپدیت به صورت ناهمگام (Async)
-        await TG_APPLICATION.process_update(update)
+    # دریافت داده JSON از درخواست تلگرام
+    payload, error_status = parse_webhook_request(
+        request.headers.get("X-Telegram-Bot-Api-Secret-Token"),
+        request.get_data())
+    if error_status:
+        return jsonify({"status": WEBHOOK_ERROR_BODIES[error_status]}), error_status
+    if not STARTUP_READY.is_set():
+        # پروژه‌ها هنوز بارگذاری نشده‌اند؛ تلگرام آپدیت را بعداً دوباره ارسال می‌کند.
+        return jsonify(WEBHOOK_STARTING_BODY), 503
+
+    # Application معمولاً هنگام بالا آمدن worker راه‌اندازی شده است (gunicorn.conf.py)؛
+    # در غیر این صورت همین‌جا یک بار مقداردهی می‌شود و روی حلقه ماندگار خود اجرا می‌شود.
+    try:
+        ensure_dispatcher_started()
+    except Exception as e:
+        logger.error(f"❌ خطای راه‌اندازی Application: {e}")
+        return jsonify(WEBHOOK_STARTING_BODY), 503
+
+    if not UPDATE_DISPATCHER.submit(payload):
+        # صف پر است؛ تلگرام آپدیت را بعداً دوباره ارسال می‌کند.
+        logger.warning(f"⚠️ صف آپدیت‌ها پر است؛ آپدیت {payload['update_id']} رد شد.")
+        return jsonify({"status": "busy"}), 503
         
-    return jsonify({"status": "ok"})
\ No newline at end of file
+    return jsonify({"status": "ok"})
+
+
+# --------------------------------------------------------------------------------------------------
+# ۶.۲. نقطه ورود ASGI (یک حلقه رویداد ماندگار؛ اجرا با: uvicorn app:asgi_app)
+# --------------------------------------------------------------------------------------------------
+
+
+async def _asgi_respond(send, status, body, content_type=b"application/json"):
+    if not isinstance(body, bytes):
+        body = json.dumps(body).encode()
+    await send({
+        'type': 'http.response.start',
+        'status': status,
+        'headers': [(b'content-type', content_type),
+                    (b'content-length', str(len(body)).encode())]
+    })
+    await send({'type': 'http.response.body', 'body': body})
+
+
+async def _asgi_read_body(receive):
+    body = b""
+    while True:
+        message = await receive()
+        body += message.get('body', b"")
+        if not message.get('more_body'):
+            return body
+
+
+async def _asgi_start_when_ready(retry_delay=UPDATE_START_RETRY):
+    """انتظار برای warm_up (بدون مسدود کردن حلقه) و سپس راه‌اندازی Application روی حلقه ASGI.
+
+    تا موفقیت راه‌اندازی، Webhook پاسخ 503 می‌دهد و شکست‌ها هر retry_delay ثانیه تکرار می‌شوند.
+    """
+    await asyncio.get_running_loop().run_in_executor(None, STARTUP_READY.wait)
+    while UPDATE_DISPATCHER.queue is None:
+        try:
+            await UPDATE_DISPATCHER.start()
+        except Exception as e:
+            logger.error(f"❌ خطای راه‌اندازی Application در حالت ASGI: {e}")
+            await asyncio.sleep(retry_delay)
+
+
+async def asgi_app(scope, receive, send):
+    """اپلیکیشن ASGI: همان مسیرهای Flask، اما Application روی حلقه خود سرور ASGI میزبانی می‌شود.
+
+    در رویداد lifespan، Application یک بار مقداردهی و در پایان خاموش می‌شود؛ بنابراین
+    کلاینت HTTP ربات و اتصالات آن به Bot API در تمام عمر فرآیند حفظ می‌شوند.
+    """
+    if scope['type'] == 'lifespan':
+        startup_task = None
+        while True:
+            message = await receive()
+            if message['type'] == 'lifespan.startup':
+                if not STARTUP_READY.is_set():
+                    # سرور بلافاصله شروع به پاسخ می‌کند؛ Application پس از warm_up بالا می‌آید.
+                    startup_task = asyncio.create_task(_asgi_start_when_ready())
+                    await send({'type': 'lifespan.startup.complete'})
+                    continue
+                try:
+                    await UPDATE_DISPATCHER.start()
+                except Exception as e:
+                    logger.error(f"❌ خطای راه‌اندازی Application در حالت ASGI: {e}")
+                    await send({'type': 'lifespan.startup.failed',
+                                'message': str(e)})
+                    return
+                await send({'type': 'lifespan.startup.complete'})
+            elif message['type'] == 'lifespan.shutdown':
+                if startup_task is not None and not startup_task.done():
+                    startup_task.cancel()
+                await UPDATE_DISPATCHER.stop()
+                await send({'type': 'lifespan.shutdown.complete'})
+                return
+
+    if scope['type'] != 'http':
+        return
+
+    path = scope['path']
+    method = scope['method']
+
+    # ⬅️ آدرس پینگ/Keep Alive (مسیر ریشه /)
+    if path == '/' and method in ('GET', 'HEAD'):
+        return await _asgi_respond(send, 200, b"Hello. I am alive!",
+                                   b"text/html; charset=utf-8")
+
+    if path == '/ready' and method == 'GET':
+        status = startup_status()
+        if status['status'] == 'ready' and UPDATE_DISPATCHER.queue is None:
+            status['status'] = 'starting'  # Application هنوز روی حلقه ASGI بالا نیامده است.
+        return await _asgi_respond(send, 200 if status['status'] == 'ready' else 503, status)
+
+    if path == '/stats' and method == 'GET':
+        return await _asgi_respond(send, 200, service_stats())
+
+    if path == f"/{TELEGRAM_BOT_TOKEN}" and method == 'POST':
+        headers = dict(scope.get('headers') or [])
+        secret_header = headers.get(b'x-telegram-bot-api-secret-token')
+        payload, error_status = parse_webhook_request(
+            secret_header.decode() if secret_header else None,
+            await _asgi_read_body(receive))
+        if error_status:
+            return await _asgi_respond(
+                send, error_status,
+                {"status": WEBHOOK_ERROR_BODIES[error_status]})
+        if UPDATE_DISPATCHER.queue is None:
+            return await _asgi_respond(send, 503, WEBHOOK_STARTING_BODY)
+        if not await UPDATE_DISPATCHER.enqueue(payload):
+            logger.warning(f"⚠️ صف آپدیت‌ها پر است؛ آپدیت {payload['update_id']} رد شد.")
+            return await _asgi_respond(send, 503, {"status": "busy"})
+        return await _asgi_respond(send, 200, {"status": "ok"})
+
+    await _asgi_respond(send, 404, {"status": "not found"})
+
+
+# --------------------------------------------------------------------------------------------------
+# ۶.۳. راه‌اندازی (دیتابیس و بارگذاری پروژه‌ها)
+# --------------------------------------------------------------------------------------------------
+
+STARTUP_TIMINGS['import'] = time.perf_counter() - _IMPORT_STARTED
+if LAZY_STARTUP:
+    start_warm_up()
+else:
+    warm_up()
@@ -0,0 +1,244 @@
+"""سرور جعلی و محلی Bot API تلگرام برای تست‌های کارایی end-to-end (فقط کتابخانه استاندارد).
+
+اجرا:
+    python fake_bot_api.py --port 8081 --latency-ms 40 --error-rate 0.01 --retry-after-rate 0.02
+    BOT_API_BASE_URL=http://127.0.0.1:8081/bot gunicorn app:app
+
+هر فراخوانی (متد، پارامترها، کد پاسخ و تاخیر) ثبت می‌شود:
+    GET  /calls          خلاصه فراخوانی‌ها به تفکیک متد
+    GET  /calls?full=1   همه فراخوانی‌ها
+    POST /reset          خالی کردن فهرست فراخوانی‌ها
+"""
+import argparse
+import email
+import itertools
+import json
+import random
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlsplit
+
+BOT_USER = {"id": 1, "is_bot": True, "first_name": "fake", "username": "fake_bot",
+            "can_join_groups": True, "can_read_all_group_messages": False,
+            "supports_inline_queries": False}
+# متدهایی که خطا و RetryAfter روی آن‌ها تزریق نمی‌شود (راه‌اندازی Application نباید شکست بخورد).
+NEVER_FAULT = frozenset({"getMe", "setWebhook", "deleteWebhook", "getWebhookInfo"})
+MEDIA_METHODS = {"sendPhoto": "photo", "sendVideo": "video", "sendDocument": "document"}
+TRUE_METHODS = frozenset({"answerCallbackQuery", "setWebhook", "deleteWebhook",
+                          "setMyCommands", "deleteMessage"})
+
+
+def parse_parameters(content_type, body):
+    """پارامترهای درخواست Bot API (JSON، فرم urlencoded یا multipart)."""
+    if not body:
+        return {}
+    if content_type.startswith("application/json"):
+        return json.loads(body)
+    if content_type.startswith("multipart/form-data"):
+        message = email.message_from_bytes(
+            f"Content-Type: {content_type}\r\n\r\n".encode() + body)
+        params = {}
+        for part in message.get_payload():
+            name = part.get_param("name", header="content-disposition")
+            if part.get_filename():
+                params[name] = f"<upload {part.get_filename()}>"
+            else:
+                params[name] = part.get_payload(decode=True).decode()
+        return params
+    return {key: values[-1] for key, values in parse_qs(body.decode()).items()}
+
+
+def _chat_id(params):
+    try:
+        return int(params.get("chat_id", 1))
+    except (TypeError, ValueError):
+        return 1
+
+
+class FakeBotAPI:
+    """وضعیت سرور جعلی: تنظیمات تزریق خطا، شمارنده شناسه پیام‌ها و فهرست فراخوانی‌ها."""
+
+    def __init__(self, host="127.0.0.1", port=8081, latency=0.0, jitter=0.0, error_rate=0.0,
+                 error_status=502, retry_after_rate=0.0, retry_after=1, seed=None):
+        self.latency = latency
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.error_status = error_status
+        self.retry_after_rate = retry_after_rate
+        self.retry_after = retry_after
+        self.calls = []
+        self._rng = random.Random(seed)
+        self._lock = threading.Lock()
+        self._message_ids = itertools.count(1)
+        self.server = ThreadingHTTPServer((host, port), self._handler_class())
+        self.server.daemon_threads = True
+        self._thread = None
+
+    @property
+    def base_url(self):
+        host, port = self.server.server_address[:2]
+        return f"http://{host}:{port}/bot"
+
+    def start(self):
+        """اجرای سرور در یک نخ پس‌زمینه (برای استفاده درون‌فرآیندی)."""
+        self._thread = threading.Thread(target=self.server.serve_forever,
+                                        name="fake-bot-api", daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def reset(self):
+        with self._lock:
+            self.calls = []
+
+    def summary(self):
+        """تعداد، خطاها، RetryAfterها و تاخیر سرور به تفکیک متد."""
+        with self._lock:
+            calls = list(self.calls)
+        methods = {}
+        for call in calls:
+            entry = methods.setdefault(call["method"], {"calls": 0, "errors": 0,
+                                                        "retry_after": 0, "latency_ms": 0.0})
+            entry["calls"] += 1
+            entry["latency_ms"] += call["latency_ms"]
+            if call["status"] == 429:
+                entry["retry_after"] += 1
+            elif call["status"] != 200:
+                entry["errors"] += 1
+        for entry in methods.values():
+            entry["latency_ms"] = round(entry["latency_ms"] / entry["calls"], 2)
+        return {"calls": len(calls), "methods": methods}
+
+    def respond(self, method, params):
+        """خروجی (کد HTTP، بدنه JSON) برای یک فراخوانی؛ تاخیر و خطاها در همین‌جا اعمال می‌شوند."""
+        delay = self.latency + (self._rng.uniform(0, self.jitter) if self.jitter else 0.0)
+        if delay:
+            time.sleep(delay)
+        if method not in NEVER_FAULT:
+            roll = self._rng.random()
+            if roll < self.retry_after_rate:
+                return 429, {"ok": False, "error_code": 429,
+                             "description": f"Too Many Requests: retry after {self.retry_after}",
+                             "parameters": {"retry_after": self.retry_after}}
+            if roll < self.retry_after_rate + self.error_rate:
+                return self.error_status, {"ok": False, "error_code": self.error_status,
+                                           "description": "Bad Gateway"}
+        return 200, {"ok": True, "result": self.result(method, params)}
+
+    def result(self, method, params):
+        """یک نتیجه معتبر (از نظر python-telegram-bot) برای متد فراخوانی‌شده."""
+        if method == "getMe":
+            return BOT_USER
+        if method in TRUE_METHODS:
+            return True
+        message_id = next(self._message_ids)
+        if method == "copyMessage":
+            return {"message_id": message_id}
+        if method == "getFile":
+            return {"file_id": params.get("file_id", "file"), "file_unique_id": "u",
+                    "file_path": f"files/{message_id}"}
+        message = {"message_id": message_id, "date": int(time.time()),
+                   "chat": {"id": _chat_id(params), "type": "private"}, "from": BOT_USER}
+        if method in MEDIA_METHODS:
+            field = MEDIA_METHODS[method]
+            media = {"file_id": str(params.get(field, "file")), "file_unique_id": f"u{message_id}"}
+            if field == "photo":
+                media.update(width=1, height=1)
+                message["photo"] = [media]
+            elif field == "video":
+                media.update(width=1, height=1, duration=1)
+                message["video"] = media
+            else:
+                message["document"] = media
+            if "caption" in params:
+                message["caption"] = params["caption"]
+        else:
+            message["text"] = params.get("text", "ok")
+        if method.startswith("edit"):
+            message["message_id"] = int(params.get("message_id", message_id))
+            message["edit_date"] = message["date"]
+        return message
+
+    def _record(self, method, params, status, started):
+        with self._lock:
+            self.calls.append({"method": method, "params": params, "status": status,
+                               "at": started,
+                               "latency_ms": round((time.time() - started) * 1000, 2)})
+
+    def _handler_class(self):
+        fake = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"  # keep-alive مثل api.telegram.org
+
+            def log_message(self, format, *args):
+                pass
+
+            def _send(self, status, payload):
+                body = json.dumps(payload).encode()
+                self.send_response(status)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def _dispatch(self):
+                started = time.time()
+                url = urlsplit(self.path)
+                body = self.rfile.read(int(self.headers.get("Content-Length") or 0))
+                if url.path == "/calls":
+                    full = parse_qs(url.query).get("full") == ["1"]
+                    with fake._lock:
+                        calls = list(fake.calls)
+                    return self._send(200, calls if full else fake.summary())
+                if url.path == "/reset":
+                    fake.reset()
+                    return self._send(200, {"ok": True})
+                # /bot<token>/<method>
+                if not url.path.startswith("/bot") or url.path.count("/") != 2:
+                    return self._send(404, {"ok": False, "error_code": 404,
+                                            "description": "Not Found"})
+                method = url.path.rsplit("/", 1)[-1]
+                params = parse_parameters(self.headers.get("Content-Type", ""), body)
+                params.update((k, v[-1]) for k, v in parse_qs(url.query).items())
+                status, payload = fake.respond(method, params)
+                fake._record(method, params, status, started)
+                self._send(status, payload)
+
+            do_GET = do_POST = _dispatch
+
+        return Handler
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8081)
+    parser.add_argument("--latency-ms", type=float, default=0)
+    parser.add_argument("--jitter-ms", type=float, default=0,
+                        help="extra uniform random latency per call")
+    parser.add_argument("--error-rate", type=float, default=0)
+    parser.add_argument("--error-status", type=int, default=502)
+    parser.add_argument("--retry-after-rate", type=float, default=0)
+    parser.add_argument("--retry-after", type=int, default=1, help="seconds")
+    parser.add_argument("--seed", type=int)
+    args = parser.parse_args()
+
+    fake = FakeBotAPI(args.host, args.port, args.latency_ms / 1000, args.jitter_ms / 1000,
+                      args.error_rate, args.error_status, args.retry_after_rate,
+                      args.retry_after, args.seed)
+    print(f"fake Bot API on {fake.base_url} (BOT_API_BASE_URL)", flush=True)
+    try:
+        fake.server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        fake.server.server_close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,10 @@
+"""تنظیمات Gunicorn (به‌طور خودکار از ./gunicorn.conf.py در پوشه اجرا خوانده می‌شود)."""
+
+
+def post_worker_init(worker):
+    """راه‌اندازی Application ربات بلافاصله پس از بارگذاری app در هر worker، نه با اولین Webhook."""
+    import app as bot
+
+    # در workerهای ASGI (مثلاً uvicorn.workers.UvicornWorker) رویداد lifespan همین کار را می‌کند.
+    if worker.wsgi is bot.app:
+        bot.start_dispatcher_in_background()
@@ -0,0 +1,15 @@
+"""تنظیمات مشترک تست‌ها؛ app.py در زمان import به این متغیرها نیاز دارد."""
+import os
+import sys
+
+os.environ.setdefault("BOT_TOKEN", "0:test")
+os.environ.setdefault("MANAGER_ID", "1")
+# import بدون دیتابیس و بدون نخ warm-up؛ هر تست backend خود را راه‌اندازی می‌کند.
+os.environ.setdefault("LAZY_STARTUP", "0")
+os.environ.pop("DATABASE_URL", None)
+# بدون سقف ارسال، تا تست‌های هندلرها منتظر صف ارسال Bot API نمانند.
+os.environ.setdefault("OUTBOUND_GLOBAL_RATE", "1000000")
+os.environ.setdefault("OUTBOUND_CHAT_RATE", "1000000")
+os.environ.setdefault("OUTBOUND_CHAT_BURST", "1000000")
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
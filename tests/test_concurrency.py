@@ -0,0 +1,248 @@
+"""پردازش همزمان آپدیت‌ها با چند worker روی یک دیتابیس SQLite واقعی.
+
+تأیید/رد/بازخوردهای همزمان روی پروژه‌های مشترک نباید گم یا ناموفق شوند و هر ذخیره
+همگام (DURABILITY_SYNC) پیش از ادامه هندلر در دیتابیس commit شده باشد.
+"""
+import asyncio
+import itertools
+import json
+import random
+import threading
+import time
+
+import pytest
+from telegram.request import BaseRequest
+
+import app
+
+PROJECTS = 4
+SUBMISSIONS = 8
+UPLOADS = 2
+WORKERS = 8
+MEDIA_ID_BASE = 1_000_000  # جدا از شناسه پیام‌هایی که StubRequest می‌سازد
+MANAGER = int(app.MANAGER_CHAT_ID)
+
+
+class StubRequest(BaseRequest):
+    """BaseRequest بدون شبکه که برای هر متد Bot API یک پاسخ معتبر می‌سازد."""
+
+    def __init__(self):
+        self._message_ids = itertools.count(1)
+
+    async def initialize(self):
+        pass
+
+    async def shutdown(self):
+        pass
+
+    @property
+    def read_timeout(self):
+        return None
+
+    async def do_request(self, url, method, request_data=None, **kwargs):
+        endpoint = url.rsplit("/", 1)[-1]
+        params = request_data.parameters if request_data else {}
+        if endpoint == "getMe":
+            result = {"id": 1, "is_bot": True, "first_name": "test", "username": "test_bot"}
+        elif endpoint in ("answerCallbackQuery", "editMessageReplyMarkup"):
+            result = True
+        elif endpoint == "copyMessage":
+            result = {"message_id": next(self._message_ids)}
+        else:
+            result = {"message_id": next(self._message_ids), "date": int(time.time()),
+                      "chat": {"id": int(params.get("chat_id", 1)), "type": "private"},
+                      "text": "ok"}
+        return 200, json.dumps({"ok": True, "result": result}).encode()
+
+
+@pytest.fixture
+def sqlite_db(tmp_path, monkeypatch):
+    url = f"sqlite:///{tmp_path / 'bot.db'}"
+    monkeypatch.setattr(app, "DATABASE_URL", url)
+    monkeypatch.setattr(app, "STORAGE", app.storage_backend(url))
+    monkeypatch.setattr(app, "DB_POOL", None)
+    monkeypatch.setattr(app, "DB_CONN_KWARGS", None)
+    app.setup_db()
+    assert app.DB_POOL is not None, "setup_db failed"
+    yield
+    app.WRITE_QUEUE.flush()
+    app.DB_POOL.closeall()
+    app.PROJECT_DATA.reset({})
+    app.WRITE_QUEUE.reset_versions({})
+    app.rebuild_indexes()
+
+
+def _stored_status(submission_id):
+    conn = app.get_db_conn()
+    try:
+        cur = conn.cursor()
+        cur.execute("SELECT status FROM submissions WHERE submission_id = %s;", (submission_id,))
+        row = cur.fetchone()
+        return row and row[0]
+    finally:
+        app.release_db_conn(conn)
+
+
+def _store_projects():
+    for p in range(1, PROJECTS + 1):
+        app.PROJECT_DATA[str(p)] = app.Project(
+            f"concurrent-{p}", client_chat_id=str(20_000 + p), editor_chat_id=str(30_000 + p),
+            submissions=[app.Submission(f"{p}-{j}", media_message_id=MEDIA_ID_BASE + j,
+                                        file_id=f"file-{p}-{j}", media_type="photo",
+                                        caption=f"P{p}")
+                         for j in range(SUBMISSIONS)])
+    app.rebuild_indexes()
+    for p in range(1, PROJECTS + 1):
+        assert app.save_project_to_db(str(p))
+        for submission in app.PROJECT_DATA[str(p)].submissions:
+            assert app.save_project_to_db(str(p), submission.submission_id)
+
+
+_update_ids = itertools.count(1)
+
+
+def _message(chat_id, text=None, **fields):
+    update_id = next(_update_ids)
+    message = {"message_id": update_id, "date": int(time.time()),
+               "chat": {"id": chat_id, "type": "private"},
+               "from": {"id": chat_id, "is_bot": False, "first_name": "test"}, **fields}
+    if text is not None:
+        message["text"] = text
+    return {"update_id": update_id, "message": message}
+
+
+def _reply(chat_id, text, reply_to):
+    return _message(chat_id, text, reply_to_message={
+        "message_id": reply_to, "date": int(time.time()),
+        "chat": {"id": chat_id, "type": "private"}})
+
+
+def _upload(chat_id, caption):
+    update = _message(chat_id, caption=caption)
+    update_id = update["update_id"]
+    update["message"]["photo"] = [{"file_id": f"photo-{update_id}",
+                                   "file_unique_id": f"u{update_id}", "width": 1, "height": 1}]
+    return update
+
+
+def _callback(chat_id, data):
+    update_id = next(_update_ids)
+    return {"update_id": update_id, "callback_query": {
+        "id": str(update_id), "chat_instance": "test", "data": data,
+        "from": {"id": chat_id, "is_bot": False, "first_name": "test"},
+        "message": {"message_id": update_id, "date": int(time.time()),
+                    "chat": {"id": chat_id, "type": "private"}, "text": "test"}}}
+
+
+def _phases():
+    """موج اول: تأیید یا بازخورد کارفرماها و ارسال‌های جدید ادیتورها؛ موج دوم: تصمیم مدیر."""
+    first, second = [], []
+    for p in range(1, PROJECTS + 1):
+        client, editor = 20_000 + p, 30_000 + p
+        for j in range(SUBMISSIONS):
+            if j % 2 == 0:
+                first.append(_callback(client, f"client_approve_{p}_{p}-{j}"))
+                second.append(_callback(MANAGER, f"manager_final_approve_{p}_{p}-{j}"))
+            else:
+                first.append(_reply(client, f"fb-{p}-{j}", MEDIA_ID_BASE + j))
+                decision = "accept" if j % 4 == 1 else "reject"
+                second.append(_callback(MANAGER, f"manager_review_{decision}_{p}_{p}-{j}"))
+        first += [_upload(editor, f"P{p} new {k}") for k in range(UPLOADS)]
+    random.shuffle(first)
+    random.shuffle(second)
+    return first, second
+
+
+async def _process(phases):
+    dispatcher = app.UpdateDispatcher(app.TG_APPLICATION, 10_000, WORKERS)
+    await dispatcher.start()
+    try:
+        for updates in phases:
+            for update in updates:
+                assert await dispatcher.enqueue(update)
+            await dispatcher.queue.join()
+    finally:
+        await dispatcher.stop()
+    return dispatcher
+
+
+def test_concurrent_transitions_are_not_lost(sqlite_db, monkeypatch):
+    request = StubRequest()
+    monkeypatch.setattr(app.TG_APPLICATION.bot, "_request", (request, request))
+    _store_projects()
+
+    # هر ذخیره همگام محتوا باید پیش از ادامه هندلر با همان وضعیت حافظه در دیتابیس باشد.
+    unsynced = []
+    save_project = app.save_project
+
+    async def checked_save_project(project_id, submission_id=None,
+                                   durability=app.DURABILITY_SYNC, outbox=()):
+        saved = await save_project(project_id, submission_id, durability, outbox)
+        if submission_id is not None and durability == app.DURABILITY_SYNC:
+            status = app.get_submission(project_id, submission_id).status
+            stored = _stored_status(submission_id)
+            if not saved or stored != status:
+                unsynced.append(f"{submission_id}: saved={saved} {stored} != {status}")
+        return saved
+
+    monkeypatch.setattr(app, "save_project", checked_save_project)
+    random.seed(14)
+    dispatcher = asyncio.run(_process(_phases()))
+
+    assert dispatcher.failed == 0
+    assert dispatcher.processed == PROJECTS * (2 * SUBMISSIONS + UPLOADS)
+    assert unsynced == []
+    expected = {0: app.SubmissionStatus.MANAGER_APPROVED,
+                1: app.SubmissionStatus.REJECTED_BY_CLIENT,
+                3: app.SubmissionStatus.MANAGER_APPROVED}
+    app.WRITE_QUEUE.flush()
+    for p in range(1, PROJECTS + 1):
+        submissions = app.PROJECT_DATA[str(p)].submissions
+        assert len(submissions) == SUBMISSIONS + UPLOADS
+        stored = app.fetch_project_from_db(str(p))[0].submissions
+        assert [s.to_dict() for s in stored] == [s.to_dict() for s in submissions]
+        for j, submission in enumerate(submissions[:SUBMISSIONS]):
+            assert submission.status == expected[0 if j % 2 == 0 else j % 4]
+            assert submission.feedback == ([f"fb-{p}-{j}"] if j % 4 == 3 else [])
+        for submission in submissions[SUBMISSIONS:]:
+            assert submission.status == app.SubmissionStatus.AWAITING_FEEDBACK
+    counts = {status: count for status, count in app.GLOBAL_STATUS_COUNTS.items() if count}
+    assert counts == {
+        app.SubmissionStatus.MANAGER_APPROVED: PROJECTS * (SUBMISSIONS // 2 + SUBMISSIONS // 4),
+        app.SubmissionStatus.REJECTED_BY_CLIENT: PROJECTS * SUBMISSIONS // 4,
+        app.SubmissionStatus.AWAITING_FEEDBACK: PROJECTS * UPLOADS,
+    }
+
+
+def test_sync_flush_waits_for_inflight_background_write(sqlite_db, monkeypatch):
+    _store_projects()
+    submission = app.PROJECT_DATA["1"].submissions[0]
+    app.set_submission_status("1", submission, app.SubmissionStatus.CLIENT_APPROVED)
+    key, row = app.project_snapshot("1", submission.submission_id)
+
+    # flush پس‌زمینه سطر را از صف برمی‌دارد و وسط نوشتن آن می‌ماند.
+    writing, release = threading.Event(), threading.Event()
+    save_rows_to_db = app.save_rows_to_db
+
+    def slow_save_rows_to_db(*args, **kwargs):
+        writing.set()
+        release.wait(5)
+        return save_rows_to_db(*args, **kwargs)
+
+    monkeypatch.setattr(app, "save_rows_to_db", slow_save_rows_to_db)
+    app.WRITE_QUEUE.mark_dirty(key, row)
+    background = threading.Thread(target=app.WRITE_QUEUE.flush)
+    background.start()
+    assert writing.wait(5)
+    assert app.WRITE_QUEUE.pending_keys("1") == []
+
+    results = []
+    sync = threading.Thread(target=lambda: results.append(app.WRITE_QUEUE.flush([key])))
+    sync.start()
+    sync.join(0.3)
+    assert sync.is_alive(), "sync flush returned before the in-flight write committed"
+    release.set()
+    sync.join(5)
+    background.join(5)
+    assert results == [True]
+    assert _stored_status(submission.submission_id) == app.SubmissionStatus.CLIENT_APPROVED